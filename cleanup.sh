@@ -57,7 +57,7 @@ else
     
     # Remove state file
     echo "Removing state file..."
-    rm -f /var/lib/vpcctl/state.json
+    rm -f /var/lib/vpcctl/state.db* /var/lib/vpcctl/state.json
     
     echo ""
     echo "✓ Manual cleanup completed"
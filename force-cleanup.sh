@@ -5,7 +5,7 @@
 echo "Force cleaning VPC resources..."
 
 # Remove state file
-sudo rm -f /var/lib/vpcctl/state.json
+sudo rm -f /var/lib/vpcctl/state.db* /var/lib/vpcctl/state.json
 echo "✓ Removed state file"
 
 # Kill all Python processes in namespaces
@@ -19,6 +19,7 @@ fi
 # Installation directories
 INSTALL_DIR="/opt/vpcctl"
 BIN_LINK="/usr/local/bin/vpcctl"
+DAEMON_LINK="/usr/local/bin/vpcctld"
 
 # Create installation directory
 echo "Creating installation directory: $INSTALL_DIR"
@@ -28,8 +29,8 @@ mkdir -p "$INSTALL_DIR/policies"
 
 # Copy files
 echo "Copying vpcctl..."
-cp vpcctl "$INSTALL_DIR/"
-chmod +x "$INSTALL_DIR/vpcctl"
+cp vpcctl vpcctld "$INSTALL_DIR/"
+chmod +x "$INSTALL_DIR/vpcctl" "$INSTALL_DIR/vpcctld"
 
 echo "Copying library modules..."
 cp lib/*.py "$INSTALL_DIR/lib/"
@@ -44,6 +45,7 @@ chmod +x "$INSTALL_DIR/cleanup.sh"
 # Create symlink
 echo "Creating symlink in /usr/local/bin..."
 ln -sf "$INSTALL_DIR/vpcctl" "$BIN_LINK"
+ln -sf "$INSTALL_DIR/vpcctld" "$DAEMON_LINK"
 
 # Create required directories
 echo "Creating state and log directories..."
@@ -0,0 +1,242 @@
+"""
+App Server - The HTTP server `vpcctl deploy-app` runs inside a subnet
+
+Built to measure the network rather than itself:
+
+- the whole response (headers and body) is rendered once at startup
+- connections are kept alive and pipelined requests are answered in order
+- --workers N processes each open their own listening socket with
+  SO_REUSEPORT, so the kernel spreads connections across them without a
+  shared accept queue or a lock
+- --mode asyncio (default) runs one event loop per worker; --mode
+  threaded runs a thread per connection instead
+- SIGTERM drains: the listening socket closes, idle connections are
+  closed, requests already arriving are answered with `Connection: close`,
+  and the process exits once no connection is left (or after
+  DRAIN_SECONDS). The parent passes SIGTERM on to its workers and waits
+  for them, and a worker whose parent is killed outright gets SIGTERM too
+
+Run as a script (deploy-app starts it inside the namespace):
+
+    python3 app_server.py --port 8080 --workers 4 --body /tmp/app-prod-web.html
+"""
+
+import argparse
+import ctypes
+import os
+import signal
+import socket
+import threading
+import time
+
+# Headers bigger than this aren't a client we want to serve
+MAX_HEADER = 64 * 1024
+
+# How long a SIGTERM'd server waits for busy connections to finish
+DRAIN_SECONDS = 2
+
+PR_SET_PDEATHSIG = 1
+
+def render_responses(body, content_type='text/html'):
+    """(keep-alive response, closing response) as ready-to-send bytes"""
+    def render(connection):
+        head = (f"HTTP/1.1 200 OK\r\n"
+                f"Server: vpcctl-app\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {connection}\r\n\r\n")
+        return head.encode() + body
+    return render('keep-alive'), render('close')
+
+def parse_requests(buffer):
+    """Complete requests at the start of buffer: ([keep-alive?, ...], rest)
+
+    rest is None if the client sent something we won't parse.
+    """
+    requests = []
+    while True:
+        end = buffer.find(b'\r\n\r\n')
+        if end < 0:
+            return requests, (buffer if len(buffer) <= MAX_HEADER else None)
+        head = buffer[:end].lower()
+        length = 0
+        for line in head.split(b'\r\n')[1:]:
+            if line.startswith(b'content-length:'):
+                try:
+                    length = int(line[15:])
+                except ValueError:
+                    return requests, None
+        if len(buffer) < end + 4 + length:
+            return requests, buffer
+        if b'connection: close' in head:
+            keep_alive = False
+        else:
+            # HTTP/1.1 keeps the connection by default, 1.0 only if asked
+            keep_alive = not head.split(b'\r\n', 1)[0].endswith(b'http/1.0') \
+                or b'connection: keep-alive' in head
+        requests.append(keep_alive)
+        buffer = buffer[end + 4 + length:]
+        if not keep_alive:
+            return requests, b''
+
+def listening_socket(host, port, backlog=4096):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def serve_asyncio(sock, responses, on_term=None):
+    import asyncio
+
+    keep, close = responses
+    connections = set()
+    draining = False
+
+    class HTTPProtocol(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+            self.buffer = b''
+            transport.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connections.add(self)
+
+        def connection_lost(self, exc):
+            connections.discard(self)
+            if draining and not connections:
+                loop.stop()
+
+        def data_received(self, data):
+            requests, self.buffer = parse_requests(self.buffer + data)
+            if draining and requests:
+                # Answer what's here and tell the client we're closing
+                requests[-1] = False
+            if requests:
+                self.transport.write(b''.join(keep if k else close for k in requests))
+            if self.buffer is None or (requests and not requests[-1]):
+                self.transport.close()
+
+    def drain():
+        nonlocal draining
+        if on_term:
+            on_term()
+        draining = True
+        server.close()
+        for conn in list(connections):
+            if not conn.buffer:
+                conn.transport.close()
+        if not connections:
+            loop.stop()
+        loop.call_later(DRAIN_SECONDS, loop.stop)
+
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(loop.create_server(HTTPProtocol, sock=sock))
+    loop.add_signal_handler(signal.SIGTERM, drain)
+    loop.run_forever()
+
+def serve_threaded(sock, responses, on_term=None):
+    keep, close = responses
+    # Connection -> whether it's between requests (safe to close)
+    connections = {}
+    # Reentrant: the SIGTERM handler runs on the main thread, maybe while it holds the lock
+    lock = threading.RLock()
+    draining = threading.Event()
+
+    def connection(conn):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b''
+        with conn:
+            try:
+                while True:
+                    try:
+                        data = conn.recv(65536)
+                    except OSError:
+                        return
+                    if not data:
+                        return
+                    with lock:
+                        connections[conn] = False
+                    requests, buffer = parse_requests(buffer + data)
+                    if draining.is_set() and requests:
+                        requests[-1] = False
+                    if requests:
+                        conn.sendall(b''.join(keep if k else close for k in requests))
+                    if buffer is None or (requests and not requests[-1]):
+                        return
+                    with lock:
+                        connections[conn] = not buffer
+                    if draining.is_set() and not buffer:
+                        return
+            finally:
+                with lock:
+                    connections.pop(conn, None)
+
+    def drain(signum, frame):
+        if on_term:
+            on_term()
+        draining.set()
+        # Unblocks accept() below
+        sock.shutdown(socket.SHUT_RDWR)
+        with lock:
+            for conn, idle in connections.items():
+                if idle:
+                    conn.shutdown(socket.SHUT_RDWR)
+
+    signal.signal(signal.SIGTERM, drain)
+    while not draining.is_set():
+        try:
+            conn, _ = sock.accept()
+        except OSError:
+            break
+        with lock:
+            connections[conn] = True
+        threading.Thread(target=connection, args=(conn,), daemon=True).start()
+
+    deadline = time.monotonic() + DRAIN_SECONDS
+    while connections and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+SERVERS = {'asyncio': serve_asyncio, 'threaded': serve_threaded}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='vpcctl test app server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--mode', choices=sorted(SERVERS), default='asyncio')
+    parser.add_argument('--body', required=True, help='File with the response body')
+    args = parser.parse_args(argv)
+
+    with open(args.body, 'rb') as f:
+        responses = render_responses(f.read())
+
+    # Fork the workers first, then each binds its own SO_REUSEPORT socket
+    parent = os.getpid()
+    children = []
+    for _ in range(args.workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            children = None
+            # Drain too if the parent is killed without passing SIGTERM on
+            ctypes.CDLL(None, use_errno=True).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+            if os.getppid() != parent:
+                os._exit(0)
+            break
+        children.append(pid)
+
+    def forward():
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    SERVERS[args.mode](listening_socket(args.host, args.port), responses,
+                       forward if children else None)
+
+    # Drained; the workers are doing the same
+    for pid in children or []:
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""
+Backend Choice - Which kernel backend get_backend() hands out by default
+
+Kept apart from backends.py (which pulls in netlink, netns, the probes and
+the ip batch renderer) so the CLI can take --backend without loading any
+of that.
+"""
+
+import os
+
+BACKEND_CHOICES = ['auto', 'netlink', 'ip', 'sim']
+
+_default_backend = None
+
+def select_backend(name):
+    """Set the backend returned by get_backend() when no name is given (None resets)"""
+    global _default_backend
+    if name is not None and name not in BACKEND_CHOICES:
+        raise ValueError(f"Unknown backend: {name}")
+    _default_backend = name
+
+def backend_name():
+    """Name of the backend get_backend() returns when no name is given"""
+    return _default_backend or os.environ.get('VPCCTL_BACKEND', 'auto')
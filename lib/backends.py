@@ -0,0 +1,348 @@
+"""
+Backends - Pluggable kernel backends for link, address and route changes
+
+Managers ask for a batch (`get_backend().batch(namespace)`), queue typed
+operations on it and commit. Namespace-scoped work (sysctl, iptables-restore,
+pings, TCP connect probes, offloads) goes through the backend too. Which backend runs it doesn't matter to
+the caller:
+
+- `ip`      renders the operations into one `ip -batch -` process and wraps
+            namespace work in `ip netns exec`
+- `netlink` sends them straight to the kernel over rtnetlink and runs
+            namespace work from a thread that has setns()'d into the
+            namespace (see netns.py), no `ip` fork at all
+- `sim`     runs everything against an in-memory simulated kernel (see
+            sim_kernel.py): no root, no processes, state kept apart
+
+Host-side commands (`backend.run`) and the processes living in a namespace
+go through the backend as well, so a manager never touches the machine
+except through the backend it was given.
+
+The default (`auto`) uses netlink when the socket can be opened and falls
+back to the ip command otherwise. `VPCCTL_BACKEND` or `vpcctl --backend`
+picks one explicitly. `sim` is never picked automatically.
+"""
+
+import os
+import shutil
+import socket
+import time
+from utils import run_command, spawn_command
+from ip_batch import IPBatch, format_options
+from netns import get_namespace, add_namespace, delete_namespace
+from probes import icmp_ping, tcp_connect
+from procs import namespace_pids, start_time, terminate
+from tracing import command_span
+from backend_choice import BACKEND_CHOICES, select_backend, backend_name
+
+_backends = {}
+
+def offload_flags(offloads):
+    """{'gro': True, 'tso': False} -> 'gro on tso off', as ethtool -K takes them"""
+    return ' '.join(f"{name} {'on' if on else 'off'}" for name, on in offloads.items())
+
+class _HostBackend:
+    """What the ip and netlink backends share: host commands, namespace sockets, processes"""
+
+    def run(self, cmd, check=True, input=None):
+        return run_command(cmd, check=check, input=input)
+
+    def socket(self, namespace, family, kind, proto=0):
+        """A socket living in a namespace (None: the host's)"""
+        if namespace is None:
+            return socket.socket(family, kind, proto)
+        # Sockets stay in the namespace they're created in, so open it from
+        # the namespace's worker thread (there's no ip(8) way to hand one back)
+        return get_namespace(namespace).run(socket.socket, family, kind, proto)
+
+    def namespace_pids(self, namespaces):
+        return namespace_pids(namespaces)
+
+    def running(self, pids):
+        """{pid: start time} for the pids still running (see procs.start_time)"""
+        started = {pid: start_time(pid) for pid in pids}
+        return {pid: ticks for pid, ticks in started.items() if ticks is not None}
+
+    def terminate(self, pids, grace=5):
+        return terminate(pids, grace=grace)
+
+    def interface_stats(self):
+        from metrics import interface_stats
+        return interface_stats()
+
+class IPCommandBackend(_HostBackend):
+    """Runs everything through the ip(8) command"""
+    name = 'ip'
+
+    def batch(self, namespace=None):
+        return IPBatch(namespace)
+
+    def link_exists(self, name):
+        result = run_command(f"ip link show {name}", check=False)
+        return result.returncode == 0
+
+    def namespace_exists(self, name):
+        result = run_command(f"ip netns list", check=False)
+        return name in result.stdout
+
+    def delete_namespace(self, name, check=True):
+        run_command(f"ip netns delete {name}", check=check)
+
+    def sysctl(self, key, value, namespace=None):
+        if namespace:
+            run_command(f"ip netns exec {namespace} sysctl -w {key}={value}")
+        else:
+            run_command(f"sysctl -w {key}={value}")
+
+    def run_in_namespace(self, namespace, cmd, check=True, input=None):
+        return run_command(f"ip netns exec {namespace} {cmd}", check=check, input=input)
+
+    def ping(self, namespace, address, count=3, timeout=2):
+        result = self.run_in_namespace(
+            namespace, f"ping -c {count} -W {timeout} {address}", check=False
+        )
+        return result.returncode == 0, result.stdout if result.returncode == 0 else result.stderr
+
+    def tcp_probe(self, namespace, address, port, timeout=2):
+        # bash's /dev/tcp does the connect; a refusal still means reachable
+        started = time.perf_counter()
+        result = self.run_in_namespace(
+            namespace, f"timeout {timeout} bash -c 'exec 3<>/dev/tcp/{address}/{port}'", check=False
+        )
+        rtt = (time.perf_counter() - started) * 1000
+        if result.returncode == 0:
+            return True, rtt, 'open'
+        if 'refused' in result.stderr:
+            return True, rtt, 'refused'
+        if result.returncode == 124:
+            return False, None, 'timed out'
+        lines = result.stderr.strip().splitlines()
+        return False, None, lines[-1] if lines else f"exit {result.returncode}"
+
+    def spawn(self, namespace, cmd):
+        """Start cmd in the background inside the namespace; returns its pid"""
+        return spawn_command(f"ip netns exec {namespace} {cmd}")
+
+    def set_offloads(self, namespace, dev, offloads):
+        """Turn GRO/GSO/TSO on or off on a link (namespace None: the host's)"""
+        if not shutil.which('ethtool'):
+            raise Exception("ethtool is not installed (the netlink backend doesn't need it)")
+        cmd = f"ethtool -K {dev} {offload_flags(offloads)}"
+        if namespace is None:
+            self.run(cmd)
+        else:
+            self.run_in_namespace(namespace, cmd)
+
+
+class NetlinkBackend(_HostBackend):
+    """Talks rtnetlink directly over an AF_NETLINK socket"""
+    name = 'netlink'
+
+    def __init__(self):
+        from netlink import NetlinkSocket
+        self.nl = NetlinkSocket()
+
+    def batch(self, namespace=None):
+        if namespace:
+            # A netlink socket opened from inside the namespace
+            return NetlinkBatch(get_namespace(namespace).netlink(), namespace)
+        return NetlinkBatch(self.nl)
+
+    def link_exists(self, name):
+        with command_span(f"ip link show {name}", backend=self.name):
+            return self.nl.link_index(name) is not None
+
+    def namespace_exists(self, name):
+        # `ip netns add` pins namespaces under /run/netns, so a stat is enough
+        return os.path.exists(os.path.join('/run/netns', name))
+
+    def delete_namespace(self, name, check=True):
+        with command_span(f"ip netns delete {name}", backend=self.name) as span:
+            try:
+                delete_namespace(name)
+            except OSError as e:
+                span['exit_code'] = e.errno
+                if check:
+                    raise Exception(f"Failed to delete namespace {name}: {e}")
+
+    def sysctl(self, key, value, namespace=None):
+        with command_span(f"sysctl -w {key}={value}", namespace, self.name):
+            if namespace:
+                get_namespace(namespace).sysctl(key, value)
+                return
+            with open(os.path.join('/proc/sys', key.replace('.', '/')), 'w') as f:
+                f.write(f"{value}\n")
+
+    def run_in_namespace(self, namespace, cmd, check=True, input=None):
+        # Forked from the namespace's worker thread, so the child starts
+        # inside the namespace without going through `ip netns exec`
+        return get_namespace(namespace).run(run_command, cmd, check=check, input=input,
+                                            namespace=namespace)
+
+    def ping(self, namespace, address, count=3, timeout=2):
+        with command_span(f"ping -c {count} {address}", namespace, self.name) as span:
+            # Only the socket is made on the namespace's (single) worker; the
+            # waiting happens on this thread, so probes from one namespace
+            # don't queue up behind each other
+            sock = self.socket(namespace, socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            ok, output = icmp_ping(address, count, timeout, sock=sock)
+            span['exit_code'] = 0 if ok else 1
+            return ok, output
+
+    def tcp_probe(self, namespace, address, port, timeout=2):
+        with command_span(f"tcp-connect {address}:{port}", namespace, self.name) as span:
+            sock = self.socket(namespace, socket.AF_INET, socket.SOCK_STREAM)
+            ok, rtt, detail = tcp_connect(address, port, timeout, sock=sock)
+            span['exit_code'] = 0 if ok else 1
+            return ok, rtt, detail
+
+    def spawn(self, namespace, cmd):
+        return get_namespace(namespace).run(spawn_command, cmd, namespace=namespace)
+
+    def set_offloads(self, namespace, dev, offloads):
+        from ethtool import set_offloads
+        with command_span(f"ethtool -K {dev} {offload_flags(offloads)}", namespace, self.name) as span:
+            if namespace is None:
+                set_offloads(dev, offloads)
+            else:
+                get_namespace(namespace).run(set_offloads, dev, offloads)
+            span['exit_code'] = 0
+
+
+class NetlinkBatch(IPBatch):
+    """Same interface as IPBatch, but each operation is a netlink request"""
+    backend = 'netlink'
+
+    def __init__(self, nl, namespace=None):
+        super().__init__(namespace)
+        self.nl = nl
+
+    def _queue(self, command, owner, check, func, *args, **kwargs):
+        # Keep the equivalent ip command around for error messages
+        self.commands.append({
+            'command': command, 'owner': owner, 'check': check,
+            'func': func, 'args': args, 'kwargs': kwargs
+        })
+
+    def add(self, command, owner, check=True):
+        # Untyped lines have no netlink equivalent, run them through ip
+        self._queue(command, owner, check, self._run_ip, command)
+
+    def add_netns(self, name, owner):
+        self._queue(f"netns add {name}", owner, True, self._add_netns, name)
+
+    def delete_netns(self, name, owner, check=True):
+        self._queue(f"netns delete {name}", owner, check, delete_namespace, name)
+
+    def add_bridge(self, name, owner):
+        self._queue(f"link add {name} type bridge", owner, True,
+                    self.nl.link_add, name, 'bridge')
+
+    def add_veth(self, name, peer, owner, peer_netns=None, options=None):
+        opts = format_options(options)
+        netns = f" netns {peer_netns}" if peer_netns else ""
+        self._queue(f"link add {name}{opts} type veth peer name {peer}{opts}{netns}", owner, True,
+                    self._add_veth, name, peer, peer_netns, options)
+
+    def set_link(self, name, owner, up=True, master=None):
+        master_opt = f" master {master}" if master else ""
+        self._queue(f"link set {name}{master_opt} {'up' if up else 'down'}", owner, True,
+                    self.nl.link_set, name, up=up, master=master)
+
+    def set_bridge(self, name, owner, **options):
+        self._queue(f"link set {name} type bridge{format_options(options)}", owner, True,
+                    self.nl.bridge_set, name, **options)
+
+    def delete_link(self, name, owner, check=True):
+        self._queue(f"link delete {name}", owner, check, self.nl.link_delete, name)
+
+    def add_address(self, dev, address, owner):
+        self._queue(f"addr add {address} dev {dev}", owner, True,
+                    self.nl.addr_add, dev, address)
+
+    def add_route(self, dst, owner, via=None, dev=None, onlink=False, check=True):
+        self._queue(f"route add {self._route_spec(dst, via, dev, onlink)}", owner, check,
+                    self.nl.route_add, dst, via=via, dev=dev, onlink=onlink)
+
+    def delete_route(self, dst, owner, via=None, dev=None, check=True):
+        self._queue(f"route del {self._route_spec(dst, via, dev, False)}", owner, check,
+                    self.nl.route_delete, dst, via=via, dev=dev)
+
+    def _add_netns(self, name):
+        # The first namespace on a host needs ip to set up /run/netns itself
+        if not add_namespace(name):
+            self._run_ip(f"netns add {name}")
+
+    def _add_veth(self, name, peer, peer_netns, options):
+        from netlink import link_attrs
+        attrs = link_attrs(options)
+        if not peer_netns:
+            self.nl.link_add(name, 'veth', peer=peer, attrs=attrs, peer_attrs=attrs)
+            return
+        # Namespace moves are done by handing the kernel an fd for the namespace
+        fd = get_namespace(peer_netns).fd
+        self.nl.link_add(name, 'veth', peer=peer, peer_netns_fd=fd, attrs=attrs, peer_attrs=attrs)
+
+    def _run_ip(self, command):
+        if self.namespace:
+            run_command(f"ip -n {self.namespace} {command}")
+        else:
+            run_command(f"ip {command}")
+
+    def commit(self):
+        """Run every queued operation in order and return the non-fatal failures"""
+        self.commands, queued = [], self.commands
+
+        failures = []
+        for line, c in enumerate(queued, 1):
+            try:
+                with command_span(f"ip {c['command']}", self.namespace, self.backend) as span:
+                    try:
+                        c['func'](*c['args'], **c['kwargs'])
+                    except OSError as e:
+                        span['exit_code'] = e.errno
+                        raise
+            except Exception as e:
+                failure = dict(c)
+                failure['line'] = line
+                failure['error'] = str(e)
+                failures.append(failure)
+
+        errors = [f for f in failures if f['check']]
+        if errors:
+            raise Exception(self._format_errors(errors))
+        return failures
+
+def get_backend(name=None):
+    """Return the requested backend, falling back to ip if netlink is unavailable"""
+    name = name or backend_name()
+
+    if name == 'sim':
+        # One simulated kernel per state directory, like the state store
+        from sim_kernel import SimBackend, sim_state_dir
+        key = (name, sim_state_dir())
+        if key not in _backends:
+            _backends[key] = SimBackend(key[1])
+        return _backends[key]
+
+    if name not in _backends:
+        if name == 'ip':
+            _backends[name] = IPCommandBackend()
+        elif name == 'netlink':
+            _backends[name] = NetlinkBackend()
+        elif name == 'auto':
+            try:
+                _backends[name] = NetlinkBackend()
+            except (OSError, AttributeError):
+                # No AF_NETLINK (non-Linux, restricted sandbox) - use ip
+                _backends[name] = get_backend('ip')
+        else:
+            raise ValueError(f"Unknown backend: {name}")
+
+    return _backends[name]
+
+def flush_backends():
+    """Write out whatever a backend keeps between runs (the simulated kernel)"""
+    for backend in _backends.values():
+        if hasattr(backend, 'save'):
+            backend.save()
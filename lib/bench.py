@@ -0,0 +1,303 @@
+"""
+Bench - `vpcctl bench`: time provisioning at scale and catch regressions
+
+Builds a generated topology of N VPCs x M subnets, K peerings and a policy
+of R rules on every subnet, in a scratch state directory, and measures
+each phase:
+
+    create -> peer -> apply-policy -> list -> cleanup-all
+
+For every phase it records wall time, processes spawned and bytes written
+to the state database and its WAL; peak RSS is recorded once for the whole
+run, since ru_maxrss only ever grows. Bytes written come from
+/proc/self/io, less what was piped into commands; the managers' logging is
+silenced and the simulated kernel file is saved after the count is taken.
+Results can be written as JSON and compared against a stored baseline; a
+metric that grew by more than the threshold (and by more than a small
+noise floor) is a regression and makes the command exit 1.
+
+It runs against the simulated kernel (sim_kernel.py) unless another
+backend is picked with --backend, so it needs neither root nor a real
+kernel. The simulated kernel never starts a process, though, so its
+process counts are always 0. --stub-commands runs the ip backend instead,
+with stand-ins for ip, iptables, nft and friends first on PATH that accept
+everything and change nothing: real process counts, still no root.
+
+On a real backend it creates real bridges and namespaces (named
+bn<i>), so don't run it there next to VPCs with those names; the last
+phase then deletes just those VPCs instead of running cleanup-all, whose
+orphan sweep would take every ns-*/br-* on the host with it.
+"""
+
+import contextlib
+import io
+import ipaddress
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+from itertools import combinations
+from utils import get_subprocess_count, get_input_bytes
+from backends import IPCommandBackend, get_backend, backend_name
+
+PHASES = ('create', 'peer', 'apply-policy', 'list', 'cleanup-all')
+
+# What --stub-commands puts first on PATH
+STUB_COMMANDS = ('ip', 'iptables', 'iptables-restore', 'iptables-save', 'nft', 'sysctl', 'ethtool')
+
+# Accepts everything and changes nothing. No link exists, and whatever is
+# piped in (ip -batch, iptables-restore, nft -f) is read in full, like the
+# real commands do.
+STUB_SCRIPT = """#!/bin/sh
+case "$(basename "$0") $*" in
+    "ip link show "*|"ip -n "*" link show "*) exit 1 ;;
+    *"-batch -"*|*"iptables-restore"*|*"nft -f -"*) cat > /dev/null ;;
+esac
+exit 0
+"""
+
+# Growth below these is noise, whatever the percentage
+NOISE_FLOOR = {'seconds': 0.05, 'subprocesses': 2, 'bytes_written': 64 * 1024}
+RSS_NOISE_FLOOR = 4096
+
+def _bytes_written():
+    """Bytes this process has written so far, or None without /proc/self/io"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux, and the high-water mark of the
+    # whole process, so it says nothing about one phase on its own
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_policy(rules):
+    """A policy of R ingress rules that the optimizer can't fold away entirely"""
+    ingress = []
+    for i in range(rules):
+        ingress.append({
+            'port': 1000 + i * 2,
+            'protocol': 'tcp' if i % 3 else 'udp',
+            'action': 'deny' if i % 4 == 3 else 'allow',
+            'source': str(ipaddress.ip_network(f"172.{16 + i // 256 % 16}.{i % 256}.0/24"))
+        })
+    return {'subnet': '0.0.0.0/0', 'description': f"vpcctl bench policy ({rules} rules)",
+            'ingress': ingress, 'egress': [{'port': '*', 'protocol': 'tcp', 'action': 'deny',
+                                            'destination': '192.0.2.0/24'}]}
+
+class Benchmark:
+    def __init__(self, logger, vpcs=4, subnets=4, peerings=3, rules=20, jobs=8, stubs=False):
+        if not 1 <= vpcs <= 250 or not 1 <= subnets <= 250:
+            raise ValueError("--vpcs and --subnets must be between 1 and 250")
+        if stubs and backend_name() not in ('auto', 'ip'):
+            raise ValueError("--stub-commands always runs the ip backend")
+        if peerings > vpcs * (vpcs - 1) // 2:
+            raise ValueError(f"{vpcs} VPCs allow at most {vpcs * (vpcs - 1) // 2} peerings")
+        self.logger = logger
+        self.params = {'vpcs': vpcs, 'subnets': subnets, 'peerings': peerings,
+                       'rules': rules, 'jobs': jobs}
+        self.stubs = stubs
+        # The managers are quiet while they're being timed
+        self.quiet = logging.getLogger('vpcctl.bench')
+        self.quiet.addHandler(logging.NullHandler())
+        self.quiet.propagate = False
+
+    def run(self):
+        """Build, measure and tear down the topology; returns the results dict"""
+        scratch = tempfile.mkdtemp(prefix='vpcctl-bench-')
+        saved = os.environ.get('VPCCTL_STATE_DIR')
+        saved_path = os.environ.get('PATH', '')
+        os.environ['VPCCTL_STATE_DIR'] = scratch
+        try:
+            if self.stubs:
+                os.environ['PATH'] = f"{self._install_stubs(scratch)}:{saved_path}"
+            return self._run(scratch)
+        finally:
+            if saved is None:
+                del os.environ['VPCCTL_STATE_DIR']
+            else:
+                os.environ['VPCCTL_STATE_DIR'] = saved
+            os.environ['PATH'] = saved_path
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def _install_stubs(self, scratch):
+        """Write the stand-in commands to a directory; returns it"""
+        bin_dir = os.path.join(scratch, 'bin')
+        os.makedirs(bin_dir)
+        script = os.path.join(bin_dir, 'stub')
+        with open(script, 'w') as f:
+            f.write(STUB_SCRIPT)
+        os.chmod(script, 0o755)
+        for command in STUB_COMMANDS:
+            os.symlink('stub', os.path.join(bin_dir, command))
+        return bin_dir
+
+    def _run(self, scratch):
+        if self.stubs:
+            backend = IPCommandBackend()
+        elif backend_name() == 'sim':
+            # Its own kernel in the scratch directory, never cached or saved
+            # by anyone else
+            from sim_kernel import SimBackend
+            backend = SimBackend(scratch)
+        else:
+            backend = get_backend()
+
+        from vpc_manager import VPCManager
+        from subnet_manager import SubnetManager
+        from peering_manager import PeeringManager
+        from firewall_manager import FirewallManager
+        from firewall_engine import get_engine
+        vpc_mgr = VPCManager(self.quiet, backend)
+        subnet_mgr = SubnetManager(self.quiet, backend)
+        peering_mgr = PeeringManager(self.quiet, backend)
+        firewall_mgr = FirewallManager(self.quiet, backend)
+
+        p = self.params
+        names = [f"bn{i}" for i in range(p['vpcs'])]
+        policy_file = os.path.join(scratch, 'policy.json')
+        with open(policy_file, 'w') as f:
+            json.dump(bench_policy(p['rules']), f)
+
+        def create():
+            for i, vpc in enumerate(names):
+                vpc_mgr.create_vpc(vpc, f"10.{i}.0.0/16")
+                for j in range(p['subnets']):
+                    subnet_mgr.create_subnet(vpc, f"s{j}", f"10.{i}.{j + 1}.0/24",
+                                             'public' if j == 0 else 'private')
+
+        def peer():
+            for vpc1, vpc2 in list(combinations(names, 2))[:p['peerings']]:
+                peering_mgr.peer_vpcs(vpc1, vpc2)
+
+        def apply_policy():
+            for vpc in names:
+                for j in range(p['subnets']):
+                    firewall_mgr.apply_policy(vpc, f"s{j}", policy_file, show_rules=False)
+
+        def list_all():
+            # Into memory, so the listing doesn't count as bytes written
+            with contextlib.redirect_stdout(io.StringIO()):
+                vpc_mgr.list_vpcs()
+                for vpc in names:
+                    subnet_mgr.list_subnets(vpc)
+                peering_mgr.list_peerings()
+
+        def cleanup():
+            if backend.name == 'sim':
+                vpc_mgr.cleanup_all(jobs=p['jobs'])
+                return
+            for vpc in names:
+                vpc_mgr.delete_vpc(vpc)
+
+        steps = dict(zip(PHASES, (create, peer, apply_policy, list_all, cleanup)))
+        phases = {}
+        for phase in PHASES:
+            self.logger.info(f"Bench: {phase}")
+            phases[phase] = self._measure(steps[phase], backend)
+
+        return {
+            'params': p,
+            'backend': 'ip-stub' if self.stubs else backend.name,
+            'firewall': get_engine(),
+            'python': platform.python_version(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'phases': phases,
+            'peak_rss_kb': _peak_rss_kb(),
+        }
+
+    def _measure(self, step, backend):
+        forks = get_subprocess_count()
+        written = _bytes_written()
+        piped = get_input_bytes()
+        started = time.perf_counter()
+        step()
+        # Only the state database and its WAL: what went down the commands'
+        # stdin doesn't count, and neither does the simulated kernel file
+        after = _bytes_written()
+        if hasattr(backend, 'save'):
+            # The simulated kernel is written once per command, so once per phase here
+            backend.save()
+        seconds = time.perf_counter() - started
+        return {
+            'seconds': round(seconds, 4),
+            'subprocesses': get_subprocess_count() - forks,
+            'bytes_written': None if written is None else after - written - (get_input_bytes() - piped),
+        }
+
+def compare(results, baseline, threshold=0.2):
+    """[(phase, metric, baseline, now, regressed)] for every metric both runs have
+
+    Peak RSS is compared once, for the whole run, as phase 'run'.
+    """
+    def row(phase, metric, base, now, floor):
+        regressed = now > base * (1 + threshold) and now - base > floor
+        return (phase, metric, base, now, regressed)
+
+    rows = []
+    for phase in PHASES:
+        now, base = results['phases'].get(phase, {}), baseline.get('phases', {}).get(phase, {})
+        for metric, floor in NOISE_FLOOR.items():
+            if now.get(metric) is None or base.get(metric) is None:
+                continue
+            rows.append(row(phase, metric, base[metric], now[metric], floor))
+    if results.get('peak_rss_kb') and baseline.get('peak_rss_kb'):
+        rows.append(row('run', 'peak_rss_kb', baseline['peak_rss_kb'], results['peak_rss_kb'],
+                        RSS_NOISE_FLOOR))
+    return rows
+
+def print_results(results):
+    p = results['params']
+    print(f"\nvpcctl bench: {p['vpcs']} VPCs x {p['subnets']} subnets, {p['peerings']} peerings, "
+          f"{p['rules']} rules ({results['backend']} backend, {results['firewall']})")
+    print("=" * 80)
+    print(f"{'PHASE':<14} {'SECONDS':>10} {'PROCS':>8} {'WRITTEN':>14}")
+    for phase, m in results['phases'].items():
+        written = '-' if m['bytes_written'] is None else f"{m['bytes_written'] / 1024:.1f} KiB"
+        print(f"{phase:<14} {m['seconds']:>10.3f} {m['subprocesses']:>8} {written:>14}")
+    print("=" * 80)
+    print(f"Peak RSS for the run: {results['peak_rss_kb'] / 1024:.1f} MiB")
+
+def print_comparison(rows, threshold):
+    print(f"\nAgainst baseline (regression: > {threshold:.0%} worse)")
+    print(f"{'PHASE':<14} {'METRIC':<14} {'BASELINE':>14} {'NOW':>14} {'CHANGE':>9}")
+    for phase, metric, base, now, regressed in rows:
+        change = f"{(now - base) / base:+.0%}" if base else ('n/a' if now == base else '+inf')
+        flag = '  REGRESSION' if regressed else ''
+        print(f"{phase:<14} {metric:<14} {base:>14} {now:>14} {change:>9}{flag}")
+
+def run_bench(logger, vpcs, subnets, peerings, rules, jobs=8, output=None, baseline=None,
+              threshold=0.2, stubs=False):
+    """`vpcctl bench`: returns False if the run regressed against the baseline"""
+    results = Benchmark(logger, vpcs, subnets, peerings, rules, jobs, stubs).run()
+    print_results(results)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {output}")
+
+    if not baseline:
+        return True
+    with open(baseline) as f:
+        stored = json.load(f)
+    if stored.get('params') != results['params'] or stored.get('backend') != results['backend']:
+        logger.warning("Baseline was taken with other parameters or another backend; "
+                       "the comparison may not mean much")
+    rows = compare(results, stored, threshold)
+    print_comparison(rows, threshold)
+    regressions = [r for r in rows if r[4]]
+    if regressions:
+        logger.error(f"{len(regressions)} metric(s) regressed against {baseline}")
+        return False
+    logger.info(f"No regressions against {baseline}")
+    return True
@@ -0,0 +1,531 @@
+"""
+CLI - Argument parsing and command dispatch for vpcctl
+
+Shared by the two ways a command can run: in-process (`main()`, what
+vpcctl falls back to) and inside vpcctld, which builds the parser once and
+calls `execute()` for every request it gets.
+"""
+
+import argparse
+import importlib
+import os
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from backend_choice import BACKEND_CHOICES, select_backend
+from firewall_engine import FIREWALL_CHOICES, select_engine
+from logger import operation, quiet
+
+# Commands that only read state: no backend selection, and nothing written
+# to the log file unless something goes wrong
+READ_ONLY_COMMANDS = ('list-vpcs', 'list-subnets', 'list-peerings', 'optimize-policy')
+
+# (phase, seconds) for --profile-startup
+_profile = []
+
+@contextmanager
+def _phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profile.append((name, time.perf_counter() - started))
+
+class _LazyManager:
+    """Imports and builds a manager the first time the command uses it"""
+
+    def __init__(self, module, cls, logger, **kwargs):
+        self._spec = (module, cls, logger, kwargs)
+        self._manager = None
+
+    def __getattr__(self, name):
+        if self._manager is None:
+            module, cls, logger, kwargs = self._spec
+            with _phase(f"import {module}"):
+                manager_class = getattr(importlib.import_module(module), cls)
+            with _phase(f"init {cls}"):
+                self._manager = manager_class(logger, **kwargs)
+        return getattr(self._manager, name)
+
+def build_parser():
+    """The vpcctl argument parser (also used by vpcctld to parse requests)"""
+    parser = argparse.ArgumentParser(
+        prog='vpcctl',
+        description='VPC Control - Manage Virtual Private Clouds on Linux',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # Create a VPC
+  sudo vpcctl create-vpc --name my-vpc --cidr 10.0.0.0/16
+
+  # Add a public subnet
+  sudo vpcctl create-subnet --vpc my-vpc --name public --cidr 10.0.1.0/24 --type public
+
+  # Add a private subnet
+  sudo vpcctl create-subnet --vpc my-vpc --name private --cidr 10.0.2.0/24 --type private
+
+  # Let vpcctl pick the next free /24 in the VPC
+  sudo vpcctl create-subnet --vpc my-vpc --name app --prefix-len 24 --type private
+
+  # Jumbo frames, multi-queue veths and offloads for east-west traffic
+  sudo vpcctl create-subnet --vpc my-vpc --name data --cidr 10.0.3.0/24 --type private --profile high-throughput
+
+  # List all VPCs
+  sudo vpcctl list-vpcs
+
+  # Deploy a test application
+  sudo vpcctl deploy-app --vpc my-vpc --subnet public --port 8080
+
+  # Peer two VPCs
+  sudo vpcctl peer-vpcs --vpc1 vpc-a --vpc2 vpc-b
+
+  # Connect many VPCs through one transit hub instead
+  sudo vpcctl create-hub --name core
+  sudo vpcctl attach-vpc --hub core --vpc vpc-a
+  sudo vpcctl attach-vpc --hub core --vpc vpc-b
+
+  # Apply firewall policy
+  sudo vpcctl apply-policy --vpc my-vpc --subnet public --policy policies/web-policy.json
+
+  # Preview what the policy optimizer does to a policy
+  sudo vpcctl optimize-policy --policy policies/web-policy.json
+
+  # Put the rules that see the most traffic first
+  sudo vpcctl tune-policy --vpc my-vpc --subnet public --window 300
+
+  # Build or update a whole topology from a file
+  sudo vpcctl apply -f topology.json
+
+  # Delete a VPC
+  sudo vpcctl delete-vpc --name my-vpc
+        """
+    )
+
+    # Global options taking a value also go in client.VALUE_OPTIONS
+    parser.add_argument('--backend', choices=BACKEND_CHOICES, default=None,
+                        help='Kernel backend for link/addr/route changes (default: auto; '
+                             'sim: in-memory simulated kernel, no root needed)')
+    parser.add_argument('--firewall', choices=FIREWALL_CHOICES, default=None,
+                        help='Engine for firewall policies (default: iptables)')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Print how long imports and setup took (always runs in-process)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Only print warnings and errors (the log file still gets everything)')
+    parser.add_argument('--trace', metavar='FILE', default=None,
+                        help='Write a Chrome/Perfetto trace of every operation and kernel command')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print where the kernel command time went, by command verb')
+
+    subparsers = parser.add_subparsers(dest='command', help='Available commands')
+
+    # Create VPC
+    create_vpc = subparsers.add_parser('create-vpc', help='Create a new VPC')
+    create_vpc.add_argument('--name', required=True, help='VPC name')
+    create_vpc.add_argument('--cidr', required=True, help='CIDR block (e.g., 10.0.0.0/16)')
+    create_vpc.add_argument('--interface', default='eth0', help='Internet interface (default: eth0)')
+
+    # Delete VPC
+    delete_vpc = subparsers.add_parser('delete-vpc', help='Delete a VPC')
+    delete_vpc.add_argument('--name', required=True, help='VPC name')
+
+    # List VPCs
+    subparsers.add_parser('list-vpcs', help='List all VPCs')
+
+    # Create Subnet
+    create_subnet = subparsers.add_parser('create-subnet', help='Create a subnet in a VPC')
+    create_subnet.add_argument('--vpc', required=True, help='VPC name')
+    create_subnet.add_argument('--name', required=True, help='Subnet name')
+    subnet_cidr = create_subnet.add_mutually_exclusive_group(required=True)
+    subnet_cidr.add_argument('--cidr', help='Subnet CIDR (e.g., 10.0.1.0/24)')
+    subnet_cidr.add_argument('--prefix-len', type=int, help='Allocate the next free CIDR of this size from the VPC (e.g., 24)')
+    create_subnet.add_argument('--type', choices=['public', 'private'], required=True, help='Subnet type')
+    create_subnet.add_argument('--profile',
+                               help='Tuning profile: default, high-throughput or a JSON file '
+                                    '(MTU, queues, txqueuelen, offloads, bridge options)')
+
+    # Delete Subnet
+    delete_subnet = subparsers.add_parser('delete-subnet', help='Delete a subnet')
+    delete_subnet.add_argument('--vpc', required=True, help='VPC name')
+    delete_subnet.add_argument('--name', required=True, help='Subnet name')
+
+    # List Subnets
+    list_subnets = subparsers.add_parser('list-subnets', help='List subnets in a VPC')
+    list_subnets.add_argument('--vpc', required=True, help='VPC name')
+
+    # Deploy Application
+    deploy_app = subparsers.add_parser('deploy-app', help='Deploy a test application in a subnet')
+    deploy_app.add_argument('--vpc', required=True, help='VPC name')
+    deploy_app.add_argument('--subnet', required=True, help='Subnet name')
+    deploy_app.add_argument('--port', type=int, default=8080, help='Port to run on (default: 8080)')
+    deploy_app.add_argument('--type', choices=['nginx', 'python'], default='python', help='App type')
+    deploy_app.add_argument('--workers', type=int, default=1,
+                            help='Server processes sharing the port via SO_REUSEPORT (default: 1)')
+    deploy_app.add_argument('--mode', choices=['asyncio', 'threaded'], default='asyncio',
+                            help='Python server: event loop or thread per connection (default: asyncio)')
+
+    # Stop Application
+    stop_app = subparsers.add_parser('stop-app', help='Stop applications in a subnet or a whole VPC')
+    stop_app.add_argument('--vpc', required=True, help='VPC name')
+    stop_app.add_argument('--subnet', help='Subnet name (default: every subnet of the VPC)')
+    stop_app.add_argument('--port', type=int, help='Only the app deployed on this port')
+    stop_app.add_argument('--grace', type=float, default=5,
+                          help='Seconds between SIGTERM and SIGKILL (default: 5)')
+
+    # List Applications
+    list_apps = subparsers.add_parser('list-apps', help='List deployed applications and their status')
+    list_apps.add_argument('--vpc', help='Only this VPC')
+
+    # Peer VPCs
+    peer_vpcs = subparsers.add_parser('peer-vpcs', help='Create peering between two VPCs')
+    peer_vpcs.add_argument('--vpc1', required=True, help='First VPC name')
+    peer_vpcs.add_argument('--vpc2', required=True, help='Second VPC name')
+
+    # Unpeer VPCs
+    unpeer_vpcs = subparsers.add_parser('unpeer-vpcs', help='Remove peering between two VPCs')
+    unpeer_vpcs.add_argument('--vpc1', required=True, help='First VPC name')
+    unpeer_vpcs.add_argument('--vpc2', required=True, help='Second VPC name')
+
+    # List peerings and transit hubs
+    subparsers.add_parser('list-peerings', help='List VPC peerings and transit hubs')
+
+    # Transit hubs
+    create_hub = subparsers.add_parser('create-hub', help='Create a transit hub')
+    create_hub.add_argument('--name', required=True, help='Hub name')
+
+    delete_hub = subparsers.add_parser('delete-hub', help='Delete a transit hub')
+    delete_hub.add_argument('--name', required=True, help='Hub name')
+
+    attach_vpc = subparsers.add_parser('attach-vpc', help='Attach a VPC to a transit hub')
+    attach_vpc.add_argument('--hub', required=True, help='Hub name')
+    attach_vpc.add_argument('--vpc', required=True, help='VPC name')
+    attach_vpc.add_argument('--route-table', default='default',
+                            help='VPCs only reach VPCs in the same route table (default: default)')
+
+    detach_vpc = subparsers.add_parser('detach-vpc', help='Detach a VPC from a transit hub')
+    detach_vpc.add_argument('--hub', required=True, help='Hub name')
+    detach_vpc.add_argument('--vpc', required=True, help='VPC name')
+
+    # Apply firewall policy
+    apply_policy = subparsers.add_parser('apply-policy', help='Apply firewall policy to a subnet')
+    apply_policy.add_argument('--vpc', required=True, help='VPC name')
+    apply_policy.add_argument('--subnet', required=True, help='Subnet name')
+    apply_policy.add_argument('--policy', required=True, help='Path to policy JSON file')
+    apply_policy.add_argument('--no-optimize', action='store_true',
+                              help='Compile the rules exactly as written')
+
+    # Optimize firewall policy
+    optimize_policy = subparsers.add_parser('optimize-policy',
+                                            help='Merge, dedupe and reorder policy rules without applying them')
+    optimize_policy.add_argument('--policy', required=True, help='Path to policy JSON file')
+    optimize_policy.add_argument('-o', '--output', help='Write the optimized policy here instead of stdout')
+
+    # Reorder policy rules by hit counts
+    tune_policy = subparsers.add_parser('tune-policy',
+                                        help='Sample rule hit counters and put the hottest rules first')
+    tune_policy.add_argument('--vpc', required=True, help='VPC name')
+    tune_policy.add_argument('--subnet', required=True, help='Subnet name')
+    tune_policy.add_argument('--window', type=int, default=60, help='Seconds to sample counters for (default: 60)')
+    tune_policy.add_argument('--dry-run', action='store_true', help='Only report, keep the current order')
+
+    # Prometheus exporter
+    exporter = subparsers.add_parser('exporter', help='Serve firewall counters and interface stats to Prometheus')
+    exporter.add_argument('--listen', default='127.0.0.1:9477', help='Address to listen on (default: 127.0.0.1:9477)')
+    exporter.add_argument('--jobs', type=int, default=8, help='Namespaces sampled in parallel (default: 8)')
+
+    # Test connectivity
+    test_conn = subparsers.add_parser('test-connectivity', help='Test connectivity between subnets')
+    test_conn.add_argument('--vpc', required=True, help='VPC name')
+    test_conn.add_argument('--from-subnet', required=True, help='Source subnet')
+    test_conn.add_argument('--to-subnet', required=True, help='Destination subnet')
+
+    # Reachability matrix
+    reach = subparsers.add_parser('reachability',
+                                  help='Probe every subnet pair at once and check it against the state')
+    scope = reach.add_mutually_exclusive_group(required=True)
+    scope.add_argument('--vpc', help='Probe between the subnets of this VPC')
+    scope.add_argument('--all-vpcs', action='store_true', help='Probe between the subnets of every VPC')
+    reach.add_argument('--probe', choices=['icmp', 'tcp'], default='icmp', help='Probe type (default: icmp)')
+    reach.add_argument('--port', type=int, help='Port for TCP probes')
+    reach.add_argument('--target', help='Also probe this address from every subnet (internet stand-in)')
+    reach.add_argument('--timeout', type=float, default=1, help='Seconds to wait per probe (default: 1)')
+    reach.add_argument('--count', type=int, default=1, help='Echo requests per ICMP probe (default: 1)')
+    reach.add_argument('--jobs', type=int, default=16, help='Probes in flight at once (default: 16)')
+
+    # Data plane benchmark
+    perf = subparsers.add_parser('perf', help='Measure throughput and latency between two subnets')
+    perf.add_argument('--from', dest='source', help='Sending subnet (vpc/subnet)')
+    perf.add_argument('--to', dest='destination',
+                      help='Receiving subnet (vpc/subnet), or host[:port] of a `perf --serve` sink')
+    perf.add_argument('--protocol', choices=['tcp', 'udp'], default='tcp', help='Protocol (default: tcp)')
+    perf.add_argument('--streams', type=int, default=4, help='Parallel sending streams (default: 4)')
+    perf.add_argument('--duration', type=float, default=10, help='Seconds to send for (default: 10)')
+    perf.add_argument('--size', type=int,
+                      help='Bytes per write (default: 131072) or per UDP datagram (default: 1472)')
+    perf.add_argument('--json', action='store_true', help='Print the results as JSON')
+    perf.add_argument('-o', '--output', help='Write the results to this JSON file')
+    perf.add_argument('--serve', action='store_true', help='Only run a sink, until interrupted')
+    perf.add_argument('--listen', default="0.0.0.0:5201",
+                      help='Sink address with --serve (default: 0.0.0.0:5201)')
+    perf.add_argument('--in', dest='subnet', help='Run the --serve sink in this subnet (vpc/subnet)')
+
+    # Apply topology
+    apply_topology = subparsers.add_parser('apply', help='Reconcile VPCs with a topology file')
+    apply_topology.add_argument('-f', '--file', required=True, help='Path to topology JSON file')
+    apply_topology.add_argument('--dry-run', action='store_true', help='Show the plan without applying it')
+    apply_topology.add_argument('--jobs', type=int, default=8, help='Parallel operations per phase (default: 8)')
+
+    # Cleanup all
+    cleanup = subparsers.add_parser('cleanup-all', help='Remove all VPCs and resources')
+    cleanup.add_argument('--jobs', type=int, default=8, help='VPCs torn down in parallel (default: 8)')
+
+    # Benchmark
+    bench = subparsers.add_parser('bench', help='Time create/peer/apply-policy/list/cleanup at scale')
+    bench.add_argument('--vpcs', type=int, default=4, help='Number of VPCs (default: 4)')
+    bench.add_argument('--subnets', type=int, default=4, help='Subnets per VPC (default: 4)')
+    bench.add_argument('--peerings', type=int, default=3, help='Number of peerings (default: 3)')
+    bench.add_argument('--rules', type=int, default=20, help='Rules in the policy applied to every subnet (default: 20)')
+    bench.add_argument('--jobs', type=int, default=8, help='VPCs torn down in parallel (default: 8)')
+    bench.add_argument('-o', '--output', help='Write the results to this JSON file')
+    bench.add_argument('--baseline', help='Compare against results saved earlier with --output')
+    bench.add_argument('--stub-commands', action='store_true',
+                       help='Run the ip backend against stand-in ip/iptables/nft commands that change '
+                            'nothing: real process counts without root')
+    bench.add_argument('--threshold', type=float, default=0.2,
+                       help='Growth that counts as a regression (default: 0.2 = 20%%)')
+
+    return parser
+
+def _simulated(args):
+    """Set up for the simulated kernel if that's the backend; True if it is
+
+    A bench run on stand-in commands gets the same treatment: it needs no
+    root and its logs don't belong with the host's.
+    """
+    stubbed = args.command == 'bench' and args.stub_commands
+    if args.command == 'bench' and not stubbed and not (args.backend or os.environ.get('VPCCTL_BACKEND')):
+        # Benchmarks run against the simulated kernel unless told otherwise
+        args.backend = 'sim'
+    if not stubbed and (args.backend or os.environ.get('VPCCTL_BACKEND')) != 'sim':
+        return False
+    # Simulated VPCs (and their logs) stay out of the host's real state
+    from sim_kernel import SIM_STATE_DIR
+    os.environ.setdefault('VPCCTL_STATE_DIR', SIM_STATE_DIR)
+    os.environ.setdefault('VPCCTL_LOG_DIR', SIM_STATE_DIR)
+    return True
+
+def execute(args, logger):
+    """Run a parsed command and return its exit code"""
+    read_only = args.command in READ_ONLY_COMMANDS
+    _simulated(args)
+    if args.backend and not read_only:
+        select_backend(args.backend)
+    if args.firewall and not read_only:
+        select_engine(args.firewall)
+    span = nullcontext()
+    if args.trace or args.timings:
+        import tracing
+        tracing.start()
+        span = tracing.span(f"vpcctl {args.command}", 'cli')
+
+    try:
+        with operation(logger, args.command, timed=not read_only, **_log_context(args)), \
+             quiet(logger) if args.quiet else nullcontext(), span:
+            return _dispatch(args, logger)
+    except Exception as e:
+        logger.error(f"Error: {str(e)}")
+        return 1
+    finally:
+        if not read_only:
+            # Loaded here so read-only commands never import the backends
+            from backends import flush_backends
+            from utils import get_subprocess_count
+            flush_backends()
+            logger.debug(f"Subprocesses spawned: {get_subprocess_count()}")
+        if args.trace or args.timings:
+            _finish_trace(args, logger)
+
+def _log_context(args):
+    """VPC and subnet a command works on, for the structured log fields"""
+    vpc, subnet = getattr(args, 'vpc', None), getattr(args, 'subnet', None)
+    if args.command in ('create-vpc', 'delete-vpc'):
+        vpc = args.name
+    elif args.command in ('create-subnet', 'delete-subnet'):
+        subnet = args.name
+    return {'vpc': vpc, 'subnet': subnet}
+
+def _finish_trace(args, logger):
+    """Write --trace and print --timings for the command that just ran"""
+    import tracing
+    tracer = tracing.stop()
+    if tracer is None:
+        return
+    if args.trace:
+        try:
+            tracer.write(args.trace)
+            logger.info(f"Trace written to {args.trace} (open it in https://ui.perfetto.dev)")
+        except OSError as e:
+            logger.error(f"Could not write trace to {args.trace}: {e}")
+    if args.timings:
+        print(f"\nKernel command timings:\n{tracer.format_timings()}", file=sys.stderr)
+
+def _dispatch(args, logger):
+    """Run the command itself; returns its exit code"""
+    # Managers (and their modules) are only loaded if the command needs them
+    vpc_mgr = _LazyManager('vpc_manager', 'VPCManager', logger)
+    subnet_mgr = _LazyManager('subnet_manager', 'SubnetManager', logger)
+    peering_mgr = _LazyManager('peering_manager', 'PeeringManager', logger)
+    firewall_mgr = _LazyManager('firewall_manager', 'FirewallManager', logger)
+    transit_mgr = _LazyManager('transit_manager', 'TransitManager', logger)
+    topology_mgr = _LazyManager('topology_manager', 'TopologyManager', logger,
+                                jobs=getattr(args, 'jobs', 8))
+
+    if args.command == 'create-vpc':
+        vpc_mgr.create_vpc(args.name, args.cidr, args.interface)
+        
+    elif args.command == 'delete-vpc':
+        vpc_mgr.delete_vpc(args.name)
+        
+    elif args.command == 'list-vpcs':
+        vpc_mgr.list_vpcs()
+        
+    elif args.command == 'create-subnet':
+        subnet_mgr.create_subnet(args.vpc, args.name, args.cidr, args.type, prefix_len=args.prefix_len,
+                                 profile=args.profile)
+        
+    elif args.command == 'delete-subnet':
+        subnet_mgr.delete_subnet(args.vpc, args.name)
+        
+    elif args.command == 'list-subnets':
+        subnet_mgr.list_subnets(args.vpc)
+        
+    elif args.command == 'deploy-app':
+        subnet_mgr.deploy_app(args.vpc, args.subnet, args.port, args.type,
+                              workers=args.workers, mode=args.mode)
+        
+    elif args.command == 'stop-app':
+        subnet_mgr.stop_app(args.vpc, args.subnet, port=args.port, grace=args.grace)
+        
+    elif args.command == 'list-apps':
+        subnet_mgr.list_apps(args.vpc)
+        
+    elif args.command == 'peer-vpcs':
+        peering_mgr.peer_vpcs(args.vpc1, args.vpc2)
+        
+    elif args.command == 'unpeer-vpcs':
+        peering_mgr.unpeer_vpcs(args.vpc1, args.vpc2)
+        
+    elif args.command == 'list-peerings':
+        peering_mgr.list_peerings()
+        transit_mgr.list_hubs()
+        
+    elif args.command == 'create-hub':
+        transit_mgr.create_hub(args.name)
+        
+    elif args.command == 'delete-hub':
+        transit_mgr.delete_hub(args.name)
+        
+    elif args.command == 'attach-vpc':
+        transit_mgr.attach_vpc(args.hub, args.vpc, args.route_table)
+        
+    elif args.command == 'detach-vpc':
+        transit_mgr.detach_vpc(args.hub, args.vpc)
+        
+    elif args.command == 'apply-policy':
+        firewall_mgr.apply_policy(args.vpc, args.subnet, args.policy,
+                                  optimize=not args.no_optimize)
+        
+    elif args.command == 'optimize-policy':
+        firewall_mgr.optimize(args.policy, args.output)
+        
+    elif args.command == 'tune-policy':
+        firewall_mgr.tune_policy(args.vpc, args.subnet, window=args.window, dry_run=args.dry_run)
+        
+    elif args.command == 'exporter':
+        import metrics
+        metrics.serve(logger, args.listen, jobs=args.jobs)
+        
+    elif args.command == 'test-connectivity':
+        subnet_mgr.test_connectivity(args.vpc, args.from_subnet, args.to_subnet)
+        
+    elif args.command == 'reachability':
+        from reachability import ReachabilityChecker
+        checker = ReachabilityChecker(logger, jobs=args.jobs)
+        if not checker.check(args.vpc, probe=args.probe, port=args.port, target=args.target,
+                             timeout=args.timeout, count=args.count):
+            return 1
+        
+    elif args.command == 'perf':
+        import perf
+        if args.serve:
+            perf.serve(logger, args.listen, args.subnet)
+        elif not (args.source and args.destination):
+            raise ValueError("perf needs --from and --to (or --serve)")
+        else:
+            perf.run_perf(logger, args.source, args.destination, args.protocol, args.streams,
+                          args.duration, args.size, output=args.output, as_json=args.json)
+        
+    elif args.command == 'apply':
+        topology_mgr.apply(args.file, dry_run=args.dry_run)
+        
+    elif args.command == 'cleanup-all':
+        vpc_mgr.cleanup_all(jobs=args.jobs)
+        
+    elif args.command == 'bench':
+        import bench
+        if not bench.run_bench(logger, args.vpcs, args.subnets, args.peerings, args.rules,
+                               jobs=args.jobs, output=args.output, baseline=args.baseline,
+                               threshold=args.threshold, stubs=args.stub_commands):
+            return 1
+
+    return 0
+
+def main(argv=None, started=None):
+    """Parse argv and run the command in this process
+
+    started is when the vpcctl script began (time.perf_counter()), so the
+    startup profile can include the imports that happened before main().
+    """
+    if started is not None:
+        _profile.append(("imports before main()", time.perf_counter() - started))
+
+    with _phase("build parser"):
+        parser = build_parser()
+        args = parser.parse_args(argv)
+
+    # Check if running as root (the simulated kernel doesn't need it)
+    if not _simulated(args) and os.geteuid() != 0:
+        print("Error: This script must be run as root (use sudo)")
+        return 1
+
+    # Setup logger
+    with _phase("setup logger"):
+        from logger import setup_logger
+        try:
+            logger = setup_logger()
+        except ValueError as e:
+            print(f"Error: {e}")
+            return 1
+
+    if not args.command:
+        parser.print_help()
+        return 1
+
+    if not args.profile_startup:
+        return execute(args, logger)
+
+    mark = len(_profile)
+    with _phase(f"run {args.command}"):
+        exit_code = execute(args, logger)
+    # Manager imports happened inside the command, don't count them twice
+    name, seconds = _profile.pop()
+    _profile.append((name, seconds - sum(s for _, s in _profile[mark:])))
+    _print_profile()
+    return exit_code
+
+def _print_profile():
+    """Startup breakdown for --profile-startup, on stderr"""
+    total = sum(seconds for _, seconds in _profile)
+    print("\nStartup profile:", file=sys.stderr)
+    for name, seconds in _profile:
+        print(f"  {name:<32} {seconds * 1000:8.1f} ms", file=sys.stderr)
+    print(f"  {'total':<32} {total * 1000:8.1f} ms", file=sys.stderr)
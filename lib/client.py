@@ -0,0 +1,75 @@
+"""
+Client - Hand a vpcctl command to a running vpcctld
+
+Deliberately imports nothing but the standard library: when the daemon is
+up, this is all vpcctl loads. The command line goes over the daemon's Unix
+socket as a JSON-RPC `run` request, and the output and exit code come back
+in the response. Returns None when there's no daemon to talk to, so the
+caller can run the command in-process instead.
+"""
+
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get('VPCCTL_SOCKET', '/run/vpcctl/vpcctld.sock')
+
+# Commands that never finish, hold sockets open for a benchmark, or sample
+# for seconds to minutes run in the client's own process: vpcctld runs one
+# command at a time, and every other client would wait behind them
+IN_PROCESS_COMMANDS = ('exporter', 'perf', 'tune-policy', 'reachability', 'test-connectivity', 'bench')
+
+# vpcctl's global options that take a value (see cli.build_parser)
+VALUE_OPTIONS = ('--backend', '--firewall', '--trace')
+
+def subcommand(argv):
+    """The subcommand of a vpcctl command line, past any global options (or None)"""
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith('-'):
+            return arg
+        # argparse also takes unambiguous abbreviations, like --back sim
+        if arg.startswith('--') and '=' not in arg and \
+           any(option.startswith(arg) for option in VALUE_OPTIONS):
+            next(args, None)
+    return None
+
+def request(method, params, socket_path=SOCKET_PATH):
+    """Send one JSON-RPC request and return the response (None if no daemon)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError, PermissionError):
+        # Not running (or stale socket, or not root): run it ourselves
+        sock.close()
+        return None
+
+    with sock, sock.makefile('rwb') as stream:
+        payload = {'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params}
+        stream.write(json.dumps(payload).encode() + b'\n')
+        stream.flush()
+        line = stream.readline()
+    if not line:
+        raise ConnectionError("vpcctld closed the connection without answering")
+    return json.loads(line)
+
+def run(argv, socket_path=SOCKET_PATH):
+    """Run a vpcctl command line through the daemon; returns its exit code or None"""
+    if os.environ.get('VPCCTL_DAEMON') == '0' or '--profile-startup' in argv \
+       or subcommand(argv) in IN_PROCESS_COMMANDS:
+        return None
+
+    env = {k: v for k, v in os.environ.items() if k.startswith('VPCCTL_')}
+    response = request('run', {'argv': argv, 'cwd': os.getcwd(), 'env': env}, socket_path)
+    if response is None:
+        return None
+
+    if 'error' in response:
+        print(f"ERROR: vpcctld: {response['error']['message']}", file=sys.stderr)
+        return 1
+
+    result = response['result']
+    sys.stdout.write(result['stdout'])
+    sys.stderr.write(result['stderr'])
+    return result['exit_code']
@@ -0,0 +1,40 @@
+"""
+Ethtool - Switch offloads (GRO, GSO, TSO) on and off without ethtool(8)
+
+Uses the SIOCETHTOOL ioctl's one-feature-at-a-time commands, which every
+driver veth included still honours. Like the probes, this works on
+whatever network namespace the calling thread is in, so run it through
+netns.get_namespace(ns).run(...) for a link inside a subnet.
+"""
+
+import ctypes
+import fcntl
+import socket
+import struct
+
+SIOCETHTOOL = 0x8946
+
+# (get, set) command per offload, from <linux/ethtool.h>
+OFFLOADS = {
+    'tso': (0x1e, 0x1f),
+    'gso': (0x23, 0x24),
+    'gro': (0x2b, 0x2c),
+}
+
+def _ethtool(sock, dev, cmd, value=0):
+    # struct ethtool_value, pointed to by ifr_data of a struct ifreq
+    data = ctypes.create_string_buffer(struct.pack('=II', cmd, value), 8)
+    ifreq = struct.pack('16sP', dev.encode(), ctypes.addressof(data)).ljust(40, b'\0')
+    fcntl.ioctl(sock.fileno(), SIOCETHTOOL, ifreq)
+    return struct.unpack('=II', data.raw)[1]
+
+def set_offloads(dev, offloads):
+    """Turn offloads on or off: {'gro': True, 'tso': False, ...}"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for name, on in offloads.items():
+            _ethtool(sock, dev, OFFLOADS[name][1], int(bool(on)))
+
+def get_offloads(dev):
+    """Current offload settings of a link"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        return {name: bool(_ethtool(sock, dev, get)) for name, (get, _) in OFFLOADS.items()}
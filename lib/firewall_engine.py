@@ -0,0 +1,22 @@
+"""
+Firewall Engine - Which engine compiles policies: iptables or nftables
+
+Kept apart from firewall_manager.py (which pulls in the compilers and the
+optimizer) so the CLI can take --firewall without loading any of that.
+"""
+
+import os
+
+FIREWALL_CHOICES = ['iptables', 'nftables']
+
+_default_engine = None
+
+def select_engine(name):
+    """Set the firewall engine used when applying policies (None resets)"""
+    global _default_engine
+    if name is not None and name not in FIREWALL_CHOICES:
+        raise ValueError(f"Unknown firewall engine: {name}")
+    _default_engine = name
+
+def get_engine():
+    return _default_engine or os.environ.get('VPCCTL_FIREWALL', 'iptables')
@@ -1,178 +1,344 @@
 """
 Firewall Manager - Handles security group rules and firewall policies
+
+Two engines compile the same JSON policies:
+
+- `iptables` (default): one rule per policy entry, loaded with iptables-restore
+- `nftables`: verdict maps and interval sets (see nftables.py), so the cost
+  per packet doesn't grow with the number of entries
+
+Pick one with `vpcctl --firewall` or VPCCTL_FIREWALL. The engine used is
+recorded per subnet, so clearing or re-applying cleans up after the right one.
 """
 
 import json
-from utils import run_command, load_vpc_state
+import time
+import hashlib
+from utils import get_subprocess_count, parse_ports, rule_comment
+from backends import get_backend
+from state_store import get_store
+import nftables
+from policy_optimizer import optimize_policy, reorder_policy, policy_order, apply_order
+from firewall_engine import get_engine
+from tracing import traced
+
+# How many ports fit in one `-m multiport` match
+MULTIPORT_SLOTS = 15
+
+def load_policy(policy_file):
+    """Load a policy JSON file"""
+    try:
+        with open(policy_file, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        raise ValueError(f"Failed to load policy file: {e}")
+
+def policy_digest(policy):
+    """Stable hash of a policy's contents (key order doesn't matter)"""
+    canonical = json.dumps(policy, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
 
 class FirewallManager:
-    def __init__(self, logger):
+    def __init__(self, logger, backend=None):
         self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
 
-    def apply_policy(self, vpc_name, subnet_name, policy_file):
+    @traced
+    def apply_policy(self, vpc_name, subnet_name, policy_file, show_rules=True, optimize=True):
         """Apply firewall policy from JSON file to a subnet"""
         self.logger.info(f"Applying firewall policy to {vpc_name}/{subnet_name}")
         
         # Load policy
-        try:
-            with open(policy_file, 'r') as f:
-                policy = json.load(f)
-        except Exception as e:
-            raise ValueError(f"Failed to load policy file: {e}")
+        policy = load_policy(policy_file)
         
         # Validate policy
         if 'subnet' not in policy:
             raise ValueError("Policy must specify 'subnet' field")
         
-        # Load VPC state
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
         subnet = vpc['subnets'][subnet_name]
         ns_name = subnet['namespace']
+        engine = get_engine()
+        
+        # Switching engines: don't leave the old engine's rules filtering too
+        previous = subnet.get('policy', {}).get('engine', 'iptables')
+        if subnet.get('policy') and previous != engine:
+            self.logger.info(f"Removing {previous} rules in {ns_name}")
+            self._flush(ns_name, previous)
+        
+        # The digest is of the file as written, so re-optimizing doesn't
+        # look like a change to `vpcctl apply`
+        digest = policy_digest(policy)
+        if optimize:
+            policy, stats = optimize_policy(policy)
+            for direction, (before, after) in stats.items():
+                self.logger.info(f"  Optimized {direction}: {before} -> {after} rules")
+        
+        # Same policy as before: keep the order tune-policy picked for it
+        stored = subnet.get('policy') or {}
+        order = None
+        if stored.get('order') and stored.get('sha256') == digest \
+           and stored.get('optimized', True) == optimize:
+            self.logger.info("  Keeping the rule order from tune-policy")
+            order = stored['order']
+            policy = apply_order(policy, order)
+        
+        self._commit(ns_name, engine, policy)
+        
+        # Remember what's attached so `vpcctl apply` can tell when it changed
+        record = {
+            'file': policy_file,
+            'sha256': digest,
+            'engine': engine,
+            'optimized': optimize
+        }
+        if order:
+            record['order'] = order
+        self.store.update_subnet(vpc_name, subnet_name, policy=record)
         
-        # Clear existing rules
-        self.logger.info(f"Clearing existing firewall rules in {ns_name}")
-        run_command(f"ip netns exec {ns_name} iptables -F INPUT")
-        run_command(f"ip netns exec {ns_name} iptables -F OUTPUT")
-        run_command(f"ip netns exec {ns_name} iptables -F FORWARD")
-        
-        # Set default policies to DROP
-        self.logger.info("Setting default policy to DROP")
-        run_command(f"ip netns exec {ns_name} iptables -P INPUT DROP")
-        run_command(f"ip netns exec {ns_name} iptables -P FORWARD DROP")
-        
-        # Allow established connections
-        run_command(
-            f"ip netns exec {ns_name} iptables -A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT"
-        )
-        run_command(
-            f"ip netns exec {ns_name} iptables -A OUTPUT -m state --state ESTABLISHED,RELATED -j ACCEPT"
-        )
-        
-        # Allow loopback
-        run_command(f"ip netns exec {ns_name} iptables -A INPUT -i lo -j ACCEPT")
-        run_command(f"ip netns exec {ns_name} iptables -A OUTPUT -o lo -j ACCEPT")
-        
-        # Apply ingress rules
-        if 'ingress' in policy:
-            self.logger.info("Applying ingress rules")
-            for rule in policy['ingress']:
-                self._apply_ingress_rule(ns_name, rule)
-        
-        # Apply egress rules
-        if 'egress' in policy:
-            self.logger.info("Applying egress rules")
-            for rule in policy['egress']:
-                self._apply_egress_rule(ns_name, rule)
+        self.logger.info(f"✓ Firewall policy applied successfully")
+        self.logger.info(f"  Ingress rules: {len(policy.get('ingress', []))}")
+        self.logger.info(f"  Egress rules: {len(policy.get('egress', []))}")
+        if show_rules:
+            self._show_rules(ns_name, engine)
+        self.logger.info(f"  Subprocesses spawned: {get_subprocess_count()}")
+
+    def _commit(self, ns_name, engine, policy):
+        """Compile a policy and load it into a namespace in one step"""
+        # Render the whole ruleset and commit it in one iptables-restore (or
+        # nft -f). Both are atomic, so there's no window where INPUT is DROP
+        # with only half the rules loaded.
+        if engine == 'nftables':
+            ruleset = nftables.compile_policy(policy, self._target)
+            command = "nft -f -"
         else:
-            # Default: allow all egress
-            run_command(f"ip netns exec {ns_name} iptables -P OUTPUT ACCEPT")
+            ruleset = self._compile_ruleset(policy)
+            command = "iptables-restore -w"
+        self.logger.debug(f"{command} payload for {ns_name}:\n{ruleset}")
         
-        self.logger.info(f"✓ Firewall policy applied successfully")
-        self._show_rules(ns_name)
+        self.logger.info(f"Committing {engine} ruleset in {ns_name}")
+        self.backend.run_in_namespace(ns_name, command, input=ruleset)
 
-    def _apply_ingress_rule(self, ns_name, rule):
-        """Apply a single ingress rule"""
-        # TODO: Add support for port ranges (e.g., 8000-9000)
-        port = rule.get('port', '*')
-        protocol = rule.get('protocol', 'tcp')
-        action = rule.get('action', 'allow').upper()
-        source = rule.get('source', '0.0.0.0/0')
+    @traced
+    def tune_policy(self, vpc_name, subnet_name, window=60, dry_run=False):
+        """Sample rule counters and re-apply the policy with the hottest rules first"""
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if action == 'ALLOW':
-            target = 'ACCEPT'
-        elif action == 'DENY':
-            target = 'DROP'
-        else:
-            self.logger.warning(f"Unknown action: {action}, defaulting to DROP")
-            target = 'DROP'
+        if vpc is None:
+            raise ValueError(f"VPC {vpc_name} does not exist")
         
-        if port == '*':
-            cmd = f"ip netns exec {ns_name} iptables -A INPUT -p {protocol} -s {source} -j {target}"
-        else:
-            cmd = f"ip netns exec {ns_name} iptables -A INPUT -p {protocol} -s {source} --dport {port} -j {target}"
+        if subnet_name not in vpc['subnets']:
+            raise ValueError(f"Subnet {subnet_name} does not exist")
+        
+        subnet = vpc['subnets'][subnet_name]
+        stored = subnet.get('policy')
+        if not stored:
+            raise ValueError(f"Subnet {subnet_name} has no firewall policy")
+        
+        if stored.get('engine', 'iptables') == 'nftables':
+            # Verdict maps find the rule by lookup, not by walking the list
+            self.logger.info("nftables rules are found through verdict maps; their order doesn't affect cost")
+            return
+        
+        policy = load_policy(stored['file'])
+        if policy_digest(policy) != stored['sha256']:
+            raise ValueError(f"{stored['file']} changed since it was applied, run apply-policy first")
+        
+        # Rebuild exactly what's loaded, so counters line up with rules
+        if stored.get('optimized', True):
+            policy, _ = optimize_policy(policy)
+        if stored.get('order'):
+            policy = apply_order(policy, stored['order'])
+        
+        from metrics import read_counters
+        self.logger.info(f"Sampling rule counters in {subnet['namespace']} for {window}s")
+        _, before = read_counters(self.backend, subnet)
+        time.sleep(window)
+        _, after = read_counters(self.backend, subnet)
+        
+        hits = {}
+        for (direction, rule), (_, packets, _) in after.items():
+            delta = packets - before.get((direction, rule), (None, 0, 0))[1]
+            hits.setdefault(direction, {})[rule] = max(delta, 0)
+        
+        tuned, costs = reorder_policy(policy, hits)
+        order = policy_order(tuned)
+        
+        print(f"\nRule order for {vpc_name}/{subnet_name} ({window}s sample)")
+        print("="*80)
+        for direction, (cost_before, cost_after) in costs.items():
+            matched = sum(hits.get(direction, {}).values())
+            saved = 100 * (cost_before - cost_after) / cost_before if cost_before else 0
+            print(f"{direction.capitalize()}: {matched} packets")
+            print(f"  Rule evaluations: {cost_before} -> {cost_after} ({saved:.1f}% fewer)")
+            if matched:
+                print(f"  Per packet: {cost_before / matched:.2f} -> {cost_after / matched:.2f}")
+            print(f"  Order: {' '.join(order[direction]) or '(no rules)'}")
+        print("="*80)
         
-        self.logger.info(f"Adding ingress rule: port={port}, proto={protocol}, action={action}")
-        run_command(cmd)
+        if dry_run:
+            self.logger.info("Dry run, nothing re-applied")
+            return
+        
+        if all(before == after for before, after in costs.values()):
+            self.logger.info("Current order is already the best one for this traffic")
+            return
+        
+        self._commit(subnet['namespace'], 'iptables', tuned)
+        self.store.update_subnet(vpc_name, subnet_name, policy=dict(stored, order=order))
+        self.logger.info(f"✓ Tuned rule order applied to {vpc_name}/{subnet_name}")
+
+    @traced
+    def optimize(self, policy_file, output_file=None):
+        """Optimize a policy file without applying it, and print or save the result"""
+        policy = load_policy(policy_file)
+        optimized, stats = optimize_policy(policy)
+        
+        for direction, (before, after) in stats.items():
+            self.logger.info(f"{direction.capitalize()}: {before} -> {after} rules")
+        
+        rendered = json.dumps(optimized, indent=2)
+        if output_file:
+            with open(output_file, 'w') as f:
+                f.write(rendered + '\n')
+            self.logger.info(f"✓ Optimized policy written to {output_file}")
+        else:
+            print(rendered)
+
+    def _compile_ruleset(self, policy):
+        """Compile a policy into an iptables-restore payload for the filter table"""
+        lines = [
+            '*filter',
+            ':INPUT DROP [0:0]',
+            ':FORWARD DROP [0:0]',
+            ':OUTPUT ACCEPT [0:0]',
+            # Allow established connections
+            '-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT',
+            '-A OUTPUT -m state --state ESTABLISHED,RELATED -j ACCEPT',
+            # Allow loopback
+            '-A INPUT -i lo -j ACCEPT',
+            '-A OUTPUT -o lo -j ACCEPT',
+        ]
+        
+        for i, rule in enumerate(policy.get('ingress', [])):
+            lines.extend(self._ingress_rule(rule, rule.get('origin', [i + 1])))
+        
+        for i, rule in enumerate(policy.get('egress', [])):
+            lines.extend(self._egress_rule(rule, rule.get('origin', [i + 1])))
+        
+        lines.append('COMMIT')
+        return '\n'.join(lines) + '\n'
+
+    def _ingress_rule(self, rule, origin):
+        """Render a single ingress rule as iptables-restore lines"""
+        return self._rule_lines('INPUT', '-s', rule.get('source', '0.0.0.0/0'), rule,
+                                rule_comment('ingress', origin))
+
+    def _egress_rule(self, rule, origin):
+        """Render a single egress rule as iptables-restore lines"""
+        return self._rule_lines('OUTPUT', '-d', rule.get('destination', '0.0.0.0/0'), rule,
+                                rule_comment('egress', origin))
 
-    def _apply_egress_rule(self, ns_name, rule):
-        """Apply a single egress rule"""
+    def _rule_lines(self, chain, address_flag, addresses, rule, comment):
         port = rule.get('port', '*')
         protocol = rule.get('protocol', 'tcp')
         action = rule.get('action', 'allow').upper()
-        destination = rule.get('destination', '0.0.0.0/0')
-        
+        target = self._target(action)
+        
+        self.logger.debug(f"{chain} rule: port={port}, proto={protocol}, action={action}")
+        # iptables expands a comma separated address list into one rule each
+        if isinstance(addresses, list):
+            addresses = ','.join(addresses)
+        match = f"-A {chain} -p {protocol} {address_flag} {addresses}"
+        
+        # The comment is how metrics.py maps counters back to policy rules
+        jump = f"-m comment --comment {comment} -j {target}"
+        
+        ports = parse_ports(port)
+        if ports is None:
+            return [f"{match} {jump}"]
+        if len(ports) == 1:
+            return [f"{match} --dport {self._dport(ports[0])} {jump}"]
+        return [
+            f"{match} -m multiport --dports {','.join(self._dport(p) for p in chunk)} {jump}"
+            for chunk in self._multiport_chunks(ports)
+        ]
+
+    def _dport(self, ports):
+        """(lo, hi) as an iptables port value"""
+        lo, hi = ports
+        return str(lo) if lo == hi else f"{lo}:{hi}"
+
+    def _multiport_chunks(self, ports):
+        """Split a port list into multiport-sized pieces (15 slots, a range takes 2)"""
+        chunk, used = [], 0
+        for lo, hi in ports:
+            size = 1 if lo == hi else 2
+            if used + size > MULTIPORT_SLOTS:
+                yield chunk
+                chunk, used = [], 0
+            chunk.append((lo, hi))
+            used += size
+        if chunk:
+            yield chunk
+
+    def _target(self, action):
+        """Map a policy action to an iptables target"""
         if action == 'ALLOW':
-            target = 'ACCEPT'
-        elif action == 'DENY':
-            target = 'DROP'
-        else:
-            self.logger.warning(f"Unknown action: {action}, defaulting to DROP")
-            target = 'DROP'
-        
-        if port == '*':
-            cmd = f"ip netns exec {ns_name} iptables -A OUTPUT -p {protocol} -d {destination} -j {target}"
-        else:
-            cmd = f"ip netns exec {ns_name} iptables -A OUTPUT -p {protocol} -d {destination} --dport {port} -j {target}"
-        
-        self.logger.info(f"Adding egress rule: port={port}, proto={protocol}, action={action}")
-        run_command(cmd)
+            return 'ACCEPT'
+        if action == 'DENY':
+            return 'DROP'
+        self.logger.warning(f"Unknown action: {action}, defaulting to DROP")
+        return 'DROP'
 
-    def _show_rules(self, ns_name):
+    def _show_rules(self, ns_name, engine='iptables'):
         """Display current firewall rules"""
         self.logger.info(f"Current firewall rules in {ns_name}:")
         
-        result = run_command(f"ip netns exec {ns_name} iptables -L -n -v", check=False)
+        result = self.backend.run_in_namespace(ns_name, self._list_command(engine), check=False)
         if result.returncode == 0:
             print("\n" + "="*80)
             print(result.stdout)
             print("="*80 + "\n")
 
+    @traced
     def clear_policy(self, vpc_name, subnet_name):
         """Clear firewall policy from a subnet"""
         self.logger.info(f"Clearing firewall policy from {vpc_name}/{subnet_name}")
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
         subnet = vpc['subnets'][subnet_name]
         ns_name = subnet['namespace']
         
-        # Flush all rules
-        run_command(f"ip netns exec {ns_name} iptables -F")
-        run_command(f"ip netns exec {ns_name} iptables -X")
+        self._flush(ns_name, subnet.get('policy', {}).get('engine', 'iptables'))
         
-        # Set default policies to ACCEPT
-        run_command(f"ip netns exec {ns_name} iptables -P INPUT ACCEPT")
-        run_command(f"ip netns exec {ns_name} iptables -P FORWARD ACCEPT")
-        run_command(f"ip netns exec {ns_name} iptables -P OUTPUT ACCEPT")
+        self.store.update_subnet(vpc_name, subnet_name, policy=None)
         
         self.logger.info(f"✓ Firewall policy cleared successfully")
 
+    @traced
     def show_policy(self, vpc_name, subnet_name):
         """Show current firewall policy for a subnet"""
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
@@ -182,7 +348,47 @@ class FirewallManager:
         print(f"\nFirewall rules for {vpc_name}/{subnet_name} ({ns_name})")
         print("="*80)
         
-        result = run_command(f"ip netns exec {ns_name} iptables -L -n -v", check=False)
+        if subnet.get('policy'):
+            self._show_counters(subnet)
+        
+        engine = subnet.get('policy', {}).get('engine', 'iptables')
+        result = self.backend.run_in_namespace(ns_name, self._list_command(engine), check=False)
         if result.returncode == 0:
             print(result.stdout)
 
+    def _show_counters(self, subnet):
+        """Packet/byte counters per policy rule (rule = position in the policy file)"""
+        from metrics import read_counters
+        try:
+            _, counters = read_counters(self.backend, subnet)
+        except Exception as e:
+            self.logger.warning(f"Could not read counters: {e}")
+            return
+        
+        print(f"Policy: {subnet['policy']['file']}")
+        print(f"{'DIRECTION':<10} {'RULE':<12} {'ACTION':<8} {'PACKETS':>14} {'BYTES':>16}")
+        for (direction, rule), (action, packets, octets) in sorted(counters.items()):
+            print(f"{direction:<10} {rule:<12} {action:<8} {packets:>14} {octets:>16}")
+        print("="*80)
+
+    def _flush(self, ns_name, engine):
+        """Remove all filtering in a namespace for one engine"""
+        if engine == 'nftables':
+            self.backend.run_in_namespace(ns_name, "nft -f -", input=nftables.delete_payload())
+            return
+        
+        # Flush all rules and reset default policies to ACCEPT in one restore
+        ruleset = '\n'.join([
+            '*filter',
+            ':INPUT ACCEPT [0:0]',
+            ':FORWARD ACCEPT [0:0]',
+            ':OUTPUT ACCEPT [0:0]',
+            'COMMIT',
+        ]) + '\n'
+        self.backend.run_in_namespace(ns_name, "iptables-restore -w", input=ruleset)
+
+    def _list_command(self, engine):
+        if engine == 'nftables':
+            return f"nft list table ip {nftables.TABLE}"
+        return "iptables -L -n -v"
+
@@ -0,0 +1,148 @@
+"""
+IP Batch - Queue ip(8) commands and run them through a single `ip -batch` process
+
+Provisioning used to run one `ip ...` shell per link/addr/route change. Here
+the commands are queued and flushed through one `ip -batch -` (or
+`ip -n <ns> -batch -` for namespace-scoped changes), so a subnet costs a
+couple of forks instead of a dozen.
+
+Each queued line remembers which object it belongs to, so when ip reports
+"Command failed -:N" we can still say which veth/bridge/route broke.
+"""
+
+import re
+from utils import run_command
+
+# ip prints this after the error message(s) for every failed batch line
+FAILED_LINE = re.compile(r'^Command failed -:(\d+)$')
+
+def format_options(options):
+    """' key value' for each option, in ip's own words"""
+    return ''.join(f" {key} {value}" for key, value in (options or {}).items())
+
+class IPBatch:
+    def __init__(self, namespace=None):
+        self.namespace = namespace
+        self.commands = []
+
+    def add(self, command, owner, check=True):
+        """Queue an ip command (without the leading 'ip') for an object"""
+        self.commands.append({'command': command, 'owner': owner, 'check': check})
+
+    # Typed helpers so callers don't care whether a batch renders ip lines
+    # (this class) or talks netlink directly (NetlinkBatch)
+
+    def add_netns(self, name, owner):
+        self.add(f"netns add {name}", owner)
+
+    def delete_netns(self, name, owner, check=True):
+        self.add(f"netns delete {name}", owner, check=check)
+
+    def add_bridge(self, name, owner):
+        self.add(f"link add {name} type bridge", owner)
+
+    def add_veth(self, name, peer, owner, peer_netns=None, options=None):
+        """options (mtu, txqueuelen, numtxqueues, numrxqueues) go on both ends"""
+        opts = format_options(options)
+        netns = f" netns {peer_netns}" if peer_netns else ""
+        self.add(f"link add {name}{opts} type veth peer name {peer}{opts}{netns}", owner)
+
+    def set_link(self, name, owner, up=True, master=None):
+        master_opt = f" master {master}" if master else ""
+        self.add(f"link set {name}{master_opt} {'up' if up else 'down'}", owner)
+
+    def set_bridge(self, name, owner, **options):
+        """Bridge options: forward_delay, stp_state, mcast_snooping"""
+        self.add(f"link set {name} type bridge{format_options(options)}", owner)
+
+    def delete_link(self, name, owner, check=True):
+        self.add(f"link delete {name}", owner, check=check)
+
+    def add_address(self, dev, address, owner):
+        self.add(f"addr add {address} dev {dev}", owner)
+
+    def add_route(self, dst, owner, via=None, dev=None, onlink=False, check=True):
+        self.add(f"route add {self._route_spec(dst, via, dev, onlink)}", owner, check=check)
+
+    def delete_route(self, dst, owner, via=None, dev=None, check=True):
+        self.add(f"route del {self._route_spec(dst, via, dev, False)}", owner, check=check)
+
+    def _route_spec(self, dst, via, dev, onlink):
+        spec = dst
+        if via:
+            spec += f" via {via}"
+        if dev:
+            spec += f" dev {dev}"
+        if onlink:
+            spec += " onlink"
+        return spec
+
+    def __len__(self):
+        return len(self.commands)
+
+    def commit(self):
+        """Run every queued command in one ip process and return the failures"""
+        if not self.commands:
+            return []
+
+        payload = '\n'.join(c['command'] for c in self.commands) + '\n'
+        if self.namespace:
+            cmd = f"ip -n {self.namespace} -force -batch -"
+        else:
+            cmd = "ip -force -batch -"
+
+        # -force keeps going after a failed line so non-fatal lines (like
+        # routes that may already exist) don't abort the whole batch
+        result = run_command(cmd, check=False, input=payload)
+        self.commands, queued = [], self.commands
+
+        failures = self._parse_failures(result.stderr or '', queued)
+        errors = [f for f in failures if f['check']]
+        if errors:
+            raise Exception(self._format_errors(errors))
+
+        if result.returncode != 0 and not failures:
+            # ip bails out on bad arguments without a line number, so guess
+            # the culprit from the argument quoted in the error message
+            raise Exception(self._format_abort(result.stderr or '', queued))
+
+        return failures
+
+    def _parse_failures(self, stderr, queued):
+        """Map 'Command failed -:N' lines back to the queued commands"""
+        failures = []
+        message = []
+        for line in stderr.splitlines():
+            match = FAILED_LINE.match(line.strip())
+            if not match:
+                message.append(line.strip())
+                continue
+
+            index = int(match.group(1)) - 1
+            if 0 <= index < len(queued):
+                failure = dict(queued[index])
+                failure['line'] = index + 1
+                failure['error'] = ' '.join(m for m in message if m)
+                failures.append(failure)
+            message = []
+        return failures
+
+    def _format_abort(self, stderr, queued):
+        """Build an error message for a batch ip aborted part-way through"""
+        where = f" in namespace {self.namespace}" if self.namespace else ""
+        quoted = re.findall(r'"([^"]+)"', stderr)
+        suspects = [c for c in queued if any(q in c['command'].split() for q in quoted)]
+
+        lines = [f"ip batch aborted{where}: {stderr.strip()}"]
+        for c in suspects or queued:
+            lines.append(f"  [{c['owner']}] ip {c['command']}")
+        return '\n'.join(lines)
+
+    def _format_errors(self, errors):
+        """Build an error message that points at the objects that failed"""
+        where = f" in namespace {self.namespace}" if self.namespace else ""
+        lines = [f"ip batch failed{where}:"]
+        for e in errors:
+            lines.append(f"  [{e['owner']}] line {e['line']}: ip {e['command']}")
+            lines.append(f"    Error: {e['error']}")
+        return '\n'.join(lines)
@@ -0,0 +1,109 @@
+"""
+IPAM - Address arithmetic and subnet allocation for VPC CIDRs
+
+Gateway and host addresses are computed from the network address instead
+of walking `network.hosts()`, which builds a list of every address (16M
+objects for a /8) just to pick the first one.
+
+AddressPool tracks a VPC's free space as a sorted list of [start, end)
+integer ranges, so `create-subnet --prefix-len 24` can carve the next free,
+properly aligned block out of the VPC without trying candidates one by one.
+"""
+
+import bisect
+import ipaddress
+
+def host_address(cidr, index=0):
+    """Return the index-th usable host address of a CIDR (0 is the first)"""
+    network = ipaddress.ip_network(cidr, strict=False)
+    # Same rules as network.hosts(): /31 and /32 (or /127, /128) have no
+    # network/broadcast address to skip
+    if network.num_addresses <= 2:
+        first, count = 0, network.num_addresses
+    else:
+        first, count = 1, network.num_addresses - 2
+    if index >= count:
+        raise ValueError(f"{cidr} has no host #{index + 1}")
+    return network.network_address + first + index
+
+def gateway_address(cidr):
+    """First usable address, which vpcctl gives to the bridge/gateway"""
+    return host_address(cidr, 0)
+
+def transit_address(cidr):
+    """Last usable address, which a transit hub uses inside the VPC"""
+    network = ipaddress.ip_network(cidr, strict=False)
+    if network.num_addresses <= 2:
+        return network.broadcast_address
+    return network.broadcast_address - 1
+
+class AddressPool:
+    """Free address space of a VPC as sorted, non-overlapping [start, end) ranges"""
+
+    def __init__(self, cidr, used=()):
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        self.max_prefix = self.network.max_prefixlen
+
+        # Build the free list in one pass over the sorted used ranges
+        start = int(self.network.network_address)
+        end = start + self.network.num_addresses
+        self.starts, self.ends = [], []
+        cursor = start
+        for lo, hi in sorted(self._range(c) for c in used):
+            lo, hi = max(lo, start), min(hi, end)
+            if lo > cursor:
+                self.starts.append(cursor)
+                self.ends.append(lo)
+            cursor = max(cursor, hi)
+        if cursor < end:
+            self.starts.append(cursor)
+            self.ends.append(end)
+
+    @staticmethod
+    def _range(cidr):
+        network = ipaddress.ip_network(cidr, strict=False)
+        lo = int(network.network_address)
+        return lo, lo + network.num_addresses
+
+    def is_free(self, cidr):
+        """True if the whole CIDR is unallocated"""
+        lo, hi = self._range(cidr)
+        i = bisect.bisect_right(self.starts, lo) - 1
+        return i >= 0 and hi <= self.ends[i]
+
+    def reserve(self, cidr):
+        """Mark a CIDR as used (it must be free)"""
+        lo, hi = self._range(cidr)
+        i = bisect.bisect_right(self.starts, lo) - 1
+        if i < 0 or hi > self.ends[i]:
+            raise ValueError(f"{cidr} is not free in {self.network}")
+
+        start, end = self.starts[i], self.ends[i]
+        # Replace the block with whatever is left on either side of the CIDR
+        pieces = [(s, e) for s, e in ((start, lo), (hi, end)) if e > s]
+        self.starts[i:i + 1] = [s for s, _ in pieces]
+        self.ends[i:i + 1] = [e for _, e in pieces]
+
+    def allocate(self, prefix_len):
+        """Reserve and return the first free aligned block of the given size"""
+        if not self.network.prefixlen <= prefix_len <= self.max_prefix:
+            raise ValueError(
+                f"Prefix length /{prefix_len} doesn't fit in {self.network}"
+            )
+
+        size = 1 << (self.max_prefix - prefix_len)
+        for start, end in zip(self.starts, self.ends):
+            aligned = (start + size - 1) & ~(size - 1)
+            if aligned + size <= end:
+                network = ipaddress.ip_network((aligned, prefix_len))
+                self.reserve(network)
+                return network
+
+        raise ValueError(f"No free /{prefix_len} left in {self.network}")
+
+def vpc_pool(vpc):
+    """AddressPool for a VPC with its gateway, transit address and subnets reserved"""
+    gateway = ipaddress.ip_network(gateway_address(vpc['cidr']))
+    transit = ipaddress.ip_network(transit_address(vpc['cidr']))
+    used = [gateway, transit] + [subnet['cidr'] for subnet in vpc['subnets'].values()]
+    return AddressPool(vpc['cidr'], used)
@@ -1,45 +1,173 @@
 """
 Logger module for VPC operations
+
+Records go to the console (INFO and up) straight away, and to the log
+file (DEBUG and up) through a queue: a QueueListener thread does the disk
+writes, so logging never blocks an operation on I/O.
+
+Configured from the environment, like the log directory:
+
+- VPCCTL_LOG_DIR      where the log file lives (default: /var/log/vpcctl)
+- VPCCTL_LOG_FORMAT   text (default) or json, one object per line with the
+                      operation id, command, VPC, subnet and duration
+- VPCCTL_LOG_ROTATE   daily (default, at midnight) or a size like 10M
+- VPCCTL_LOG_BACKUPS  rotated files to keep (default: 7)
 """
 
+import atexit
+import json
 import logging
 import os
-from datetime import datetime
+import queue
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+LOG_DIR = '/var/log/vpcctl'
+LOG_FILE = 'vpcctl.log'
+
+# Fields operation() puts on every record logged while it's running
+CONTEXT_FIELDS = ('op_id', 'operation', 'vpc', 'subnet', 'duration_ms')
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+_context = {}
+_listener = None
+
+class _DeferredOpen:
+    """Creates the log directory and file on the first record
+
+    Commands that never log to the file (list-vpcs and friends) don't
+    touch /var/log at all.
+    """
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+class DeferredRotatingFileHandler(_DeferredOpen, RotatingFileHandler):
+    pass
+
+class DeferredTimedRotatingFileHandler(_DeferredOpen, TimedRotatingFileHandler):
+    pass
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                    + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class _ContextFilter(logging.Filter):
+    def filter(self, record):
+        for field, value in _context.items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+def rotating_handler(log_file, rotate=None, backups=None):
+    """File handler for VPCCTL_LOG_ROTATE: 'daily' or a size like '10M'"""
+    setting = rotate or os.environ.get('VPCCTL_LOG_ROTATE', 'daily')
+    rotate = setting.strip().upper()
+    backups = int(backups if backups is not None else os.environ.get('VPCCTL_LOG_BACKUPS', 7))
+    if rotate == 'DAILY':
+        return DeferredTimedRotatingFileHandler(log_file, when='midnight', backupCount=backups,
+                                                delay=True)
+    try:
+        max_bytes = int(float(rotate[:-1]) * SIZE_UNITS[rotate[-1]]) if rotate[-1] in SIZE_UNITS \
+            else int(rotate)
+    except (ValueError, IndexError):
+        raise ValueError(f"VPCCTL_LOG_ROTATE must be 'daily' or a size like 10M, not {setting!r}")
+    return DeferredRotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups, delay=True)
 
 def setup_logger():
     """Setup and return logger instance"""
-    log_dir = '/var/log/vpcctl'
-    
-    # Create log directory if it doesn't exist
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    
-    log_file = os.path.join(log_dir, f'vpcctl-{datetime.now().strftime("%Y%m%d")}.log')
-    
+    global _listener
+    log_dir = os.environ.get('VPCCTL_LOG_DIR', LOG_DIR)
+    log_format = os.environ.get('VPCCTL_LOG_FORMAT', 'text')
+    if log_format not in ('text', 'json'):
+        raise ValueError(f"VPCCTL_LOG_FORMAT must be text or json, not {log_format!r}")
+
     # Configure logger
     logger = logging.getLogger('vpcctl')
     logger.setLevel(logging.DEBUG)
-    
+
     # Remove existing handlers
     logger.handlers = []
-    
-    # File handler
-    file_handler = logging.FileHandler(log_file)
+    if _listener:
+        _listener.stop()
+
+    # File handler, fed from a queue by the listener thread
+    file_handler = rotating_handler(os.path.join(log_dir, LOG_FILE))
     file_handler.setLevel(logging.DEBUG)
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-    file_handler.setFormatter(file_formatter)
-    
+    if log_format == 'json':
+        file_handler.setFormatter(JSONFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        ))
+    queue_handler = QueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(_ContextFilter())
+    _listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
     # Console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_formatter = logging.Formatter('%(levelname)s: %(message)s')
-    console_handler.setFormatter(console_formatter)
-    
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
-    
+    console = logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    console.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
+
+    logger.addHandler(queue_handler)
+    logger.addHandler(console)
+
     return logger
 
+def console_handler(logger):
+    """The handler printing to the terminal"""
+    return next(h for h in logger.handlers
+                if isinstance(h, logging.StreamHandler) and not isinstance(h, logging.FileHandler))
+
+@contextmanager
+def quiet(logger):
+    """Only warnings and errors on the console (the log file still gets everything)"""
+    console = console_handler(logger)
+    level = console.level
+    console.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        console.setLevel(level)
+
+@contextmanager
+def operation(logger, name, vpc=None, subnet=None, timed=True):
+    """Tag every record logged inside with an operation id, VPC and subnet
+
+    Logs how long the operation took (duration_ms) when it's done, unless
+    timed is False: read-only commands shouldn't open the log file just
+    for that.
+    """
+    global _context
+    saved = _context
+    _context = {field: value for field, value in
+                (('op_id', os.urandom(6).hex()), ('operation', name), ('vpc', vpc), ('subnet', subnet))
+                if value is not None}
+    started = time.perf_counter()
+    try:
+        yield _context['op_id']
+    finally:
+        elapsed = (time.perf_counter() - started) * 1000
+        if timed:
+            logger.debug(f"{name} finished in {elapsed:.1f} ms", extra={'duration_ms': round(elapsed, 1)})
+        _context = saved
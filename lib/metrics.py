@@ -0,0 +1,248 @@
+"""
+Metrics - Firewall counters and interface stats as Prometheus text
+
+`vpcctl exporter` serves this over HTTP. One scrape:
+
+- reads the exact per-rule packet/byte counters of every subnet that has a
+  policy, with a single `iptables-save -c` (or `nft -j list table`) per
+  namespace, all namespaces at once from a thread pool. Every compiled
+  rule carries a `vpcctl:<direction>:<rules>` comment (see
+  firewall_manager.py / nftables.py), which is how a counter is mapped
+  back to the policy rule(s) it came from
+- reads bridge, subnet, peering and transit veth stats from one read of
+  /proc/net/dev, no process at all
+
+So the cost of a scrape is one process per policed namespace, however many
+rules or metrics there are.
+"""
+
+import json
+import re
+import time
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from utils import parse_rule_comment, get_subprocess_count
+from backends import get_backend
+from state_store import get_store
+import nftables
+
+# [packets:bytes] -A CHAIN ... -m comment --comment vpcctl:ingress:1 -j ACCEPT
+IPTABLES_RULE = re.compile(r'^\[(\d+):(\d+)\] -A (\S+) (.*)$')
+# :INPUT DROP [packets:bytes]
+IPTABLES_POLICY = re.compile(r'^:(INPUT|OUTPUT) (\S+) \[(\d+):(\d+)\]$')
+CHAIN_DIRECTIONS = {'INPUT': 'ingress', 'OUTPUT': 'egress'}
+
+# /proc/net/dev columns we export, by position after the interface name
+INTERFACE_FIELDS = {
+    'receive_bytes': 0, 'receive_packets': 1, 'receive_errs': 2, 'receive_drop': 3,
+    'transmit_bytes': 8, 'transmit_packets': 9, 'transmit_errs': 10, 'transmit_drop': 11,
+}
+
+def parse_iptables_counters(text):
+    """iptables-save -c output -> {(direction, rule): [action, packets, bytes]}"""
+    counters = {}
+    for line in text.splitlines():
+        match = IPTABLES_POLICY.match(line)
+        if match:
+            chain, policy, packets, octets = match.groups()
+            counters[(CHAIN_DIRECTIONS[chain], 'default')] = [policy, int(packets), int(octets)]
+            continue
+
+        match = IPTABLES_RULE.match(line)
+        if not match:
+            continue
+        packets, octets, _, rest = match.groups()
+        args = shlex.split(rest)
+        if '--comment' not in args or '-j' not in args:
+            continue
+        tag = parse_rule_comment(args[args.index('--comment') + 1])
+        if tag is None:
+            continue
+        # A multiport rule split in several lines still is one policy rule
+        entry = counters.setdefault(tag, [args[args.index('-j') + 1], 0, 0])
+        entry[1] += int(packets)
+        entry[2] += int(octets)
+    return counters
+
+def parse_nft_counters(text):
+    """`nft -j list table` output -> {(direction, rule): [action, packets, bytes]}"""
+    counters = {}
+    for item in json.loads(text).get('nftables', []):
+        rule = item.get('rule')
+        if not rule:
+            continue
+        tag = parse_rule_comment(rule.get('comment'))
+        if tag is None:
+            continue
+
+        action, packets, octets = 'DROP' if tag[1] == 'default' else None, 0, 0
+        for expr in rule.get('expr', []):
+            if 'counter' in expr:
+                packets, octets = expr['counter']['packets'], expr['counter']['bytes']
+            elif 'accept' in expr:
+                action = 'ACCEPT'
+            elif 'drop' in expr:
+                action = 'DROP'
+        if tag == ('egress', 'default'):
+            action = 'ACCEPT'
+
+        entry = counters.setdefault(tag, [action, 0, 0])
+        entry[1] += packets
+        entry[2] += octets
+    return counters
+
+def interface_stats(path='/proc/net/dev'):
+    """{interface: {field: value}} for every interface in our namespace"""
+    stats = {}
+    with open(path) as f:
+        # Two header lines
+        for line in f.readlines()[2:]:
+            name, _, values = line.partition(':')
+            values = values.split()
+            stats[name.strip()] = {field: int(values[i]) for field, i in INTERFACE_FIELDS.items()}
+    return stats
+
+def read_counters(backend, subnet):
+    """Per-rule counters of a subnet's policy -> (engine, counters), one process"""
+    engine = subnet['policy'].get('engine', 'iptables')
+    if engine == 'nftables':
+        command, parse = f"nft -j list table ip {nftables.TABLE}", parse_nft_counters
+    else:
+        command, parse = "iptables-save -c -t filter", parse_iptables_counters
+    result = backend.run_in_namespace(subnet['namespace'], command, check=False)
+    if result.returncode != 0:
+        raise Exception(result.stderr.strip() or f"{command} exited with {result.returncode}")
+    return engine, parse(result.stdout)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class _Metrics:
+    """Collects samples and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self.families = {}
+
+    def add(self, name, kind, help_text, labels, value):
+        family = self.families.setdefault(name, (kind, help_text, []))
+        family[2].append((labels, value))
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, samples) in self.families.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+class MetricsCollector:
+    def __init__(self, logger, jobs=8, backend=None):
+        self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
+        self.jobs = jobs
+
+    def collect(self):
+        """Sample every namespace and interface once and return the Prometheus text"""
+        started = time.monotonic()
+        forks = get_subprocess_count()
+        metrics = _Metrics()
+        state = self.store.load()
+
+        policed = [
+            (vpc_name, subnet_name, subnet)
+            for vpc_name, vpc in state['vpcs'].items()
+            for subnet_name, subnet in vpc['subnets'].items()
+            if subnet.get('policy')
+        ]
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [(v, s, pool.submit(read_counters, self.backend, subnet)) for v, s, subnet in policed]
+
+        for vpc_name, subnet_name, future in futures:
+            ok = 1
+            try:
+                engine, counters = future.result()
+            except Exception as e:
+                self.logger.warning(f"Reading counters of {vpc_name}/{subnet_name} failed: {e}")
+                ok, counters = 0, {}
+            metrics.add('vpcctl_firewall_up', 'gauge',
+                        'Whether the firewall counters of a subnet could be read',
+                        {'vpc': vpc_name, 'subnet': subnet_name}, ok)
+
+            for (direction, rule), (action, packets, octets) in sorted(counters.items()):
+                labels = {'vpc': vpc_name, 'subnet': subnet_name, 'engine': engine,
+                          'direction': direction, 'rule': rule, 'action': action}
+                metrics.add('vpcctl_firewall_rule_packets_total', 'counter',
+                            'Packets matched by a policy rule (rule is its position in the policy file)',
+                            labels, packets)
+                metrics.add('vpcctl_firewall_rule_bytes_total', 'counter',
+                            'Bytes matched by a policy rule (rule is its position in the policy file)',
+                            labels, octets)
+
+        interfaces = {}
+        for vpc_name, vpc in state['vpcs'].items():
+            interfaces[vpc['bridge']] = {'vpc': vpc_name, 'kind': 'bridge'}
+            for subnet_name, subnet in vpc['subnets'].items():
+                interfaces[subnet['veth_host']] = {'vpc': vpc_name, 'kind': 'subnet',
+                                                   'subnet': subnet_name}
+        for peering in state['peerings']:
+            interfaces[peering['veth1']] = {'vpc': peering['vpc1'], 'kind': 'peering'}
+            interfaces[peering['veth2']] = {'vpc': peering['vpc2'], 'kind': 'peering'}
+        for hub_name, hub in state['hubs'].items():
+            for vpc_name, att in hub['attachments'].items():
+                interfaces[att['veth_host']] = {'vpc': vpc_name, 'kind': 'transit', 'hub': hub_name}
+
+        stats = self.backend.interface_stats()
+        for name, labels in interfaces.items():
+            if name not in stats:
+                continue
+            for field, value in stats[name].items():
+                metrics.add(f"vpcctl_interface_{field}_total", 'counter',
+                            f"Interface statistic {field} (host side, from /proc/net/dev)",
+                            {'interface': name, **labels}, value)
+
+        metrics.add('vpcctl_scrape_duration_seconds', 'gauge', 'Time the scrape took',
+                    {}, round(time.monotonic() - started, 6))
+        metrics.add('vpcctl_scrape_subprocesses', 'gauge', 'Processes spawned by the scrape',
+                    {}, get_subprocess_count() - forks)
+        return metrics.render()
+
+def serve(logger, listen='127.0.0.1:9477', jobs=8):
+    """Serve /metrics until interrupted"""
+    # Only the exporter needs the HTTP server; keep it out of everyone's imports
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    host, _, port = listen.rpartition(':')
+    collector = MetricsCollector(logger, jobs=jobs)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            try:
+                body = collector.collect().encode()
+            except Exception as e:
+                logger.error(f"Scrape failed: {e}")
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(f"exporter: {self.address_string()} {format % args}")
+
+    server = ThreadingHTTPServer((host or '0.0.0.0', int(port)), Handler)
+    logger.info(f"Serving metrics on http://{listen}/metrics")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -2,23 +2,31 @@
 NAT Manager - Handles Network Address Translation
 """
 
-from utils import run_command, load_vpc_state
+import os
+from backends import get_backend
+from state_store import get_store
+from tracing import traced
+
+def internet_target():
+    """Address internet checks ping (VPCCTL_INTERNET_TARGET, e.g. a local stand-in)"""
+    return os.environ.get('VPCCTL_INTERNET_TARGET', '8.8.8.8')
 
 class NATManager:
-    def __init__(self, logger):
+    def __init__(self, logger, backend=None):
         self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
 
+    @traced
     def configure_nat_gateway(self, vpc_name, subnet_name):
         """Configure NAT gateway for a subnet"""
         self.logger.info(f"Configuring NAT gateway for {vpc_name}/{subnet_name}")
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
@@ -28,31 +36,30 @@ class NATManager:
         
         # Enable IP forwarding
         self.logger.info("Enabling IP forwarding")
-        run_command("sysctl -w net.ipv4.ip_forward=1")
+        self.backend.sysctl('net.ipv4.ip_forward', 1)
         
         # Add MASQUERADE rule
         self.logger.info(f"Adding MASQUERADE rule for {cidr}")
-        run_command(
+        self.backend.run(
             f"iptables -t nat -A POSTROUTING -s {cidr} -o {interface} -j MASQUERADE"
         )
         
         # Allow forwarding
-        run_command(f"iptables -A FORWARD -s {cidr} -j ACCEPT")
-        run_command(f"iptables -A FORWARD -d {cidr} -j ACCEPT")
+        self.backend.run(f"iptables -A FORWARD -s {cidr} -j ACCEPT")
+        self.backend.run(f"iptables -A FORWARD -d {cidr} -j ACCEPT")
         
         self.logger.info("✓ NAT gateway configured successfully")
 
+    @traced
     def remove_nat_gateway(self, vpc_name, subnet_name):
         """Remove NAT gateway configuration"""
         self.logger.info(f"Removing NAT gateway for {vpc_name}/{subnet_name}")
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
@@ -62,42 +69,39 @@ class NATManager:
         
         # Remove MASQUERADE rule
         self.logger.info(f"Removing MASQUERADE rule for {cidr}")
-        run_command(
+        self.backend.run(
             f"iptables -t nat -D POSTROUTING -s {cidr} -o {interface} -j MASQUERADE",
             check=False
         )
         
         # Remove forwarding rules
-        run_command(f"iptables -D FORWARD -s {cidr} -j ACCEPT", check=False)
-        run_command(f"iptables -D FORWARD -d {cidr} -j ACCEPT", check=False)
+        self.backend.run(f"iptables -D FORWARD -s {cidr} -j ACCEPT", check=False)
+        self.backend.run(f"iptables -D FORWARD -d {cidr} -j ACCEPT", check=False)
         
         self.logger.info("✓ NAT gateway removed successfully")
 
-    def test_internet_connectivity(self, vpc_name, subnet_name):
+    @traced
+    def test_internet_connectivity(self, vpc_name, subnet_name, target=None):
         """Test internet connectivity from a subnet"""
         self.logger.info(f"Testing internet connectivity from {vpc_name}/{subnet_name}")
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
         subnet = vpc['subnets'][subnet_name]
         ns_name = subnet['namespace']
         
-        self.logger.info("Pinging 8.8.8.8 (Google DNS)")
+        target = target or internet_target()
+        self.logger.info(f"Pinging {target}")
         
-        result = run_command(
-            f"ip netns exec {ns_name} ping -c 3 -W 2 8.8.8.8",
-            check=False
-        )
+        ok, _ = self.backend.ping(ns_name, target, count=3, timeout=2)
         
-        if result.returncode == 0:
+        if ok:
             self.logger.info("✓ Internet connectivity test PASSED")
             return True
         else:
@@ -0,0 +1,266 @@
+"""
+Netlink - Minimal rtnetlink client built on the standard library
+
+Talks to the kernel over an AF_NETLINK/NETLINK_ROUTE socket instead of
+forking `ip`. Only covers what vpcctl needs: links (bridge/veth create,
+delete, up, master, namespace moves, MTU, queues, bridge options), IPv4
+addresses and IPv4 routes.
+
+Message layouts come from <linux/netlink.h>, <linux/rtnetlink.h> and
+<linux/if_link.h>.
+"""
+
+import errno
+import ipaddress
+import os
+import socket
+import struct
+import threading
+
+NETLINK_ROUTE = 0
+
+# Message types
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+# Message flags
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# Link attributes
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_TXQLEN = 13
+IFLA_LINKINFO = 18
+IFLA_NET_NS_FD = 28
+IFLA_NUM_TX_QUEUES = 31
+IFLA_NUM_RX_QUEUES = 32
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+VETH_INFO_PEER = 1
+IFF_UP = 0x1
+
+# Bridge attributes (inside IFLA_INFO_DATA)
+IFLA_BR_FORWARD_DELAY = 1
+IFLA_BR_STP_STATE = 5
+IFLA_BR_MCAST_SNOOPING = 23
+
+# Address attributes
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+# Route attributes and rtmsg values
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RT_TABLE_MAIN = 254
+RTPROT_BOOT = 3
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+RTN_UNICAST = 1
+RTNH_F_ONLINK = 0x4
+
+NLMSGHDR = struct.Struct('=IHHII')
+NLMSGERR = struct.Struct('=i')
+RTATTR = struct.Struct('=HH')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTMSG = struct.Struct('=BBBBBBBBI')
+
+def _align(length):
+    return (length + 3) & ~3
+
+def _attr(attr_type, data):
+    """Pack a single rtattr (TLV) padded to 4 bytes"""
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attr_type) + data + b'\0' * (_align(length) - length)
+
+def _attr_str(attr_type, value):
+    return _attr(attr_type, value.encode() + b'\0')
+
+def _attr_u32(attr_type, value):
+    return _attr(attr_type, struct.pack('=I', value))
+
+def _attr_u8(attr_type, value):
+    return _attr(attr_type, struct.pack('=B', value))
+
+# Options link_add/link_set take, as `ip link` spells them
+LINK_OPTIONS = {
+    'mtu': IFLA_MTU,
+    'txqueuelen': IFLA_TXQLEN,
+    'numtxqueues': IFLA_NUM_TX_QUEUES,
+    'numrxqueues': IFLA_NUM_RX_QUEUES,
+}
+
+def link_attrs(options):
+    """Attributes for LINK_OPTIONS (queue counts only count at creation)"""
+    return b''.join(_attr_u32(LINK_OPTIONS[key], value)
+                    for key, value in (options or {}).items() if value is not None)
+
+class NetlinkSocket:
+    """A NETLINK_ROUTE socket that sends one request at a time and waits for the ACK"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        self.sock.bind((0, 0))
+        self.seq = 0
+        # One request in flight at a time, so threads sharing the socket
+        # don't read each other's replies
+        self.lock = threading.Lock()
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, msg_type, flags, payload):
+        """Send a request and return the reply messages as (type, body) tuples"""
+        with self.lock:
+            return self._request(msg_type, flags, payload)
+
+    def _request(self, msg_type, flags, payload):
+        self.seq += 1
+        seq = self.seq
+        header = NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+                               flags | NLM_F_REQUEST, seq, 0)
+        self.sock.send(header + payload)
+
+        replies = []
+        while True:
+            data = self.sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, reply_type, _, reply_seq, _ = NLMSGHDR.unpack_from(data, offset)
+                body = data[offset + NLMSGHDR.size:offset + length]
+                offset += _align(length)
+
+                if reply_seq != seq:
+                    continue
+                if reply_type == NLMSG_ERROR:
+                    (error,) = NLMSGERR.unpack_from(body)
+                    if error:
+                        raise OSError(-error, os.strerror(-error))
+                    return replies
+                if reply_type == NLMSG_DONE:
+                    return replies
+                replies.append((reply_type, body))
+
+                # Plain GET requests without NLM_F_ACK end with their one reply
+                if not flags & NLM_F_ACK:
+                    return replies
+
+    # Links
+
+    def link_index(self, name):
+        """Return the ifindex for an interface name, or None if it doesn't exist"""
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0) + _attr_str(IFLA_IFNAME, name)
+        try:
+            replies = self.request(RTM_GETLINK, 0, payload)
+        except OSError as e:
+            if e.errno == errno.ENODEV:
+                return None
+            raise
+        for reply_type, body in replies:
+            if reply_type == RTM_NEWLINK:
+                return IFINFOMSG.unpack_from(body)[2]
+        return None
+
+    def _require_index(self, name):
+        index = self.link_index(name)
+        if index is None:
+            raise OSError(errno.ENODEV, f'Cannot find device "{name}"')
+        return index
+
+    def link_add(self, name, kind, peer=None, peer_netns_fd=None, attrs=b'', peer_attrs=b''):
+        """Create a link of the given kind (bridge, veth, ...)"""
+        info = _attr_str(IFLA_INFO_KIND, kind)
+        if peer is not None:
+            peer_msg = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+            peer_msg += _attr_str(IFLA_IFNAME, peer) + peer_attrs
+            if peer_netns_fd is not None:
+                peer_msg += _attr_u32(IFLA_NET_NS_FD, peer_netns_fd)
+            info += _attr(IFLA_INFO_DATA, _attr(VETH_INFO_PEER, peer_msg))
+
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0)
+        payload += _attr_str(IFLA_IFNAME, name) + attrs + _attr(IFLA_LINKINFO, info)
+        self.request(RTM_NEWLINK, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, payload)
+
+    def link_set(self, name, up=None, master=None, netns_fd=None, attrs=b''):
+        """Change link state, bridge master or namespace of an existing link"""
+        flags = change = 0
+        if up is not None:
+            change = IFF_UP
+            flags = IFF_UP if up else 0
+
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, self._require_index(name), flags, change)
+        if master is not None:
+            payload += _attr_u32(IFLA_MASTER, self._require_index(master))
+        if netns_fd is not None:
+            payload += _attr_u32(IFLA_NET_NS_FD, netns_fd)
+        payload += attrs
+        self.request(RTM_NEWLINK, NLM_F_ACK, payload)
+
+    def bridge_set(self, name, forward_delay=None, stp_state=None, mcast_snooping=None):
+        """Change bridge options (forward_delay in hundredths of a second, like ip)"""
+        data = b''
+        if forward_delay is not None:
+            data += _attr_u32(IFLA_BR_FORWARD_DELAY, forward_delay)
+        if stp_state is not None:
+            data += _attr_u32(IFLA_BR_STP_STATE, stp_state)
+        if mcast_snooping is not None:
+            data += _attr_u8(IFLA_BR_MCAST_SNOOPING, mcast_snooping)
+        info = _attr_str(IFLA_INFO_KIND, 'bridge') + _attr(IFLA_INFO_DATA, data)
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, self._require_index(name), 0, 0)
+        payload += _attr(IFLA_LINKINFO, info)
+        self.request(RTM_NEWLINK, NLM_F_ACK, payload)
+
+    def link_delete(self, name):
+        """Delete a link (deleting one end of a veth removes both)"""
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, self._require_index(name), 0, 0)
+        self.request(RTM_DELLINK, NLM_F_ACK, payload)
+
+    # Addresses
+
+    def addr_add(self, dev, address):
+        """Add an IPv4 address in CIDR form (e.g. 10.0.1.2/24) to a link"""
+        iface = ipaddress.ip_interface(address)
+        packed = iface.ip.packed
+        payload = IFADDRMSG.pack(socket.AF_INET, iface.network.prefixlen, 0,
+                                 RT_SCOPE_UNIVERSE, self._require_index(dev))
+        payload += _attr(IFA_LOCAL, packed) + _attr(IFA_ADDRESS, packed)
+        self.request(RTM_NEWADDR, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, payload)
+
+    # Routes
+
+    def _route_msg(self, dst, via, dev, onlink, scope, protocol, rtype):
+        if dst == 'default':
+            dst = '0.0.0.0/0'
+        network = ipaddress.ip_network(dst, strict=False)
+        payload = RTMSG.pack(socket.AF_INET, network.prefixlen, 0, 0, RT_TABLE_MAIN,
+                             protocol, scope, rtype, RTNH_F_ONLINK if onlink else 0)
+        if network.prefixlen:
+            payload += _attr(RTA_DST, network.network_address.packed)
+        if via:
+            payload += _attr(RTA_GATEWAY, ipaddress.ip_address(via).packed)
+        if dev:
+            payload += _attr_u32(RTA_OIF, self._require_index(dev))
+        return payload
+
+    def route_add(self, dst, via=None, dev=None, onlink=False):
+        """Add an IPv4 route to the main table"""
+        scope = RT_SCOPE_UNIVERSE if via else RT_SCOPE_LINK
+        payload = self._route_msg(dst, via, dev, onlink, scope, RTPROT_BOOT, RTN_UNICAST)
+        self.request(RTM_NEWROUTE, NLM_F_ACK | NLM_F_CREATE | NLM_F_EXCL, payload)
+
+    def route_delete(self, dst, via=None, dev=None):
+        """Delete an IPv4 route from the main table"""
+        payload = self._route_msg(dst, via, dev, False, RT_SCOPE_NOWHERE, 0, 0)
+        self.request(RTM_DELROUTE, NLM_F_ACK, payload)
@@ -0,0 +1,183 @@
+"""
+Netns - Run code inside network namespaces without `ip netns exec`
+
+`ip netns exec <ns> cmd` forks ip, which unshares a mount namespace,
+remounts /sys, calls setns() and then execs cmd. For a sysctl write or a
+netlink request that's a lot of work for nothing.
+
+Instead each namespace gets one worker thread that opens /run/netns/<ns>
+once and calls setns() on itself. Anything submitted to that thread runs
+inside the namespace: /proc/sys/net writes, sockets (including netlink
+sockets, which stay bound to the namespace after they're created) and
+child processes, which inherit the thread's namespace when forked.
+
+Workers and their fds are cached for the lifetime of the command (or of
+vpcctld, which checks that the namespace behind a cached fd is still the
+one pinned under /run/netns) and closed at exit.
+"""
+
+import atexit
+import ctypes
+import os
+import threading
+
+NETNS_RUN_DIR = '/run/netns'
+CLONE_NEWNET = 0x40000000
+MS_BIND = 0x1000
+MNT_DETACH = 0x2
+
+_libc = None
+_namespaces = {}
+_lock = threading.Lock()
+
+def _call_libc(name, *args):
+    """Call a libc function and raise OSError on failure"""
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    if getattr(_libc, name)(*args) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, f"{name}: {os.strerror(err)}")
+
+def _setns(fd):
+    if hasattr(os, 'setns'):
+        os.setns(fd, CLONE_NEWNET)
+    else:
+        _call_libc('setns', fd, CLONE_NEWNET)
+
+def _unshare_net():
+    if hasattr(os, 'unshare'):
+        os.unshare(CLONE_NEWNET)
+    else:
+        _call_libc('unshare', CLONE_NEWNET)
+
+def _netns_dir_ready():
+    """True once iproute2 has set /run/netns up as a shared mount point"""
+    with open('/proc/self/mountinfo') as f:
+        return any(line.split()[4] == NETNS_RUN_DIR for line in f)
+
+class Namespace:
+    """A network namespace with a dedicated worker thread living inside it"""
+
+    def __init__(self, name, created=False):
+        # Imported here: commands that never enter a namespace skip the cost
+        from concurrent.futures import ThreadPoolExecutor
+        self.name = name
+        self.path = os.path.join(NETNS_RUN_DIR, name)
+        self.fd = None
+        self._netlink = None
+
+        if created:
+            # add_namespace() already moved the worker into the new namespace
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"netns-{name}")
+            self.executor.submit(self._create).result()
+        else:
+            self.fd = os.open(self.path, os.O_RDONLY)
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"netns-{name}",
+                initializer=_setns, initargs=(self.fd,)
+            )
+
+    def _create(self):
+        """Create a namespace from the worker thread and pin it under /run/netns"""
+        fd = os.open(self.path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0)
+        os.close(fd)
+        try:
+            _unshare_net()
+            _call_libc('mount', b'/proc/thread-self/ns/net', self.path.encode(),
+                       b'none', MS_BIND, None)
+        except OSError:
+            os.unlink(self.path)
+            raise
+        self.fd = os.open(self.path, os.O_RDONLY)
+
+    def run(self, func, *args, **kwargs):
+        """Run func inside the namespace and return its result"""
+        return self.executor.submit(func, *args, **kwargs).result()
+
+    def sysctl(self, key, value):
+        """Write a sysctl inside the namespace (e.g. net.ipv4.ip_forward=1)"""
+        path = os.path.join('/proc/sys', key.replace('.', '/'))
+
+        def write():
+            with open(path, 'w') as f:
+                f.write(f"{value}\n")
+
+        self.run(write)
+
+    def netlink(self):
+        """Return a netlink socket bound to this namespace (created once)"""
+        if self._netlink is None:
+            from netlink import NetlinkSocket
+            self._netlink = self.run(NetlinkSocket)
+        return self._netlink
+
+    def stale(self):
+        """True if /run/netns/<name> no longer is the namespace we have open
+
+        Only matters to long-lived processes (vpcctld): someone else may
+        have deleted or recreated the namespace since we opened it.
+        """
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return True
+        opened = os.fstat(self.fd)
+        return (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self._netlink is not None:
+            self._netlink.close()
+            self._netlink = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def get_namespace(name):
+    """Return the cached Namespace for name, opening it on first use"""
+    with _lock:
+        ns = _namespaces.get(name)
+        if ns is not None and ns.stale():
+            forget_namespace(name, locked=True)
+            ns = None
+        if ns is None:
+            ns = _namespaces[name] = Namespace(name)
+        return ns
+
+def add_namespace(name):
+    """Create a named namespace without forking `ip netns add`
+
+    Returns False if /run/netns hasn't been set up as a shared mount yet;
+    the caller should let `ip netns add` do that one-time setup.
+    """
+    if not _netns_dir_ready():
+        return False
+    with _lock:
+        forget_namespace(name, locked=True)
+        _namespaces[name] = Namespace(name, created=True)
+    return True
+
+def delete_namespace(name):
+    """Unpin and remove a named namespace (what `ip netns delete` does)"""
+    forget_namespace(name)
+    path = os.path.join(NETNS_RUN_DIR, name)
+    _call_libc('umount2', path.encode(), MNT_DETACH)
+    os.unlink(path)
+
+def forget_namespace(name, locked=False):
+    """Drop the cached worker and fd for a namespace that is going away"""
+    if not locked:
+        with _lock:
+            return forget_namespace(name, locked=True)
+    ns = _namespaces.pop(name, None)
+    if ns:
+        ns.close()
+
+def close_namespaces():
+    """Close every cached namespace (registered to run at exit)"""
+    with _lock:
+        for name in list(_namespaces):
+            forget_namespace(name, locked=True)
+
+atexit.register(close_namespaces)
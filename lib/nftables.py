@@ -0,0 +1,240 @@
+"""
+nftables - Compile firewall policies into an nft ruleset
+
+The iptables engine turns every policy entry into its own rule, so a packet
+walks the list until something matches. Here the same policy becomes:
+
+- one verdict map keyed by (protocol . destination port) with port
+  intervals, e.g. `tcp . 8000-9000 : jump in_2`, looked up once per packet
+- per map entry a short chain of address checks, where consecutive rules
+  with the same action share one interval set of CIDRs
+
+So 2,000 allowed source CIDRs on port 443 is one map lookup plus one set
+lookup, not 2,000 rule evaluations.
+
+Every chain rule carries a counter and a comment naming the policy rules
+it came from, and each base chain ends with a counter for what falls
+through to the default, so metrics.py can read per-rule counters back.
+
+First-match order is kept: the port space is cut into segments at every
+rule boundary, and each segment's chain lists the rules covering it in
+policy order. Rules listed after a catch-all (0.0.0.0/0) can never match
+and are left out. A map entry that comes down to a lone catch-all still
+jumps to a one-rule chain, so its packets are counted like any other rule's.
+
+`protocol: "all"` rules have no map key of their own: they're part of
+every map entry's chain (in policy order) and are checked once more at the
+end of the base chain, for packets no map entry caught.
+
+Everything is loaded with one `nft -f -`, which is a single transaction,
+so it's as atomic as iptables-restore.
+"""
+
+import ipaddress
+from utils import parse_ports, rule_comment
+
+TABLE = 'vpcctl'
+ANY = ipaddress.ip_network('0.0.0.0/0')
+PORT_PROTOCOLS = ('tcp', 'udp')
+
+def _normalize(rules, address_key, target):
+    """Policy rules -> (protocol, (lo, hi) or None, network, verdict, origin)"""
+    normalized = []
+    for i, rule in enumerate(rules):
+        origin = tuple(rule.get('origin', [i + 1]))
+        protocol = rule.get('protocol', 'tcp')
+        port_list = parse_ports(rule.get('port', '*'))
+        if protocol not in PORT_PROTOCOLS:
+            if port_list is not None:
+                raise ValueError(f"Port given for portless protocol {protocol}")
+            port_list = [None]
+        elif port_list is None:
+            port_list = [(0, 65535)]
+        addresses = rule.get(address_key, '0.0.0.0/0')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        verdict = target(rule.get('action', 'allow').upper()).lower()
+        # A rule with several ports/addresses is the same as one rule per
+        # combination, one after the other
+        for ports in port_list:
+            for address in addresses:
+                network = ipaddress.ip_network(address, strict=False)
+                normalized.append((protocol, ports, network, verdict, origin))
+    return normalized
+
+def _runs(rules):
+    """Collapse an ordered rule list into (verdict, networks, origins) runs"""
+    runs = []
+    for _, _, network, verdict, origin in rules:
+        if runs and runs[-1][0] == verdict:
+            runs[-1][1].append(network)
+            runs[-1][2].update(origin)
+        else:
+            runs.append((verdict, [network], set(origin)))
+        if network == ANY:
+            # Nothing after a catch-all is reachable
+            break
+    return tuple(
+        (verdict, tuple(ipaddress.collapse_addresses(networks)), tuple(sorted(origins)))
+        for verdict, networks, origins in runs
+    )
+
+def _segments(ranges):
+    """Cut the port space at every range boundary"""
+    points = sorted({lo for lo, _ in ranges} | {hi + 1 for _, hi in ranges})
+    return [(lo, hi - 1) for lo, hi in zip(points, points[1:])]
+
+class _Direction:
+    """Compiles one direction (ingress or egress) into maps, sets and chains"""
+
+    def __init__(self, direction, prefix, match):
+        self.direction = direction
+        self.prefix = prefix
+        self.match = match
+        self.chains = {}
+        self.port_map = []
+        self.proto_map = []
+        self.fallthrough = None
+
+    def _chain(self, runs):
+        if runs not in self.chains:
+            self.chains[runs] = f"{self.prefix}_{len(self.chains) + 1}"
+        return self.chains[runs]
+
+    def _verdict_for(self, runs):
+        # Even a lone catch-all gets a chain: map elements can't carry the
+        # counter and comment metrics.py reads back
+        return f"jump {self._chain(runs)}"
+
+    def compile(self, rules):
+        protocols = dict.fromkeys(r[0] for r in rules if r[0] != 'all')
+        for protocol in protocols:
+            # 'all' rules match this protocol too, wherever they are in the policy
+            proto_rules = [r for r in rules if r[0] in (protocol, 'all')]
+
+            if protocol not in PORT_PROTOCOLS:
+                self.proto_map.append((protocol, self._verdict_for(_runs(proto_rules))))
+                continue
+
+            ranges = list(dict.fromkeys(r[1] for r in proto_rules if r[0] == protocol))
+            elements = []
+            for lo, hi in _segments(ranges):
+                covering = [r for r in proto_rules
+                            if r[0] == 'all' or r[1][0] <= lo and hi <= r[1][1]]
+                if not any(r[0] == protocol for r in covering):
+                    # Only 'all' rules left, which the fall-through checks anyway
+                    continue
+                verdict = self._verdict_for(_runs(covering))
+                # Neighbouring segments with the same outcome become one interval
+                if elements and elements[-1][2] == verdict and elements[-1][1] == lo - 1:
+                    elements[-1] = (elements[-1][0], hi, verdict)
+                else:
+                    elements.append((lo, hi, verdict))
+
+            for lo, hi, verdict in elements:
+                port = str(lo) if lo == hi else f"{lo}-{hi}"
+                self.port_map.append((f"{protocol} . {port}", verdict))
+
+        # Whatever no map entry caught still has to go through the 'all' rules.
+        # A lone catch-all goes in the base chain as is, where it's counted.
+        any_protocol = [r for r in rules if r[0] == 'all']
+        if any_protocol:
+            runs = _runs(any_protocol)
+            verdict, networks, origins = runs[0]
+            if len(runs) == 1 and networks == (ANY,):
+                self.fallthrough = f'counter {verdict} comment "{rule_comment(self.direction, origins)}"'
+            else:
+                self.fallthrough = f"jump {self._chain(runs)}"
+
+    def render_objects(self):
+        """Sets, maps and jump chains, to go inside the table block"""
+        lines = []
+        for runs, chain in self.chains.items():
+            body = []
+            for i, (verdict, networks, origins) in enumerate(runs):
+                action = f'counter {verdict} comment "{rule_comment(self.direction, origins)}"'
+                if networks == (ANY,):
+                    body.append(f"        {action}")
+                elif len(networks) == 1:
+                    body.append(f"        {self.match} {networks[0]} {action}")
+                else:
+                    set_name = f"{chain}_{i}"
+                    elements = ', '.join(str(n) for n in networks)
+                    lines.append(f"    set {set_name} {{")
+                    lines.append("        type ipv4_addr; flags interval")
+                    lines.append(f"        elements = {{ {elements} }}")
+                    lines.append("    }")
+                    body.append(f"        {self.match} @{set_name} {action}")
+            lines.append(f"    chain {chain} {{")
+            lines.extend(body)
+            lines.append("    }")
+
+        if self.port_map:
+            elements = ', '.join(f"{key} : {verdict}" for key, verdict in self.port_map)
+            lines.append(f"    map {self.prefix}_ports {{")
+            lines.append("        type inet_proto . inet_service : verdict; flags interval")
+            lines.append(f"        elements = {{ {elements} }}")
+            lines.append("    }")
+        if self.proto_map:
+            elements = ', '.join(f"{key} : {verdict}" for key, verdict in self.proto_map)
+            lines.append(f"    map {self.prefix}_protos {{")
+            lines.append("        type inet_proto : verdict")
+            lines.append(f"        elements = {{ {elements} }}")
+            lines.append("    }")
+        return lines
+
+    def render_lookups(self):
+        """The rules that go in the base chain"""
+        lines = []
+        if self.port_map:
+            lines.append(f"        meta l4proto . th dport vmap @{self.prefix}_ports")
+        if self.proto_map:
+            lines.append(f"        meta l4proto vmap @{self.prefix}_protos")
+        if self.fallthrough:
+            lines.append(f"        {self.fallthrough}")
+        # Counts whatever is left for the chain policy
+        lines.append(f'        counter comment "{rule_comment(self.direction, "default")}"')
+        return lines
+
+def compile_policy(policy, target):
+    """Compile a policy into an `nft -f` payload that replaces the vpcctl table
+
+    target maps a policy action ('ALLOW', 'DENY') to 'ACCEPT' or 'DROP'.
+    """
+    ingress = _Direction('ingress', 'in', 'ip saddr')
+    ingress.compile(_normalize(policy.get('ingress', []), 'source', target))
+    egress = _Direction('egress', 'out', 'ip daddr')
+    egress.compile(_normalize(policy.get('egress', []), 'destination', target))
+
+    lines = [
+        # Declaring the table first makes the delete safe when it doesn't exist yet
+        f"table ip {TABLE}",
+        f"delete table ip {TABLE}",
+        f"table ip {TABLE} {{",
+    ]
+    lines += ingress.render_objects()
+    lines += egress.render_objects()
+    lines += [
+        "    chain input {",
+        "        type filter hook input priority 0; policy drop;",
+        "        ct state established,related accept",
+        "        iif lo accept",
+    ]
+    lines += ingress.render_lookups()
+    lines += [
+        "    }",
+        "    chain forward {",
+        "        type filter hook forward priority 0; policy drop;",
+        "    }",
+        "    chain output {",
+        "        type filter hook output priority 0; policy accept;",
+        "        ct state established,related accept",
+        "        oif lo accept",
+    ]
+    lines += egress.render_lookups()
+    lines += ["    }", "}"]
+    return '\n'.join(lines) + '\n'
+
+def delete_payload():
+    """`nft -f` payload that removes the vpcctl table (if it's there)"""
+    return f"table ip {TABLE}\ndelete table ip {TABLE}\n"
@@ -2,34 +2,44 @@
 Peering Manager - Handles VPC peering connections
 """
 
-from utils import run_command, load_vpc_state, save_vpc_state
+from utils import get_bridge_ip
+from backends import get_backend
+from state_store import get_store
 import ipaddress
+from tracing import traced
+
+def peered_cidrs(store, vpc_name):
+    """CIDRs of every VPC peered with vpc_name (what its subnets need routes to)"""
+    cidrs = []
+    for peering in store.list_peerings(vpc_name):
+        other = peering['vpc2'] if peering['vpc1'] == vpc_name else peering['vpc1']
+        cidrs.append(store.get_vpc(other)['cidr'])
+    return cidrs
 
 class PeeringManager:
-    def __init__(self, logger):
+    def __init__(self, logger, backend=None):
         self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
 
+    @traced
     def peer_vpcs(self, vpc1_name, vpc2_name):
         """Create a peering connection between two VPCs"""
         self.logger.info(f"Creating peering connection: {vpc1_name} <-> {vpc2_name}")
         
-        state = load_vpc_state()
+        vpc1 = self.store.get_vpc(vpc1_name, subnets=True)
+        vpc2 = self.store.get_vpc(vpc2_name, subnets=True)
         
         # Validate VPCs exist
-        if vpc1_name not in state['vpcs']:
+        if vpc1 is None:
             raise ValueError(f"VPC {vpc1_name} does not exist")
         
-        if vpc2_name not in state['vpcs']:
+        if vpc2 is None:
             raise ValueError(f"VPC {vpc2_name} does not exist")
         
-        vpc1 = state['vpcs'][vpc1_name]
-        vpc2 = state['vpcs'][vpc2_name]
-        
         # Check if peering already exists
-        for peering in state.get('peerings', []):
-            if (peering['vpc1'] == vpc1_name and peering['vpc2'] == vpc2_name) or \
-               (peering['vpc1'] == vpc2_name and peering['vpc2'] == vpc1_name):
-                raise ValueError(f"Peering already exists between {vpc1_name} and {vpc2_name}")
+        if self.store.get_peering(vpc1_name, vpc2_name):
+            raise ValueError(f"Peering already exists between {vpc1_name} and {vpc2_name}")
         
         # Check for CIDR overlap
         cidr1 = ipaddress.ip_network(vpc1['cidr'], strict=False)
@@ -47,73 +57,46 @@ class PeeringManager:
         veth2 = f"peer2-{peer_hash}"
         
         self.logger.info(f"Creating veth pair: {veth1} <-> {veth2}")
-        run_command(f"ip link add {veth1} type veth peer name {veth2}")
+        batch = self.backend.batch()
+        owner = f"peering {vpc1_name}-{vpc2_name}"
+        batch.add_veth(veth1, veth2, owner)
         
         # Attach to bridges
         bridge1 = vpc1['bridge']
         bridge2 = vpc2['bridge']
         
         self.logger.info(f"Attaching {veth1} to {bridge1}")
-        run_command(f"ip link set {veth1} master {bridge1}")
-        run_command(f"ip link set {veth1} up")
+        batch.set_link(veth1, owner, up=True, master=bridge1)
         
         self.logger.info(f"Attaching {veth2} to {bridge2}")
-        run_command(f"ip link set {veth2} master {bridge2}")
-        run_command(f"ip link set {veth2} up")
-        
-        # Add routes for each subnet in the VPCs
-        # This creates a full mesh - might want to make this configurable later
-        for subnet1_name, subnet1_data in vpc1['subnets'].items():
-            for subnet2_name, subnet2_data in vpc2['subnets'].items():
-                # Add route from subnet1 to subnet2
-                ns1 = subnet1_data['namespace']
-                cidr2 = subnet2_data['cidr']
-                
-                self.logger.info(f"Adding route: {ns1} -> {cidr2} via {bridge1}")
-                run_command(
-                    f"ip netns exec {ns1} ip route add {cidr2} via {subnet1_data['ip'].rsplit('.', 1)[0]}.1",
-                    check=False
-                )
-                
-                # Add route from subnet2 to subnet1
-                ns2 = subnet2_data['namespace']
-                cidr1 = subnet1_data['cidr']
-                
-                self.logger.info(f"Adding route: {ns2} -> {cidr1} via {bridge2}")
-                run_command(
-                    f"ip netns exec {ns2} ip route add {cidr1} via {subnet2_data['ip'].rsplit('.', 1)[0]}.1",
-                    check=False
-                )
+        batch.set_link(veth2, owner, up=True, master=bridge2)
+        batch.commit()
         
-        # Store peering info
-        if 'peerings' not in state:
-            state['peerings'] = []
+        # One summarized route to the other VPC's CIDR per namespace, instead
+        # of a route per subnet pair. Subnets created later pick the route up
+        # in create_subnet (see peered_cidrs), deleted ones take it with them.
+        self.logger.info(f"Adding route to {vpc2['cidr']} in {len(vpc1['subnets'])} subnet(s) of {vpc1_name}")
+        self._program_routes(vpc1, vpc2['cidr'], add=True)
+        self.logger.info(f"Adding route to {vpc1['cidr']} in {len(vpc2['subnets'])} subnet(s) of {vpc2_name}")
+        self._program_routes(vpc2, vpc1['cidr'], add=True)
         
-        state['peerings'].append({
+        # Store peering info
+        self.store.add_peering({
             'vpc1': vpc1_name,
             'vpc2': vpc2_name,
             'veth1': veth1,
             'veth2': veth2
         })
         
-        save_vpc_state(state)
-        
         self.logger.info(f"✓ Peering connection created successfully")
         self.logger.info(f"  {vpc1_name} ({vpc1['cidr']}) <-> {vpc2_name} ({vpc2['cidr']})")
 
+    @traced
     def unpeer_vpcs(self, vpc1_name, vpc2_name):
         """Remove peering connection between two VPCs"""
         self.logger.info(f"Removing peering connection: {vpc1_name} <-> {vpc2_name}")
         
-        state = load_vpc_state()
-        
-        # Find peering
-        peering = None
-        for p in state.get('peerings', []):
-            if (p['vpc1'] == vpc1_name and p['vpc2'] == vpc2_name) or \
-               (p['vpc1'] == vpc2_name and p['vpc2'] == vpc1_name):
-                peering = p
-                break
+        peering = self.store.get_peering(vpc1_name, vpc2_name)
         
         if not peering:
             raise ValueError(f"No peering exists between {vpc1_name} and {vpc2_name}")
@@ -121,41 +104,42 @@ class PeeringManager:
         # Delete veth pair
         veth1 = peering['veth1']
         self.logger.info(f"Deleting veth pair: {veth1}")
-        run_command(f"ip link delete {veth1}", check=False)
+        batch = self.backend.batch()
+        batch.delete_link(veth1, f"peering {vpc1_name}-{vpc2_name}", check=False)
+        batch.commit()
         
         # Remove routes
-        vpc1 = state['vpcs'][peering['vpc1']]
-        vpc2 = state['vpcs'][peering['vpc2']]
-        
-        for subnet1_name, subnet1_data in vpc1['subnets'].items():
-            for subnet2_name, subnet2_data in vpc2['subnets'].items():
-                # Remove route from subnet1 to subnet2
-                ns1 = subnet1_data['namespace']
-                cidr2 = subnet2_data['cidr']
-                
-                run_command(
-                    f"ip netns exec {ns1} ip route del {cidr2}",
-                    check=False
-                )
-                
-                # Remove route from subnet2 to subnet1
-                ns2 = subnet2_data['namespace']
-                cidr1 = subnet1_data['cidr']
-                
-                run_command(
-                    f"ip netns exec {ns2} ip route del {cidr1}",
-                    check=False
-                )
+        vpc1 = self.store.get_vpc(peering['vpc1'], subnets=True)
+        vpc2 = self.store.get_vpc(peering['vpc2'], subnets=True)
+        
+        self._program_routes(vpc1, vpc2['cidr'], add=False)
+        self._program_routes(vpc2, vpc1['cidr'], add=False)
         
         # Remove from state
-        state['peerings'].remove(peering)
-        save_vpc_state(state)
+        self.store.delete_peering(vpc1_name, vpc2_name)
         
         self.logger.info(f"✓ Peering connection removed successfully")
 
+    def _program_routes(self, vpc, remote_cidr, add=True):
+        """Add or remove the route to a peered VPC's CIDR in every subnet of vpc"""
+        gateway_ip = get_bridge_ip(vpc['cidr'])
+        
+        for subnet_name, subnet in vpc['subnets'].items():
+            ns_name = subnet['namespace']
+            owner = f"route {remote_cidr} ({ns_name})"
+            batch = self.backend.batch(ns_name)
+            if add:
+                batch.add_route(remote_cidr, owner, via=gateway_ip, dev=subnet['veth_ns'],
+                                onlink=True, check=False)
+            else:
+                batch.delete_route(remote_cidr, owner, check=False)
+            for failure in batch.commit():
+                self.logger.warning(f"{failure['owner']}: {failure['error']}")
+
+    @traced
     def list_peerings(self):
         """List all VPC peerings"""
-        state = load_vpc_state()
+        state = self.store.load()
         
         if not state.get('peerings'):
             print("No VPC peerings found")
@@ -0,0 +1,372 @@
+"""
+Perf - `vpcctl perf`: what the data plane delivers between two subnets
+
+Starts a socket sink in the destination subnet's namespace and a sender
+with N parallel streams in the source's. The paths worth measuring are
+the ones vpcctl builds:
+
+- subnet to subnet on the same bridge
+- subnet to a peered VPC's subnet, over the peer1-/peer2- veths
+- subnet out through the host's MASQUERADE: point --to at a sink started
+  elsewhere with `vpcctl perf --serve`
+
+Two phases. Throughput: the streams send as fast as they can for
+--duration seconds. The sink counts what arrives, so UDP loss shows, and
+reports it back. Gbit/s comes from bytes received. Packets/s comes from
+the datagrams received (UDP), or from the packets the source's host-side
+veth took in (TCP, whose segments the sockets don't see; with GSO a
+packet there can be up to 64K). Latency: one
+connection bounces small messages off the sink, giving p50/p99/max.
+
+Sockets are opened inside the namespaces through the backend (a socket
+stays in the namespace it was created in), so the sink and the sender
+are threads of this process and nothing is forked. The simulated kernel
+carries no traffic, so perf needs a real backend.
+
+Wire format, so `--serve` works with any vpcctl on the other end:
+
+- TCP: each connection starts with one byte. b'S' means stream: the sink
+  reads until EOF and answers with the byte count (8 bytes, network order).
+  b'E' means echo: every ECHO_SIZE-byte message is sent back.
+- UDP: datagrams start with a byte as well. b'Z' resets the counters,
+  b'S' is data, b'E' is echoed back and b'R' is answered with
+  b'R' + (datagrams, bytes) received since the reset.
+"""
+
+import json
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from backends import get_backend
+from state_store import get_store
+from tracing import traced
+
+DEFAULT_PORT = 5201
+CHUNK = 128 * 1024
+UDP_PAYLOAD = 1472           # fills a 1500-byte MTU
+ECHO_SIZE = 64
+LATENCY_SECONDS = 2
+LATENCY_ROUNDS = 10000
+REPORT = struct.Struct('!QQ')
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _read_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("peer closed the connection")
+        data += chunk
+    return data
+
+class Sink:
+    """TCP and UDP sink on one port, served from background threads"""
+
+    def __init__(self, tcp, udp):
+        self.tcp, self.udp = tcp, udp
+        self.udp_counts = [0, 0]
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @classmethod
+    def listen(cls, open_socket, address, port=0):
+        """Bind both sockets (port 0: any free one, the same for TCP and UDP)"""
+        tcp = open_socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        tcp.bind((address, port))
+        tcp.listen(64)
+        udp = open_socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        udp.bind((address, tcp.getsockname()[1]))
+        return cls(tcp, udp)
+
+    @property
+    def port(self):
+        return self.tcp.getsockname()[1]
+
+    def start(self):
+        for target in (self._accept, self._datagrams):
+            threading.Thread(target=target, name='perf-sink', daemon=True).start()
+        return self
+
+    def close(self):
+        self._closed = True
+        self.tcp.close()
+        self.udp.close()
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._connection, args=(conn,), name='perf-conn',
+                             daemon=True).start()
+
+    def _connection(self, conn):
+        with conn:
+            try:
+                mode = _read_exactly(conn, 1)
+                if mode == b'S':
+                    received = 0
+                    buffer = bytearray(CHUNK)
+                    while True:
+                        n = conn.recv_into(buffer)
+                        if not n:
+                            break
+                        received += n
+                    conn.sendall(struct.pack('!Q', received))
+                elif mode == b'E':
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    while True:
+                        conn.sendall(_read_exactly(conn, ECHO_SIZE))
+            except (OSError, ConnectionError):
+                pass
+
+    def _datagrams(self):
+        buffer = bytearray(65536)
+        while not self._closed:
+            try:
+                n, peer = self.udp.recvfrom_into(buffer)
+            except OSError:
+                return
+            kind = buffer[:1]
+            if kind == b'S':
+                with self._lock:
+                    self.udp_counts[0] += 1
+                    self.udp_counts[1] += n
+            elif kind == b'E':
+                self.udp.sendto(buffer[:n], peer)
+            elif kind == b'Z':
+                with self._lock:
+                    self.udp_counts = [0, 0]
+                self.udp.sendto(b'Z', peer)
+            elif kind == b'R':
+                with self._lock:
+                    report = REPORT.pack(*self.udp_counts)
+                self.udp.sendto(b'R' + report, peer)
+
+class PerfRunner:
+    def __init__(self, logger, backend=None):
+        self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
+
+    def _endpoint(self, spec):
+        """'vpc/subnet' -> the subnet's record"""
+        vpc_name, _, subnet_name = spec.partition('/')
+        if not subnet_name:
+            raise ValueError(f"Expected vpc/subnet, got {spec!r}")
+        subnet = self.store.get_subnet(vpc_name, subnet_name)
+        if subnet is None:
+            raise ValueError(f"Subnet {spec} does not exist")
+        return subnet
+
+    @traced
+    def run(self, source, destination, protocol='tcp', streams=4, duration=10, size=None):
+        """Measure source -> destination; returns the results dict
+
+        destination is a vpc/subnet (a sink is started there) or the
+        host:port of a sink started with --serve.
+        """
+        if protocol not in ('tcp', 'udp'):
+            raise ValueError(f"Unknown protocol: {protocol}")
+        if streams < 1 or duration <= 0:
+            raise ValueError("--streams and --duration must be positive")
+        src = self._endpoint(source)
+        size = size or (UDP_PAYLOAD if protocol == 'udp' else CHUNK)
+        if protocol == 'udp' and not 1 <= size <= 65507:
+            raise ValueError("UDP datagrams carry 1 to 65507 bytes")
+
+        sink = None
+        if '/' in destination:
+            dst = self._endpoint(destination)
+            sink = Sink.listen(self._opener(dst['namespace']), dst['ip']).start()
+            address = (dst['ip'], sink.port)
+        else:
+            host, _, port = destination.rpartition(':')
+            address = (host or destination, int(port) if host else DEFAULT_PORT)
+
+        self.logger.info(f"perf {source} -> {destination}: {protocol.upper()}, {streams} stream(s), "
+                         f"{duration}s")
+        opener = self._opener(src['namespace'])
+        try:
+            before = self.backend.interface_stats().get(src['veth_host'], {})
+            if protocol == 'tcp':
+                received, seconds = self._tcp_stream(opener, address, streams, duration, size)
+                packets = None
+            else:
+                received, packets, sent, seconds = self._udp_stream(opener, address, streams,
+                                                                    duration, size)
+            after = self.backend.interface_stats().get(src['veth_host'], {})
+            latencies = self._latency(opener, address, protocol)
+        finally:
+            if sink:
+                sink.close()
+
+        if packets is None and 'receive_packets' in after:
+            # Segments the host side of the source's veth took in
+            packets = after['receive_packets'] - before.get('receive_packets', 0)
+        results = {
+            'from': source, 'to': destination, 'protocol': protocol, 'streams': streams,
+            'duration': round(seconds, 3), 'size': size, 'backend': self.backend.name,
+            'bytes': received,
+            'gbit_per_second': round(received * 8 / seconds / 1e9, 4),
+            'packets_per_second': None if packets is None else round(packets / seconds),
+            'latency_ms': latencies,
+        }
+        if protocol == 'udp':
+            results['datagrams_sent'] = sent
+            results['loss'] = round(1 - packets / sent, 4) if sent else None
+        return results
+
+    def _opener(self, namespace):
+        return lambda family, kind: self.backend.socket(namespace, family, kind)
+
+    def _tcp_stream(self, opener, address, streams, duration, size):
+        payload = b'\0' * size
+
+        def stream():
+            sock = opener(socket.AF_INET, socket.SOCK_STREAM)
+            with sock:
+                sock.connect(address)
+                sock.sendall(b'S')
+                deadline = time.monotonic() + duration
+                while time.monotonic() < deadline:
+                    sock.sendall(payload)
+                sock.shutdown(socket.SHUT_WR)
+                return struct.unpack('!Q', _read_exactly(sock, 8))[0]
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=streams, thread_name_prefix='perf-stream') as pool:
+            counts = [f.result() for f in [pool.submit(stream) for _ in range(streams)]]
+        # The counts are only in once everything sent has been read
+        return sum(counts), time.monotonic() - started
+
+    def _udp_stream(self, opener, address, streams, duration, size):
+        control = opener(socket.AF_INET, socket.SOCK_DGRAM)
+        control.settimeout(1)
+        with control:
+            self._udp_control(control, address, b'Z')
+            payload = b'S' + b'\0' * (size - 1)
+
+            def stream():
+                sock = opener(socket.AF_INET, socket.SOCK_DGRAM)
+                sent = 0
+                with sock:
+                    deadline = time.monotonic() + duration
+                    while time.monotonic() < deadline:
+                        try:
+                            sock.sendto(payload, address)
+                            sent += 1
+                        except OSError:
+                            # ENOBUFS: the queue is full, let it drain
+                            time.sleep(0.0001)
+                return sent
+
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=streams, thread_name_prefix='perf-stream') as pool:
+                sent = sum(f.result() for f in [pool.submit(stream) for _ in range(streams)])
+            seconds = time.monotonic() - started
+            # Let the last datagrams land
+            time.sleep(0.2)
+            datagrams, received = REPORT.unpack(self._udp_control(control, address, b'R')[1:])
+        return received, datagrams, sent, seconds
+
+    def _udp_control(self, sock, address, kind):
+        for _ in range(5):
+            sock.sendto(kind, address)
+            try:
+                reply, _ = sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            if reply[:1] == kind:
+                return reply
+        raise Exception(f"No answer from the perf sink at {address[0]}:{address[1]}")
+
+    def _latency(self, opener, address, protocol):
+        """p50/p99/max of round trips of one ECHO_SIZE-byte message"""
+        message = b'E' + b'\0' * (ECHO_SIZE - 1)
+        rtts = []
+        if protocol == 'tcp':
+            sock = opener(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.connect(address)
+            sock.sendall(b'E')
+        else:
+            sock = opener(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(1)
+        with sock:
+            deadline = time.monotonic() + LATENCY_SECONDS
+            while time.monotonic() < deadline and len(rtts) < LATENCY_ROUNDS:
+                started = time.perf_counter()
+                if protocol == 'tcp':
+                    sock.sendall(message)
+                    _read_exactly(sock, ECHO_SIZE)
+                else:
+                    sock.sendto(message, address)
+                    try:
+                        sock.recvfrom(ECHO_SIZE)
+                    except socket.timeout:
+                        continue
+                rtts.append((time.perf_counter() - started) * 1000)
+        if not rtts:
+            return None
+        rtts.sort()
+        return {'p50': round(_percentile(rtts, 0.5), 4), 'p99': round(_percentile(rtts, 0.99), 4),
+                'max': round(rtts[-1], 4), 'samples': len(rtts)}
+
+def print_results(results):
+    latency = results['latency_ms']
+    pps = results['packets_per_second']
+    print(f"\nvpcctl perf: {results['from']} -> {results['to']} ({results['protocol'].upper()}, "
+          f"{results['streams']} stream(s), {results['backend']} backend)")
+    print("=" * 80)
+    print(f"  Throughput:  {results['gbit_per_second']:.3f} Gbit/s "
+          f"({results['bytes'] / 1024 ** 2:.1f} MiB in {results['duration']:.2f}s)")
+    print(f"  Packets/s:   {'-' if pps is None else f'{pps:,}'}")
+    if 'loss' in results:
+        loss = '-' if results['loss'] is None else f"{results['loss']:.2%}"
+        print(f"  UDP loss:    {loss} of {results['datagrams_sent']:,} datagrams")
+    if latency:
+        print(f"  Latency:     p50 {latency['p50']:.3f} ms, p99 {latency['p99']:.3f} ms, "
+              f"max {latency['max']:.3f} ms ({latency['samples']} round trips)")
+    else:
+        print("  Latency:     no echo came back")
+    print("=" * 80)
+
+def run_perf(logger, source, destination, protocol='tcp', streams=4, duration=10, size=None,
+             output=None, as_json=False):
+    """`vpcctl perf`"""
+    results = PerfRunner(logger).run(source, destination, protocol, streams, duration, size)
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Results written to {output}")
+
+def serve(logger, listen, subnet=None):
+    """`vpcctl perf --serve`: run a sink until interrupted"""
+    backend = get_backend()
+    host, _, port = listen.rpartition(':')
+    namespace = None
+    if subnet:
+        namespace = PerfRunner(logger, backend)._endpoint(subnet)['namespace']
+    sink = Sink.listen(lambda family, kind: backend.socket(namespace, family, kind),
+                       host or '0.0.0.0', int(port)).start()
+    logger.info(f"perf sink listening on {host or '0.0.0.0'}:{sink.port} (TCP and UDP)"
+                f"{f' in {subnet}' if subnet else ''}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.close()
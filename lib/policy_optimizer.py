@@ -0,0 +1,275 @@
+"""
+Policy Optimizer - Shrink a firewall policy without changing what it does
+
+Runs between loading a policy and compiling it. Rules are evaluated first
+match wins, so every step only moves or merges a rule when no rule it
+jumps over could have matched the same packets with a different action:
+
+1. shadowed rules go: a rule fully covered by an earlier one never matches,
+   and a rule that just repeats the default (DENY on ingress, ALLOW on
+   egress) changes nothing unless it's guarding a later, overlapping rule
+2. rules with the same action, protocol and ports are merged and their
+   CIDRs collapsed (10.0.0.0/25 + 10.0.0.128/25 -> 10.0.0.0/24)
+3. rules with the same action, protocol and sources are merged and their
+   ports coalesced into ranges / multiport lists (80, 81, 82 -> "80-82")
+4. within a run of rules that share an action (so order between them can't
+   matter) the cheapest matches go first
+
+reorder_policy() is the profile-guided version of step 4, used by
+`vpcctl tune-policy`: given hit counts per rule it moves hot rules up as
+far as the same first-match constraint allows.
+
+The output is the same JSON format, except that `port` and `source` /
+`destination` may now be lists (both firewall engines understand that) and
+every rule has an `origin`: the positions (1-based) of the rules it was
+made from, which end up in the rule comments that counters are read back
+by (see metrics.py).
+"""
+
+import ipaddress
+from utils import parse_ports
+
+ALL_PORTS = ((0, 65535),)
+PORT_PROTOCOLS = ('tcp', 'udp')
+
+# What a packet gets when no rule matches (see FirewallManager._compile_ruleset)
+DEFAULT_ACTIONS = {'ingress': 'DENY', 'egress': 'ALLOW'}
+ADDRESS_KEYS = {'ingress': 'source', 'egress': 'destination'}
+
+def _merge_intervals(intervals):
+    merged = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(hi, merged[-1][1]))
+        else:
+            merged.append((lo, hi))
+    return tuple(merged)
+
+class _Rule:
+    def __init__(self, protocol, ports, networks, action, extra, origins):
+        self.protocol = protocol
+        # None for protocols without ports, otherwise merged (lo, hi) intervals
+        self.ports = ports
+        self.networks = tuple(ipaddress.collapse_addresses(networks))
+        self.action = action
+        # Keys we don't optimize (descriptions etc.) ride along untouched
+        self.extra = extra
+        self.origins = tuple(sorted(set(origins)))
+
+    @classmethod
+    def parse(cls, rule, address_key, position):
+        protocol = rule.get('protocol', 'tcp')
+        ports = parse_ports(rule.get('port', '*'))
+        if protocol in PORT_PROTOCOLS:
+            ports = _merge_intervals(ports) if ports else ALL_PORTS
+        elif ports is not None:
+            raise ValueError(f"Port given for portless protocol {protocol}")
+        addresses = rule.get(address_key, '0.0.0.0/0')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        networks = [ipaddress.ip_network(a, strict=False) for a in addresses]
+        action = rule.get('action', 'allow').upper()
+        extra = {k: v for k, v in rule.items()
+                 if k not in ('protocol', 'port', 'action', 'origin', address_key)}
+        # Re-optimizing an optimized policy keeps pointing at the original rules
+        return cls(protocol, ports, networks, action, extra, rule.get('origin', [position]))
+
+    def covers(self, other):
+        """True if every packet other matches, this rule matches too"""
+        # 'all' covers every protocol, but nothing but 'all' covers 'all'
+        if self.protocol not in (other.protocol, 'all'):
+            return False
+        # No ports on this rule (icmp, all) means any port
+        if self.ports is not None and not all(
+                any(lo <= olo and ohi <= hi for lo, hi in self.ports)
+                for olo, ohi in other.ports):
+            return False
+        return all(any(n.subnet_of(mine) for mine in self.networks) for n in other.networks)
+
+    def overlaps(self, other):
+        if self.protocol != other.protocol and 'all' not in (self.protocol, other.protocol):
+            return False
+        if self.ports is not None and other.ports is not None and not any(
+                lo <= ohi and olo <= hi for lo, hi in self.ports for olo, ohi in other.ports):
+            return False
+        return any(a.overlaps(b) for a in self.networks for b in other.networks)
+
+    def cost(self):
+        """Rough evaluation cost: number of port and address comparisons"""
+        return len(self.ports or ()) + len(self.networks)
+
+    def render(self, address_key):
+        rule = dict(self.extra)
+        rule['protocol'] = self.protocol
+        if self.ports is not None:
+            ports = [str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in self.ports]
+            if self.ports == ALL_PORTS:
+                rule['port'] = '*'
+            elif len(ports) == 1:
+                rule['port'] = int(ports[0]) if ports[0].isdigit() else ports[0]
+            else:
+                rule['port'] = [int(p) if p.isdigit() else p for p in ports]
+        rule['action'] = self.action.lower()
+        addresses = [str(n) for n in self.networks]
+        rule[address_key] = addresses[0] if len(addresses) == 1 else addresses
+        rule['origin'] = list(self.origins)
+        return rule
+
+def _can_move_up(rules, i, j):
+    """Can rule j jump ahead to position i without changing any verdict?"""
+    rule = rules[j]
+    return all(
+        other.action == rule.action or not other.overlaps(rule)
+        for other in rules[i + 1:j]
+    )
+
+def _drop_shadowed(rules, default_action):
+    kept = []
+    for rule in rules:
+        if not any(earlier.covers(rule) for earlier in kept):
+            kept.append(rule)
+    # A rule that does what the default would do anyway is only needed to
+    # keep packets away from a later rule with another action
+    result = []
+    for i, rule in enumerate(kept):
+        if rule.action == default_action and not any(
+                later.action != rule.action and later.overlaps(rule) for later in kept[i + 1:]):
+            continue
+        result.append(rule)
+    return result
+
+def _merge(rules, same_key, combine):
+    """Fold each rule into the earliest compatible rule it can safely move up to"""
+    merged = []
+    for rule in rules:
+        merged.append(rule)
+        j = len(merged) - 1
+        for i in range(j):
+            target = merged[i]
+            if (target.action == rule.action and target.protocol == rule.protocol
+                    and same_key(target) == same_key(rule) and _can_move_up(merged, i, j)):
+                merged[i] = combine(target, rule)
+                merged.pop()
+                break
+    return merged
+
+def _order_runs(rules):
+    """Cheapest first within each run of same-action rules"""
+    ordered, run = [], []
+    for rule in rules:
+        if run and run[-1].action != rule.action:
+            ordered += sorted(run, key=_Rule.cost)
+            run = []
+        run.append(rule)
+    return ordered + sorted(run, key=_Rule.cost)
+
+def _optimize_rules(rules, direction):
+    default_action = DEFAULT_ACTIONS[direction]
+    rules = _drop_shadowed(rules, default_action)
+
+    rules = _merge(
+        rules, lambda r: r.ports,
+        lambda a, b: _Rule(a.protocol, a.ports, a.networks + b.networks, a.action, a.extra,
+                           a.origins + b.origins)
+    )
+    rules = _merge(
+        rules, lambda r: r.networks,
+        lambda a, b: _Rule(a.protocol, _merge_intervals(a.ports + b.ports) if a.ports else None,
+                           a.networks, a.action, a.extra, a.origins + b.origins)
+    )
+    # Merging can produce a rule that now covers a later one
+    rules = _drop_shadowed(rules, default_action)
+    return _order_runs(rules)
+
+def optimize_policy(policy):
+    """Return (optimized policy, {direction: (rules before, rules after)})"""
+    optimized = dict(policy)
+    stats = {}
+    for direction, address_key in ADDRESS_KEYS.items():
+        if direction not in policy:
+            continue
+        original = policy[direction]
+        rules = [_Rule.parse(rule, address_key, i + 1) for i, rule in enumerate(original)]
+        rules = _optimize_rules(rules, direction)
+        optimized[direction] = [rule.render(address_key) for rule in rules]
+        stats[direction] = (len(original), len(rules))
+    return optimized, stats
+
+def _origin_key(rule):
+    """A compiled rule's origin as it appears in its counter comment ('1,3')"""
+    return ','.join(str(o) for o in rule.origins)
+
+def _hit_order(rules, hits):
+    """Hottest-first order that keeps every overlapping allow/deny pair in place
+
+    Rule j has to stay behind rule i (i < j) when they overlap with
+    different actions. Among the rules whose predecessors are all placed,
+    always take the one with the most hits (ties keep policy order).
+    """
+    blockers = [
+        {i for i in range(j) if rules[i].action != rules[j].action and rules[i].overlaps(rules[j])}
+        for j in range(len(rules))
+    ]
+    placed, order = set(), []
+    while len(order) < len(rules):
+        ready = [j for j in range(len(rules)) if j not in placed and blockers[j] <= placed]
+        best = max(ready, key=lambda j: (hits.get(_origin_key(rules[j]), 0), -j))
+        placed.add(best)
+        order.append(best)
+    return [rules[j] for j in order]
+
+def _expected_cost(rules, hits, default_hits):
+    """Rule evaluations needed for the sampled traffic: a hit on the n-th rule costs n"""
+    cost = sum(hits.get(_origin_key(rule), 0) * (i + 1) for i, rule in enumerate(rules))
+    # Packets that match nothing walk the whole list whatever the order
+    return cost + default_hits * len(rules)
+
+def reorder_policy(policy, hits):
+    """Reorder a compiled policy by hit counts
+
+    hits is {direction: {origin key: hits}}, with 'default' for traffic
+    that matched no rule. Returns (policy, {direction: (cost before, cost
+    after)}) where cost is the number of rule evaluations the sampled
+    traffic would need.
+    """
+    reordered = dict(policy)
+    costs = {}
+    for direction, address_key in ADDRESS_KEYS.items():
+        if direction not in policy:
+            continue
+        rules = [_Rule.parse(rule, address_key, i + 1) for i, rule in enumerate(policy[direction])]
+        direction_hits = hits.get(direction, {})
+        default_hits = direction_hits.get('default', 0)
+
+        ordered = _hit_order(rules, direction_hits)
+        before = _expected_cost(rules, direction_hits, default_hits)
+        after = _expected_cost(ordered, direction_hits, default_hits)
+        if after > before:
+            # Greedy isn't always optimal with constraints; never make it worse
+            ordered, after = rules, before
+        reordered[direction] = [rule.render(address_key) for rule in ordered]
+        costs[direction] = (before, after)
+    return reordered, costs
+
+def policy_order(policy):
+    """{direction: [origin keys]}: the rule order of a compiled policy, for the state"""
+    return {
+        direction: [_origin_key(_Rule.parse(rule, address_key, i + 1))
+                    for i, rule in enumerate(policy[direction])]
+        for direction, address_key in ADDRESS_KEYS.items() if direction in policy
+    }
+
+def apply_order(policy, order):
+    """Put a compiled policy's rules back in a recorded order
+
+    Directions whose rules don't match the recording (the policy changed
+    since) are left alone.
+    """
+    ordered = dict(policy)
+    for direction, keys in order.items():
+        rules = policy.get(direction, [])
+        by_key = {','.join(str(o) for o in rule.get('origin', [i + 1])): rule
+                  for i, rule in enumerate(rules)}
+        if sorted(by_key) == sorted(keys) and len(by_key) == len(rules):
+            ordered[direction] = [by_key[key] for key in keys]
+    return ordered
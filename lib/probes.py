@@ -0,0 +1,111 @@
+"""
+Probes - In-process connectivity checks
+
+These run in whatever network namespace their socket was opened in. By
+default that's the calling thread's; to probe from a subnet without forking
+ping, pass a socket opened inside it (backend.socket()) and the probe
+itself can run on any thread.
+"""
+
+import itertools
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+_ids = itertools.count(1)
+_ids_lock = threading.Lock()
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def _echo_request(ident, seq):
+    payload = struct.pack('!d', time.monotonic()) + b'vpcctl'.ljust(48, b'.')
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = _checksum(header + payload)
+    return struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq) + payload
+
+def icmp_echo(sock, address, ident, seq, timeout):
+    """Send one echo request and return the RTT in ms, or None on timeout"""
+    start = time.monotonic()
+    sock.sendto(_echo_request(ident, seq), (address, 0))
+    deadline = start + timeout
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        ready, _, _ = select.select([sock], [], [], remaining)
+        if not ready:
+            return None
+        packet, (source, _) = sock.recvfrom(2048)
+        # Raw ICMP sockets hand us the IP header too
+        ihl = (packet[0] & 0x0f) * 4
+        icmp_type, _, _, reply_id, reply_seq = struct.unpack('!BBHHH', packet[ihl:ihl + 8])
+        if (icmp_type == ICMP_ECHO_REPLY and source == address
+                and reply_id == ident and reply_seq == seq):
+            return (time.monotonic() - start) * 1000
+
+def icmp_ping(address, count=3, timeout=2, sock=None):
+    """Ping an address like `ping -c count -W timeout`; returns (ok, output)
+
+    sock is a raw ICMP socket to use (and close), or None to open one here.
+    """
+    with _ids_lock:
+        ident = (os.getpid() + next(_ids)) & 0xffff
+
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+    lines = [f"PING {address}"]
+    rtts = []
+    try:
+        for seq in range(1, count + 1):
+            rtt = icmp_echo(sock, address, ident, seq, timeout)
+            if rtt is None:
+                lines.append(f"Request timeout for icmp_seq={seq}")
+            else:
+                rtts.append(rtt)
+                lines.append(f"reply from {address}: icmp_seq={seq} time={rtt:.3f} ms")
+    except OSError as e:
+        lines.append(f"ping: {address}: {e.strerror}")
+    finally:
+        sock.close()
+
+    loss = 100 * (count - len(rtts)) // count
+    lines.append(f"{count} packets transmitted, {len(rtts)} received, {loss}% packet loss")
+    if rtts:
+        lines.append(f"rtt min/avg/max = {min(rtts):.3f}/{sum(rtts) / len(rtts):.3f}/{max(rtts):.3f} ms")
+    return bool(rtts), '\n'.join(lines) + '\n'
+
+def tcp_connect(address, port, timeout=2, sock=None):
+    """Connect to address:port: (reachable, rtt in ms, 'open'/'refused'/why not)
+
+    A refused connection still got an answer back, so the address is
+    reachable; only a timeout or an error means it isn't. sock is a TCP
+    socket to use (and close), or None to open one here.
+    """
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    start = time.monotonic()
+    try:
+        sock.connect((address, port))
+        return True, (time.monotonic() - start) * 1000, 'open'
+    except ConnectionRefusedError:
+        return True, (time.monotonic() - start) * 1000, 'refused'
+    except socket.timeout:
+        return False, None, 'timed out'
+    except OSError as e:
+        return False, None, e.strerror
+    finally:
+        sock.close()
@@ -0,0 +1,135 @@
+"""
+Procs - Find, signal and wait for processes running inside namespaces
+
+Used to stop whatever is running in a subnet before its namespace goes
+away. Instead of `kill -9` followed by a fixed sleep, every process gets a
+pidfd and we poll() those until they've all exited (or the timeout hits),
+so teardown waits exactly as long as the processes take to die.
+
+terminate() is the polite version: SIGTERM first, SIGKILL only for what
+is still running after a grace period. All pids are polled together, so
+stopping twenty apps takes as long as the slowest one, not the sum.
+"""
+
+import os
+import select
+import signal
+import time
+
+NETNS_RUN_DIR = '/run/netns'
+
+def namespace_pids(namespaces):
+    """Map each namespace name to the pids living in it (one /proc scan)"""
+    inodes = {}
+    for name in namespaces:
+        try:
+            st = os.stat(os.path.join(NETNS_RUN_DIR, name))
+        except OSError:
+            continue
+        inodes[(st.st_dev, st.st_ino)] = name
+
+    pids = {name: [] for name in inodes.values()}
+    if not inodes:
+        return pids
+
+    me = os.getpid()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit() or int(entry) == me:
+            continue
+        try:
+            st = os.stat(f"/proc/{entry}/ns/net")
+        except OSError:
+            # Gone already, or a kernel thread
+            continue
+        name = inodes.get((st.st_dev, st.st_ino))
+        if name:
+            pids[name].append(int(entry))
+    return pids
+
+def _stat(pid):
+    """Fields of /proc/<pid>/stat after the command name, or None if it's gone"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The name is in parentheses and can contain anything, spaces included
+            return f.read().rsplit(')', 1)[1].split()
+    except (OSError, IndexError):
+        return None
+
+def start_time(pid):
+    """When pid started, in clock ticks since boot; None if it isn't running
+
+    A pid and its start time together name one process: a recycled pid
+    comes back with a different start time.
+    """
+    fields = _stat(pid)
+    if fields is None or fields[0] == 'Z':
+        return None
+    # Field 22 of stat, the 20th after the name
+    return int(fields[19])
+
+def _exited(pid):
+    """Fallback liveness check for kernels without pidfd"""
+    fields = _stat(pid)
+    # A zombie has exited, it just hasn't been reaped yet
+    return fields is None or fields[0] == 'Z'
+
+def kill_and_wait(pids, sig=signal.SIGKILL, timeout=5):
+    """Signal pids and wait until they exit; returns the ones still running"""
+    pidfds = {}
+    fallback = []
+    for pid in pids:
+        try:
+            fd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            continue
+        except (OSError, AttributeError):
+            fallback.append(pid)
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+            continue
+        try:
+            # Signalling through the pidfd can't hit a recycled pid
+            signal.pidfd_send_signal(fd, sig)
+        except ProcessLookupError:
+            os.close(fd)
+            continue
+        pidfds[fd] = pid
+
+    deadline = time.monotonic() + timeout
+    poller = select.poll()
+    for fd in pidfds:
+        poller.register(fd, select.POLLIN)
+
+    try:
+        # A pidfd becomes readable once its process exits
+        while pidfds:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for fd, _ in poller.poll(remaining * 1000):
+                poller.unregister(fd)
+                os.close(fd)
+                del pidfds[fd]
+
+        while fallback and time.monotonic() < deadline:
+            fallback = [pid for pid in fallback if not _exited(pid)]
+            if fallback:
+                time.sleep(0.01)
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+
+    return sorted(list(pidfds.values()) + fallback)
+
+def terminate(pids, grace=5, timeout=2):
+    """SIGTERM, wait up to grace seconds, then SIGKILL the rest
+
+    Returns the pids still running after that (stuck in the kernel,
+    usually).
+    """
+    survivors = kill_and_wait(pids, sig=signal.SIGTERM, timeout=grace)
+    if survivors:
+        survivors = kill_and_wait(survivors, sig=signal.SIGKILL, timeout=timeout)
+    return survivors
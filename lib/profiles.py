@@ -0,0 +1,122 @@
+"""
+Profiles - Data-plane tuning for a subnet's veth pair and its VPC's bridge
+
+A subnet is created with kernel defaults: MTU 1500, one queue each way,
+a txqueuelen of 1000 and whatever offloads veth starts with. A profile
+changes that, on both ends of the veth pair:
+
+    {
+      "mtu": 9000,                 # jumbo frames
+      "queues": 4,                 # numtxqueues and numrxqueues
+      "txqueuelen": 10000,
+      "offloads": {"gro": true, "gso": true, "tso": true},
+      "bridge": {"multicast_snooping": false, "forward_delay": 0, "stp": false}
+    }
+
+Every key is optional. The bridge options go to the VPC's bridge, which
+all its subnets share. forward_delay is in seconds.
+
+`create-subnet --profile` takes the name of a built-in profile or the path
+of a JSON file like the one above; the settings applied are recorded with
+the subnet.
+"""
+
+import json
+import os
+
+PROFILES = {
+    'default': {},
+    'high-throughput': {
+        'mtu': 9000,
+        'queues': 4,
+        'txqueuelen': 10000,
+        'offloads': {'gro': True, 'gso': True, 'tso': True},
+        'bridge': {'multicast_snooping': False, 'forward_delay': 0},
+    },
+}
+
+OFFLOADS = ('gro', 'gso', 'tso')
+BRIDGE_OPTIONS = ('multicast_snooping', 'forward_delay', 'stp')
+
+# What the kernel accepts for a veth
+MTU_RANGE = (68, 65535)
+MAX_QUEUES = 4096
+
+def _integer(settings, key, low, high):
+    value = settings.get(key)
+    if value is None:
+        return
+    if isinstance(value, bool) or not isinstance(value, int) or not low <= value <= high:
+        raise ValueError(f"Profile {key} must be a whole number from {low} to {high}, not {value!r}")
+
+def validate_profile(settings):
+    """Raise ValueError for anything a profile can't contain"""
+    if not isinstance(settings, dict):
+        raise ValueError("A profile must be a JSON object")
+    unknown = set(settings) - {'description', 'mtu', 'queues', 'txqueuelen', 'offloads', 'bridge'}
+    if unknown:
+        raise ValueError(f"Unknown profile setting(s): {', '.join(sorted(unknown))}")
+
+    _integer(settings, 'mtu', *MTU_RANGE)
+    _integer(settings, 'queues', 1, MAX_QUEUES)
+    _integer(settings, 'txqueuelen', 0, 2 ** 32 - 1)
+
+    offloads = settings.get('offloads', {})
+    if not isinstance(offloads, dict) or set(offloads) - set(OFFLOADS) or \
+       not all(isinstance(v, bool) for v in offloads.values()):
+        raise ValueError(f"Profile offloads must map {', '.join(OFFLOADS)} to true or false")
+
+    bridge = settings.get('bridge', {})
+    if not isinstance(bridge, dict) or set(bridge) - set(BRIDGE_OPTIONS):
+        raise ValueError(f"Profile bridge options are {', '.join(BRIDGE_OPTIONS)}")
+    for key in ('multicast_snooping', 'stp'):
+        if key in bridge and not isinstance(bridge[key], bool):
+            raise ValueError(f"Profile bridge {key} must be true or false")
+    delay = bridge.get('forward_delay', 0)
+    if isinstance(delay, bool) or not isinstance(delay, (int, float)) or delay < 0:
+        raise ValueError(f"Profile bridge forward_delay must be seconds, not {delay!r}")
+
+def load_profile(spec, base_dir=None):
+    """A built-in profile by name or one from a JSON file: {'name': ..., 'settings': ...}
+
+    Relative file paths are taken from base_dir when given.
+    """
+    if spec in PROFILES:
+        return {'name': spec, 'settings': PROFILES[spec]}
+
+    path = os.path.normpath(os.path.join(base_dir, spec)) if base_dir else os.path.abspath(spec)
+    if not os.path.exists(path):
+        raise ValueError(f"Unknown profile {spec} (built in: {', '.join(PROFILES)}; "
+                         f"or the path of a JSON file)")
+    try:
+        with open(path, 'r') as f:
+            settings = json.load(f)
+    except Exception as e:
+        raise ValueError(f"Failed to load profile file: {e}")
+    validate_profile(settings)
+    settings.pop('description', None)
+    return {'name': path, 'settings': settings}
+
+def veth_options(settings):
+    """Link options for both ends of the veth pair, as `ip link add` spells them"""
+    queues = settings.get('queues')
+    options = {
+        'mtu': settings.get('mtu'),
+        'txqueuelen': settings.get('txqueuelen'),
+        'numtxqueues': queues,
+        'numrxqueues': queues,
+    }
+    return {key: value for key, value in options.items() if value is not None}
+
+def bridge_options(settings):
+    """Bridge options as `ip link set ... type bridge` spells them"""
+    bridge = settings.get('bridge', {})
+    options = {}
+    if 'forward_delay' in bridge:
+        # Hundredths of a second
+        options['forward_delay'] = int(round(bridge['forward_delay'] * 100))
+    if 'stp' in bridge:
+        options['stp_state'] = int(bridge['stp'])
+    if 'multicast_snooping' in bridge:
+        options['mcast_snooping'] = int(bridge['multicast_snooping'])
+    return options
@@ -0,0 +1,303 @@
+"""
+Reachability - `vpcctl reachability`: probe every subnet pair at once
+
+test-connectivity checks one pair with a three-packet ping, one pair at a
+time. This probes every source/destination pair of a VPC (or of all VPCs)
+concurrently on a bounded pool, with an ICMP echo or a TCP connect from
+inside the source namespace, and prints the result as a matrix with RTTs.
+
+Every result is compared with what the state says should happen:
+
+- subnets of the same VPC, of peered VPCs and of VPCs on the same transit
+  hub route table reach each other
+- any other pair goes by the host's FORWARD chain (one `iptables-save`):
+  every VPC's bridge is routed by the host, and create-vpc accepts
+  whatever comes in from it, so unpeered VPCs on one host do reach each
+  other unless something else there drops it. A FORWARD rule this can't
+  evaluate (other matches, jumps to other chains) leaves the pair
+  unpredicted rather than guessed
+- the destination's firewall policy (ingress) and the source's (egress)
+  are evaluated the way the compiled ruleset would: first matching rule
+  wins, unmatched ingress is dropped, unmatched egress allowed
+
+Cells that disagree are marked with '!' and listed under the matrix, and
+the command exits 1. With --target, every subnet also probes that address
+as a stand-in for the internet (a local host works as well as 8.8.8.8):
+public subnets should reach it through their NAT, private ones shouldn't.
+"""
+
+import ipaddress
+import re
+import shlex
+from concurrent.futures import ThreadPoolExecutor
+from backends import get_backend
+from state_store import get_store
+from firewall_manager import load_policy, policy_digest
+from utils import parse_ports
+from tracing import traced
+
+PROBES = ('icmp', 'tcp')
+
+# What a policy rule's address key is called in each direction
+ADDRESS_KEYS = {'ingress': 'source', 'egress': 'destination'}
+
+# A policy is attached but its file is gone or changed since
+_UNKNOWN = object()
+
+# FORWARD rule matches we can evaluate, and the packet field each one tests
+FORWARD_MATCHES = {'-i': 'in', '-o': 'out', '-s': 'src', '-d': 'dst'}
+
+def _rtt(output):
+    """Average RTT in ms from ping output, or None"""
+    times = [float(t) for t in re.findall(r'time[=<]([\d.]+) ?ms', output)]
+    return sum(times) / len(times) if times else None
+
+def _rule_matches(rule, direction, address, protocol, port):
+    if rule.get('protocol', 'tcp') not in ('all', protocol):
+        return False
+    addresses = rule.get(ADDRESS_KEYS[direction], '0.0.0.0/0')
+    if isinstance(addresses, str):
+        addresses = [addresses]
+    if not any(address in ipaddress.ip_network(a, strict=False) for a in addresses):
+        return False
+    if protocol == 'icmp':
+        return True
+    ports = parse_ports(rule.get('port', '*'))
+    return ports is None or any(lo <= port <= hi for lo, hi in ports)
+
+def policy_allows(policy, direction, address, protocol, port=None):
+    """Would a policy let this packet through? First match wins, like the compiled chain"""
+    address = ipaddress.ip_address(address)
+    for rule in policy.get(direction, []):
+        if _rule_matches(rule, direction, address, protocol, port):
+            return rule.get('action', 'allow').upper() == 'ALLOW'
+    # INPUT is DROP, OUTPUT is ACCEPT
+    return direction == 'egress'
+
+def vpc_path(state, vpc1, vpc2):
+    """(whether vpc1's subnets should reach vpc2's, why)"""
+    if vpc1 == vpc2:
+        return True, 'same VPC'
+    for peering in state['peerings']:
+        if {peering['vpc1'], peering['vpc2']} == {vpc1, vpc2}:
+            return True, 'peered'
+    for hub_name, hub in state['hubs'].items():
+        a, b = hub['attachments'].get(vpc1), hub['attachments'].get(vpc2)
+        if a and b and a['route_table'] == b['route_table']:
+            return True, f"transit hub {hub_name}"
+    return False, 'not peered'
+
+def parse_forward_chain(text):
+    """`iptables-save -t filter` output -> (FORWARD policy, [rule arguments])"""
+    policy, rules = 'ACCEPT', []
+    for line in text.splitlines():
+        if line.startswith(':FORWARD '):
+            policy = line.split()[1]
+        elif line.startswith('-A FORWARD '):
+            rules.append(shlex.split(line)[2:])
+    return policy, rules
+
+def _forward_match(option, value, packet):
+    if option in ('-i', '-o'):
+        # A trailing + is a prefix match, as in -i br+
+        name = packet[FORWARD_MATCHES[option]]
+        return name.startswith(value[:-1]) if value.endswith('+') else name == value
+    return ipaddress.ip_address(packet[FORWARD_MATCHES[option]]) in ipaddress.ip_network(value, strict=False)
+
+def forward_verdict(chain, packet):
+    """Would the host forward packet ({'in', 'out', 'src', 'dst'})? None if it can't be told"""
+    policy, rules = chain
+    for args in rules:
+        matched, target, i = True, None, 0
+        while i < len(args):
+            negate = args[i] == '!'
+            option = args[i + negate]
+            value = args[i + negate + 1] if i + negate + 1 < len(args) else None
+            i += negate + 2
+            if option == '-j':
+                target = value
+            elif option == '-m' and value == 'comment':
+                i += 2
+            elif option in FORWARD_MATCHES:
+                if _forward_match(option, value, packet) == negate:
+                    matched = False
+            else:
+                return None
+        if not matched:
+            continue
+        if target == 'ACCEPT':
+            return True
+        if target in ('DROP', 'REJECT'):
+            return False
+        # RETURN, LOG, another chain...
+        return None
+    return policy == 'ACCEPT'
+
+class ReachabilityChecker:
+    def __init__(self, logger, jobs=16, backend=None):
+        self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
+        self.jobs = jobs
+
+    @traced
+    def check(self, vpc_name=None, probe='icmp', port=None, target=None, timeout=1, count=1):
+        """Probe every pair, print the matrix; returns False if anything was unexpected"""
+        if probe not in PROBES:
+            raise ValueError(f"Unknown probe: {probe}")
+        if probe == 'tcp' and port is None:
+            raise ValueError("TCP probes need a --port")
+
+        state = self.store.load()
+        if vpc_name is not None and vpc_name not in state['vpcs']:
+            raise ValueError(f"VPC {vpc_name} does not exist")
+        vpcs = [vpc_name] if vpc_name else sorted(state['vpcs'])
+        endpoints = [
+            (f"{v}/{s}", v, subnet)
+            for v in vpcs for s, subnet in sorted(state['vpcs'][v]['subnets'].items())
+        ]
+        if not endpoints:
+            self.logger.warning("No subnets to probe")
+            return True
+
+        policies = {label: self._policy(label, subnet) for label, _, subnet in endpoints}
+        forward = self._forward_chain() if len(vpcs) > 1 else None
+        columns = [(label, subnet['ip']) for label, _, subnet in endpoints]
+        if target:
+            columns.append(('target', target))
+
+        self.logger.info(f"Probing {len(endpoints)} subnets ({probe}"
+                         f"{f' port {port}' if probe == 'tcp' else ''}, {self.jobs} at a time)")
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = {
+                (src, dst): pool.submit(self._probe, subnet['namespace'], address,
+                                        probe, port, timeout, count)
+                for src, _, subnet in endpoints
+                for dst, address in columns if dst != src
+            }
+
+        results, mismatches = {}, []
+        for src, src_vpc, subnet in endpoints:
+            for dst, address in columns:
+                if dst == src:
+                    continue
+                try:
+                    ok, rtt, detail = futures[(src, dst)].result()
+                except Exception as e:
+                    ok, rtt, detail = False, None, str(e)
+                expected, why = self._expected(state, src, src_vpc, subnet, dst, address,
+                                               policies, forward, probe, port)
+                results[(src, dst)] = (ok, rtt, expected is not None and ok != expected)
+                if expected is not None and ok != expected:
+                    mismatches.append((src, dst, ok, detail, why))
+
+        self._print_matrix(endpoints, columns, results)
+        reachable = sum(1 for ok, _, _ in results.values() if ok)
+        self.logger.info(f"{reachable}/{len(results)} pairs reachable")
+        for src, dst, ok, detail, why in mismatches:
+            if ok:
+                self.logger.error(f"✗ {src} -> {dst}: reachable, expected blocked ({why})")
+            else:
+                self.logger.error(f"✗ {src} -> {dst}: unreachable ({detail}), expected reachable ({why})")
+        if mismatches:
+            self.logger.error(f"{len(mismatches)} pair(s) differ from the expected reachability")
+            return False
+        self.logger.info("✓ Reachability matches peering, forwarding and policy state")
+        return True
+
+    def _probe(self, namespace, address, probe, port, timeout, count):
+        if probe == 'tcp':
+            return self.backend.tcp_probe(namespace, address, port, timeout)
+        ok, output = self.backend.ping(namespace, address, count=count, timeout=timeout)
+        return ok, _rtt(output) if ok else None, None if ok else 'no reply'
+
+    def _policy(self, label, subnet):
+        """The subnet's policy as applied, None without one, _UNKNOWN if it can't be known"""
+        record = subnet.get('policy')
+        if not record:
+            return None
+        try:
+            policy = load_policy(record['file'])
+        except ValueError:
+            self.logger.warning(f"{label}: policy file {record['file']} is gone, "
+                                f"not predicting its traffic")
+            return _UNKNOWN
+        if policy_digest(policy) != record.get('sha256'):
+            self.logger.warning(f"{label}: {record['file']} changed since it was applied, "
+                                f"not predicting its traffic")
+            return _UNKNOWN
+        return policy
+
+    def _forward_chain(self):
+        """The host's FORWARD chain (see parse_forward_chain), None if it can't be read"""
+        try:
+            result = self.backend.run("iptables-save -t filter", check=False)
+            if result.returncode != 0:
+                raise Exception(result.stderr.strip() or f"exit {result.returncode}")
+        except Exception as e:
+            self.logger.warning(f"Can't read the host's FORWARD chain ({e}), "
+                                f"not predicting traffic between unpeered VPCs")
+            return None
+        return parse_forward_chain(result.stdout)
+
+    def _expected(self, state, src, src_vpc, subnet, dst, address, policies, forward, probe, port):
+        """(expected reachable, why), or (None, why) when it can't be told"""
+        if dst == 'target':
+            reachable, why = (True, 'public subnet, NAT') if subnet['type'] == 'public' \
+                else (False, 'private subnet, no NAT')
+        else:
+            dst_vpc = dst.split('/', 1)[0]
+            reachable, why = vpc_path(state, src_vpc, dst_vpc)
+            if not reachable:
+                reachable, why = self._host_path(state, src_vpc, subnet['ip'], dst_vpc, address, forward)
+        if reachable is None:
+            return None, why
+        if not reachable:
+            return False, why
+
+        checks = [(src, 'egress', address)]
+        if dst != 'target':
+            checks.append((dst, 'ingress', subnet['ip']))
+        for label, direction, peer in checks:
+            policy = policies[label]
+            if policy is _UNKNOWN:
+                return None, f"{label} policy unknown"
+            if policy is not None and not policy_allows(policy, direction, peer, probe, port):
+                return False, f"{label} {direction} policy"
+        return True, why
+
+    def _host_path(self, state, src_vpc, src_ip, dst_vpc, dst_ip, forward):
+        """(whether the host forwards between two unpeered VPCs, both ways, why)"""
+        if forward is None:
+            return None, 'not peered, host FORWARD chain unknown'
+        src_bridge, dst_bridge = state['vpcs'][src_vpc]['bridge'], state['vpcs'][dst_vpc]['bridge']
+        there = forward_verdict(forward, {'in': src_bridge, 'out': dst_bridge, 'src': src_ip, 'dst': dst_ip})
+        back = forward_verdict(forward, {'in': dst_bridge, 'out': src_bridge, 'src': dst_ip, 'dst': src_ip})
+        if there is False or back is False:
+            return False, 'not peered, host FORWARD drops it'
+        if there is None or back is None:
+            return None, 'not peered, host FORWARD rules not understood'
+        return True, f"not peered, but the host forwards {src_bridge} <-> {dst_bridge}"
+
+    def _print_matrix(self, endpoints, columns, results):
+        names = {label: str(i) for i, (label, _, _) in enumerate(endpoints, 1)}
+        names['target'] = 'target'
+        width = max(8, *(len(n) for n in names.values()))
+        label_width = max(len(label) for label, _, _ in endpoints) + len(str(len(endpoints))) + 1
+
+        print("\nReachability (RTT in ms; -- no answer; ! not what the state expects)")
+        print("=" * 80)
+        corner = 'FROM \\ TO'
+        header = ''.join(f"{names[dst]:>{width}} " for dst, _ in columns)
+        print(f"{corner:<{label_width}}{header}")
+        for src, _, _ in endpoints:
+            cells = []
+            for dst, _ in columns:
+                if dst == src:
+                    cells.append(f"{'.':>{width}} ")
+                    continue
+                ok, rtt, unexpected = results[(src, dst)]
+                cell = (f"{rtt:.2f}" if rtt is not None else 'ok') if ok else '--'
+                cells.append(f"{cell:>{width}}{'!' if unexpected else ' '}")
+            print(f"{names[src] + ' ' + src:<{label_width}}{''.join(cells)}")
+        print("=" * 80)
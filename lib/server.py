@@ -0,0 +1,214 @@
+"""
+Server - vpcctld, a long-running vpcctl serving JSON-RPC on a Unix socket
+
+Every `vpcctl` run pays for starting Python, importing every manager,
+setting up logging, building the argparse tree and opening the state store
+before doing any kernel work. vpcctld pays that once. It keeps the parser,
+the logger, the state store connection, the netlink sockets and the
+per-namespace setns workers (see netns.py) alive between requests, so a
+request costs the kernel work and little else.
+
+Protocol: one JSON-RPC 2.0 object per line, in both directions.
+
+- `run` {argv, cwd, env}: run a vpcctl command line, returns
+  {exit_code, stdout, stderr}. This is what the vpcctl client sends.
+- `<command>` {option: value}: same thing for scripts, e.g.
+  {"method": "create-vpc", "params": {"name": "prod", "cidr": "10.0.0.0/16"}}
+- `ping`: {pid, uptime, requests}
+
+Commands run one at a time on a single worker thread, the same order they
+would have had as separate processes holding the state lock, and the only
+thread the state store's connection and the output capture have to serve.
+Long-running commands (sampling, probes, benchmarks; see
+client.IN_PROCESS_COMMANDS) never get here, so nothing holds that thread
+for more than the kernel work of one command.
+"""
+
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout, redirect_stderr
+from cli import build_parser, execute
+from backend_choice import select_backend
+from firewall_engine import select_engine
+from client import SOCKET_PATH, IN_PROCESS_COMMANDS, subcommand
+from logger import console_handler
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def params_to_argv(command, params):
+    """{'name': 'prod', 'dry_run': True} -> [command, '--name', 'prod', '--dry-run']"""
+    argv = [command]
+    for key, value in params.items():
+        flag = f"--{key.replace('_', '-')}"
+        if value is True:
+            argv.append(flag)
+        elif value not in (False, None):
+            argv += [flag, str(value)]
+    return argv
+
+class Daemon:
+    def __init__(self, logger, socket_path=SOCKET_PATH):
+        self.logger = logger
+        self.socket_path = socket_path
+        self.parser = build_parser()
+        self.commands = set(self.parser._subparsers._group_actions[0].choices)
+        self.worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='vpcctld')
+        self.started = time.monotonic()
+        self.requests = 0
+
+        # Console output of a request goes back to its client
+        self.console = console_handler(logger)
+
+    def handle(self, message):
+        """Answer one JSON-RPC request"""
+        request_id = None
+        try:
+            try:
+                request = json.loads(message)
+            except ValueError as e:
+                raise RPCError(PARSE_ERROR, f"Invalid JSON: {e}")
+            if not isinstance(request, dict) or 'method' not in request:
+                raise RPCError(INVALID_REQUEST, "Expected a JSON-RPC request object")
+
+            request_id = request.get('id')
+            method = request['method']
+            params = request.get('params') or {}
+            if not isinstance(params, dict):
+                raise RPCError(INVALID_PARAMS, "params must be an object")
+
+            if method == 'ping':
+                result = {'pid': os.getpid(), 'uptime': round(time.monotonic() - self.started, 3),
+                          'requests': self.requests}
+            elif method == 'run':
+                argv = params.get('argv')
+                if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+                    raise RPCError(INVALID_PARAMS, "argv must be a list of strings")
+                result = self._submit(argv, params.get('cwd'), params.get('env') or {})
+            elif method in self.commands:
+                result = self._submit(params_to_argv(method, params), None, {})
+            else:
+                raise RPCError(METHOD_NOT_FOUND, f"Unknown method: {method}")
+
+            return {'jsonrpc': '2.0', 'id': request_id, 'result': result}
+        except RPCError as e:
+            return {'jsonrpc': '2.0', 'id': request_id,
+                    'error': {'code': e.code, 'message': str(e)}}
+
+    def _submit(self, argv, cwd, env):
+        command = subcommand(argv)
+        if command in IN_PROCESS_COMMANDS:
+            raise RPCError(INVALID_PARAMS, f"{command} doesn't run inside vpcctld")
+        return self.worker.submit(self._run, argv, cwd, env).result()
+
+    def _run(self, argv, cwd, env):
+        """Run a command line on the worker thread, capturing what it prints"""
+        self.requests += 1
+        stdout, stderr = io.StringIO(), io.StringIO()
+        saved_env = {k: v for k, v in os.environ.items() if k.startswith('VPCCTL_')}
+        saved_cwd = os.getcwd()
+
+        # The client's VPCCTL_* settings and working directory (for relative
+        # policy/topology paths) apply for the length of the request
+        for key in saved_env:
+            if key not in env:
+                del os.environ[key]
+        os.environ.update({k: v for k, v in env.items() if k.startswith('VPCCTL_')})
+        self.console.setStream(stderr)
+        try:
+            if cwd:
+                os.chdir(cwd)
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                try:
+                    args = self.parser.parse_args(argv)
+                    if not args.command:
+                        self.parser.print_help()
+                        exit_code = 1
+                    else:
+                        exit_code = execute(args, self.logger)
+                except SystemExit as e:
+                    # --help, or argparse rejecting the arguments
+                    exit_code = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            self.logger.exception(f"Request {argv} failed")
+            stderr.write(f"ERROR: {e}\n")
+            exit_code = 1
+        finally:
+            self.console.setStream(self._stderr)
+            os.chdir(saved_cwd)
+            for key in [k for k in os.environ if k.startswith('VPCCTL_')]:
+                del os.environ[key]
+            os.environ.update(saved_env)
+            # --backend/--firewall only apply to the request that gave them
+            select_backend(None)
+            select_engine(None)
+
+        return {'exit_code': exit_code, 'stdout': stdout.getvalue(), 'stderr': stderr.getvalue()}
+
+    def serve(self):
+        """Listen on the Unix socket until SIGTERM/SIGINT"""
+        self._stderr = self.console.stream
+        self._claim_socket()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    response = daemon.handle(line)
+                    self.wfile.write(json.dumps(response).encode() + b'\n')
+                    self.wfile.flush()
+
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+
+        def stop(signum, frame):
+            # shutdown() waits for serve_forever(), so not from its own thread
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.logger.info(f"vpcctld listening on {self.socket_path} (pid {os.getpid()})")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            self.worker.shutdown(wait=True)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.logger.info("vpcctld stopped")
+
+    def _claim_socket(self):
+        """Create the socket directory and clear a stale socket left by a crash"""
+        os.makedirs(os.path.dirname(self.socket_path), mode=0o755, exist_ok=True)
+        if not os.path.exists(self.socket_path):
+            return
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(self.socket_path)
+        else:
+            raise ValueError(f"vpcctld is already running on {self.socket_path}")
+        finally:
+            probe.close()
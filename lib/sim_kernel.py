@@ -0,0 +1,981 @@
+"""
+Sim Kernel - An in-memory network stack behind `--backend sim`
+
+Models just enough of Linux networking for vpcctl to build, verify and time
+topologies without root or a real kernel:
+
+- namespaces, each with its links, routes, sysctls, iptables tables, an
+  nftables ruleset and "processes" (background commands)
+- bridges and veth pairs (a veth end can live in another namespace), link
+  state, bridge ports, IPv4 addresses, MTU (a bridge takes the smallest of
+  its ports'), queues, txqueuelen, offloads and bridge options
+- routes, including connected routes for addresses on up links and the
+  kernel's checks (gateway reachable unless onlink, no duplicates, ...)
+- iptables filter chains with counters, evaluated for simulated pings and
+  TCP connects;
+  nat rules are kept and listed but don't rewrite addresses, and nftables
+  rulesets are stored (and listed) but not evaluated
+
+Batches use the same typed operations as the netlink backend, so managers
+can't tell the difference. Commands (`iptables`, `iptables-restore`,
+`iptables-save`, `nft`, `sysctl`, `ping`, `ip netns list`, `ip link show`)
+are interpreted instead of run; nothing is ever forked.
+
+A ping (or a TCP connect) walks the topology hop by hop: route lookup, the L2 segment behind
+the outgoing link (veth peer, bridge and its ports), the filter chains on
+the way, ip_forward on routers, and the same again for the reply.
+
+The kernel lives in sim-kernel.json next to the state. It's read once per
+process and written back after each command (see backends.flush_backends),
+so simulated runs should take turns, like they would holding the real
+state lock, or go through vpcctld which keeps it in memory.
+"""
+
+import errno
+import ipaddress
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+from backends import NetlinkBatch, offload_flags
+from tracing import command_span
+
+# Simulated VPCs never share the host's state
+SIM_STATE_DIR = os.path.expanduser('~/.local/state/vpcctl-sim')
+KERNEL_FILE = 'sim-kernel.json'
+
+HOST = ''
+IFNAMSIZ = 16
+MAX_HOPS = 64
+PING_BYTES = 84
+
+TABLE_CHAINS = {
+    'filter': ('INPUT', 'FORWARD', 'OUTPUT'),
+    'nat': ('PREROUTING', 'INPUT', 'OUTPUT', 'POSTROUTING'),
+    'mangle': ('PREROUTING', 'INPUT', 'FORWARD', 'OUTPUT', 'POSTROUTING'),
+}
+TARGETS = ('ACCEPT', 'DROP', 'REJECT', 'RETURN', 'LOG', 'MASQUERADE', 'SNAT', 'DNAT')
+STAT_FIELDS = ('receive_bytes', 'receive_packets', 'transmit_bytes', 'transmit_packets')
+
+# What a new link starts with, as the kernel sets it up
+LINK_DEFAULTS = {'mtu': 1500, 'txqueuelen': 1000, 'numtxqueues': 1, 'numrxqueues': 1}
+LOOPBACK_MTU = 65536
+MTU_RANGE = (68, 65535)
+VETH_OFFLOADS = {'gro': False, 'gso': True, 'tso': True}
+BRIDGE_DEFAULTS = {'forward_delay': 1500, 'stp_state': 0, 'mcast_snooping': 1}
+
+def sim_state_dir():
+    """Where the simulated kernel (and the state that goes with it) lives"""
+    return os.environ.get('VPCCTL_STATE_DIR', SIM_STATE_DIR)
+
+def _no_device(name):
+    return OSError(errno.ENODEV, f'Cannot find device "{name}"')
+
+def _network(dst):
+    return ipaddress.ip_network('0.0.0.0/0' if dst == 'default' else dst, strict=False)
+
+def _new_namespace():
+    return {'links': {}, 'routes': [], 'sysctl': {}, 'iptables': {}, 'nft': None, 'processes': {}}
+
+class SimKernel:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.namespaces = {HOST: _new_namespace()}
+        self.next_index = 1
+        self.next_pid = 100000
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.namespaces = saved['namespaces']
+            self.next_index = saved['next_index']
+            self.next_pid = saved['next_pid']
+        else:
+            self._add_link(HOST, 'lo', 'loopback', up=True, addresses=['127.0.0.1/8'])
+
+    def save(self):
+        """Write the kernel back to its file (atomically)"""
+        if not self.path:
+            return
+        with self.lock:
+            data = {'namespaces': self.namespaces, 'next_index': self.next_index,
+                    'next_pid': self.next_pid}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+
+    def netlink(self, namespace=None):
+        return SimNetlink(self, namespace or HOST)
+
+    # Namespaces
+
+    def namespace(self, name):
+        ns = self.namespaces.get(name or HOST)
+        if ns is None:
+            raise OSError(errno.ENOENT, f'Cannot open network namespace "{name}": No such file or directory')
+        return ns
+
+    def add_namespace(self, name):
+        with self.lock:
+            if name in self.namespaces:
+                raise OSError(errno.EEXIST, f'Cannot create namespace file "/run/netns/{name}": File exists')
+            self.namespaces[name] = _new_namespace()
+            self._add_link(name, 'lo', 'loopback', addresses=['127.0.0.1/8'])
+
+    def delete_namespace(self, name):
+        with self.lock:
+            ns = self.namespace(name)
+            # Veths die with their namespace, taking their peers along
+            for link_name in list(ns['links']):
+                if link_name in ns['links']:
+                    self._delete_link(name, link_name)
+            del self.namespaces[name]
+
+    # Links
+
+    def _add_link(self, ns_name, name, kind, up=False, addresses=(), peer=None, options=None):
+        ns = self.namespace(ns_name)
+        if len(name) >= IFNAMSIZ:
+            raise OSError(errno.EINVAL, f'"{name}" is not a valid interface name')
+        if name in ns['links']:
+            raise OSError(errno.EEXIST, "File exists")
+        link = {
+            'index': self.next_index, 'kind': kind, 'up': up, 'master': None,
+            'addresses': list(addresses), 'peer': peer, 'stats': dict.fromkeys(STAT_FIELDS, 0)
+        }
+        link.update(LINK_DEFAULTS, **(options or {}))
+        if kind == 'loopback':
+            link['mtu'] = LOOPBACK_MTU
+        elif kind == 'veth':
+            link['offloads'] = dict(VETH_OFFLOADS)
+        elif kind == 'bridge':
+            link['bridge'] = dict(BRIDGE_DEFAULTS)
+        ns['links'][name] = link
+        self.next_index += 1
+        return link
+
+    def _mtu(self, ns, name):
+        """A link's MTU; a bridge has the smallest of its ports', like the kernel's default"""
+        link = ns['links'][name]
+        if link['kind'] == 'bridge':
+            ports = [other.get('mtu', 1500) for other in ns['links'].values() if other['master'] == name]
+            if ports:
+                return min(ports)
+        return link.get('mtu', 1500)
+
+    def set_offloads(self, ns_name, dev, offloads):
+        with self.lock:
+            link = self._link(ns_name, dev)
+            if link['kind'] != 'veth':
+                raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+            link.setdefault('offloads', dict(VETH_OFFLOADS)).update(offloads)
+
+    def _delete_link(self, ns_name, name):
+        ns = self.namespace(ns_name)
+        link = ns['links'].pop(name, None)
+        if link is None:
+            raise _no_device(name)
+        ns['routes'] = [r for r in ns['routes'] if r['dev'] != name]
+        for other in ns['links'].values():
+            if other['master'] == name:
+                other['master'] = None
+        if link['peer']:
+            peer_ns, peer_name = link['peer']
+            if peer_name in self.namespaces.get(peer_ns, {}).get('links', {}):
+                self.namespaces[peer_ns]['links'][peer_name]['peer'] = None
+                self._delete_link(peer_ns, peer_name)
+
+    def _link(self, ns_name, name):
+        link = self.namespace(ns_name)['links'].get(name)
+        if link is None:
+            raise _no_device(name)
+        return link
+
+    # Routing
+
+    def _local(self, ns, address):
+        """The link that owns a local address, or None"""
+        for name, link in ns['links'].items():
+            if any(ipaddress.ip_interface(a).ip == address for a in link['addresses']):
+                return name
+        if address in ipaddress.ip_network('127.0.0.0/8') and ns['links']['lo']['up']:
+            return 'lo'
+        return None
+
+    def _connected(self, ns):
+        """(network, dev) for every address on an up link"""
+        return [
+            (ipaddress.ip_interface(a).network, name)
+            for name, link in ns['links'].items() if link['up'] and link['kind'] != 'loopback'
+            for a in link['addresses']
+        ]
+
+    def _lookup(self, ns, address):
+        """Longest-prefix match: (dev, next hop) or None"""
+        candidates = [(network, dev, None) for network, dev in self._connected(ns)]
+        for route in ns['routes']:
+            if ns['links'].get(route['dev'], {}).get('up'):
+                candidates.append((_network(route['dst']), route['dev'], route['via']))
+        matches = [c for c in candidates if address in c[0]]
+        if not matches:
+            return None
+        _, dev, via = max(matches, key=lambda c: c[0].prefixlen)
+        return dev, ipaddress.ip_address(via) if via else address
+
+    def _segment(self, ns_name, dev):
+        """Every link reachable at L2 from a link: {(ns, link): (ns, link) it was reached from}"""
+        start = (ns_name, dev)
+        parents, todo = {start: None}, [start]
+        while todo:
+            key = todo.pop()
+            ns_key, name = key
+            links = self.namespaces[ns_key]['links']
+            link = links[name]
+            found = []
+            if link['peer']:
+                found.append(tuple(link['peer']))
+            if link['master']:
+                found.append((ns_key, link['master']))
+            if link['kind'] == 'bridge':
+                found += [(ns_key, port) for port, other in links.items() if other['master'] == name]
+            for other in found:
+                other_link = self.namespaces[other[0]]['links'].get(other[1])
+                if other not in parents and other_link is not None and other_link['up']:
+                    parents[other] = key
+                    todo.append(other)
+        return parents
+
+    def _neighbour(self, ns_name, dev, address):
+        """Where a frame for address goes when sent out of dev (ARP, in effect)
+
+        Returns the path of links it crosses, ending at the one that owns
+        the address, or None.
+        """
+        parents = self._segment(ns_name, dev)
+        for key in parents:
+            link = self.namespaces[key[0]]['links'][key[1]]
+            if key == (ns_name, dev) or link['master'] is not None:
+                continue
+            if any(ipaddress.ip_interface(a).ip == address for a in link['addresses']):
+                path = []
+                while key is not None:
+                    path.append(key)
+                    key = parents[key]
+                return path[::-1]
+        return None
+
+    # Packets
+
+    def _chain_verdict(self, ns, chain, packet):
+        table = ns['iptables'].get('filter')
+        if table is None:
+            return 'ACCEPT'
+        verdict = _traverse(table, chain, packet)
+        return verdict or table[chain]['policy']
+
+    def _count(self, link, direction):
+        link['stats'][f'{direction}_bytes'] += PING_BYTES
+        link['stats'][f'{direction}_packets'] += 1
+
+    def _send(self, ns_name, packet):
+        """Route a locally generated packet to its destination
+
+        Returns (namespace it was delivered to, None) or (None, why not).
+        """
+        ns = self.namespaces[ns_name]
+        dst = packet['dst']
+        in_dev = None
+        for hop in range(MAX_HOPS):
+            local = self._local(ns, dst)
+            if local:
+                if hop == 0:
+                    packet = dict(packet, src=packet['src'] or dst, out='lo')
+                    if self._chain_verdict(ns, 'OUTPUT', packet) != 'ACCEPT':
+                        return None, "Operation not permitted"
+                    in_dev = 'lo'
+                if self._chain_verdict(ns, 'INPUT', dict(packet, **{'in': in_dev, 'out': None})) != 'ACCEPT':
+                    return None, "filtered"
+                return ns_name, None
+
+            if hop and ns['sysctl'].get('net.ipv4.ip_forward', '0') != '1':
+                return None, "Destination Host Unreachable"
+            route = self._lookup(ns, dst)
+            if route is None:
+                return None, "Network is unreachable"
+            dev, next_hop = route
+
+            if hop == 0:
+                if packet['src'] is None:
+                    addresses = ns['links'][dev]['addresses']
+                    packet = dict(packet, src=ipaddress.ip_interface(addresses[0]).ip if addresses else dst)
+                verdict = self._chain_verdict(ns, 'OUTPUT', dict(packet, **{'in': None, 'out': dev}))
+                if verdict != 'ACCEPT':
+                    return None, "Operation not permitted"
+            else:
+                verdict = self._chain_verdict(ns, 'FORWARD', dict(packet, **{'in': in_dev, 'out': dev}))
+                if verdict != 'ACCEPT':
+                    return None, "filtered"
+
+            path = self._neighbour(ns_name, dev, next_hop)
+            if path is None:
+                return None, "Destination Host Unreachable"
+            # Entering a veth end from its peer is a receive, leaving
+            # through a bridge port a transmit
+            self._count(ns['links'][dev], 'transmit')
+            for previous, (link_ns, name) in zip(path, path[1:]):
+                link = self.namespaces[link_ns]['links'][name]
+                if link['kind'] == 'veth' and link['peer'] == list(previous):
+                    self._count(link, 'receive')
+                elif link['kind'] == 'veth':
+                    self._count(link, 'transmit')
+            ns_name, in_dev = path[-1]
+            ns = self.namespaces[ns_name]
+            if ns['links'][in_dev]['kind'] == 'bridge':
+                self._count(ns['links'][in_dev], 'receive')
+            packet = dict(packet, ttl=packet['ttl'] - 1)
+        return None, "Time to live exceeded"
+
+    def ping(self, ns_name, address, count=3):
+        """Simulated ICMP echo: (ok, ping-like output)"""
+        with self.lock:
+            self.namespace(ns_name)
+            try:
+                target = ipaddress.ip_address(address)
+            except ValueError:
+                return False, f"ping: {address}: Name or service not known\n"
+
+            lines = [f"PING {address} ({address}) 56(84) bytes of data."]
+            received = 0
+            for seq in range(1, count + 1):
+                request = {'proto': 'icmp', 'src': None, 'dst': target, 'state': 'NEW', 'ttl': 64}
+                where, error = self._send(ns_name or HOST, request)
+                if where is not None:
+                    # The reply comes back from the target's side
+                    source = self._reply_source(ns_name or HOST, target)
+                    reply = {'proto': 'icmp', 'src': target, 'dst': source,
+                             'state': 'ESTABLISHED', 'ttl': 64}
+                    back, error = self._send(where, reply)
+                    if back == (ns_name or HOST):
+                        received += 1
+                        lines.append(f"64 bytes from {address}: icmp_seq={seq} ttl=64 time=0.01 ms")
+                        continue
+                if error not in ('filtered', None):
+                    lines.append(f"From {address} icmp_seq={seq} {error}")
+
+            loss = 100 * (count - received) // count
+            lines += ["", f"--- {address} ping statistics ---",
+                      f"{count} packets transmitted, {received} received, {loss}% packet loss"]
+            return received > 0, '\n'.join(lines) + '\n'
+
+    def _reply_source(self, ns_name, target):
+        ns = self.namespaces[ns_name]
+        if self._local(ns, target):
+            return target
+        dev, _ = self._lookup(ns, target)
+        addresses = ns['links'][dev]['addresses']
+        return ipaddress.ip_interface(addresses[0]).ip if addresses else target
+
+    # Processes
+
+    def connect(self, ns_name, address, port):
+        """Simulated TCP connect: (reachable, 'connected' or why not)
+
+        Whether anything listens isn't modelled, so reaching the port
+        counts as connected.
+        """
+        with self.lock:
+            self.namespace(ns_name)
+            target = ipaddress.ip_address(address)
+            syn = {'proto': 'tcp', 'src': None, 'dst': target, 'dport': port, 'state': 'NEW', 'ttl': 64}
+            where, error = self._send(ns_name or HOST, syn)
+            if where is None:
+                return False, 'timed out' if error == 'filtered' else error
+            source = self._reply_source(ns_name or HOST, target)
+            reply = {'proto': 'tcp', 'src': target, 'dst': source, 'state': 'ESTABLISHED', 'ttl': 64}
+            back, error = self._send(where, reply)
+            if back != (ns_name or HOST):
+                return False, 'timed out' if error in ('filtered', None) else error
+            return True, 'connected'
+
+    def spawn(self, ns_name, command):
+        with self.lock:
+            pid = self.next_pid
+            self.next_pid += 1
+            self.namespace(ns_name)['processes'][str(pid)] = command
+            return pid
+
+    def namespace_pids(self, names):
+        with self.lock:
+            return {name: [int(pid) for pid in self.namespaces[name]['processes']]
+                    for name in names if name in self.namespaces}
+
+    def kill(self, pids):
+        with self.lock:
+            for ns in self.namespaces.values():
+                for pid in pids:
+                    ns['processes'].pop(str(pid), None)
+
+    def interface_stats(self):
+        with self.lock:
+            stats = {}
+            for name, link in self.namespaces[HOST]['links'].items():
+                stats[name] = dict.fromkeys(('receive_errs', 'receive_drop', 'transmit_errs', 'transmit_drop'), 0)
+                stats[name].update(link['stats'])
+            return stats
+
+    # Commands
+
+    def execute(self, ns_name, cmd, input=None):
+        """Interpret a command line in a namespace: (returncode, stdout, stderr)"""
+        with self.lock:
+            try:
+                self.namespace(ns_name)
+            except OSError as e:
+                return 1, '', f"{e.strerror}\n"
+
+            if cmd.rstrip().endswith('&'):
+                # Background command: a process that runs until it's killed
+                self.spawn(ns_name, cmd.rstrip()[:-1].strip())
+                return 0, '', ''
+
+            args = shlex.split(cmd)
+            handlers = {
+                'ip': self._ip, 'iptables': self._iptables, 'iptables-restore': self._iptables_restore,
+                'iptables-save': self._iptables_save, 'nft': self._nft, 'sysctl': self._sysctl,
+                'ping': self._ping,
+            }
+            handler = handlers.get(args[0] if args else '')
+            if handler is None:
+                return 127, '', f"{args[0] if args else cmd}: not available in the simulated kernel\n"
+            try:
+                return handler(self.namespaces[ns_name or HOST], args[1:], input)
+            except (IndexError, ValueError) as e:
+                return 2, '', f"{args[0]}: bad arguments: {e}\n"
+
+    def _ip(self, ns, args, input):
+        if args[:2] == ['netns', 'list']:
+            names = sorted(n for n in self.namespaces if n != HOST)
+            return 0, ''.join(f"{name}\n" for name in names), ''
+        if args[:2] == ['link', 'show']:
+            links = ns['links'].items()
+            if args[2:4] == ['type', 'bridge']:
+                links = [(n, l) for n, l in links if l['kind'] == 'bridge']
+            elif len(args) > 2:
+                if args[-1] not in ns['links']:
+                    return 1, '', f'Device "{args[-1]}" does not exist.\n'
+                links = [(args[-1], ns['links'][args[-1]])]
+            out = []
+            for name, link in links:
+                state = 'UP' if link['up'] else 'DOWN'
+                master = f" master {link['master']}" if link['master'] else ''
+                out.append(f"{link['index']}: {name}: <BROADCAST,MULTICAST,{state}> mtu {self._mtu(ns, name)}"
+                           f"{master} state {state} qlen {link.get('txqueuelen', 1000)}")
+                out.append(f"    link/{'loopback' if link['kind'] == 'loopback' else 'ether'} ({link['kind']})")
+            return 0, '\n'.join(out) + '\n' if out else '', ''
+        return 1, '', f"ip {' '.join(args)}: not available in the simulated kernel\n"
+
+    def _sysctl(self, ns, args, input):
+        args = [a for a in args if a not in ('-w', '-q')]
+        out = []
+        for arg in args:
+            key, sep, value = arg.partition('=')
+            if sep:
+                ns['sysctl'][key] = value.strip()
+            out.append(f"{key} = {ns['sysctl'].get(key, '0')}")
+        return 0, '\n'.join(out) + '\n', ''
+
+    def _ping(self, ns, args, input):
+        count, address = 3, None
+        i = 0
+        while i < len(args):
+            if args[i] == '-c':
+                count = int(args[i + 1])
+                i += 1
+            elif args[i] == '-W':
+                i += 1
+            elif not args[i].startswith('-'):
+                address = args[i]
+            i += 1
+        name = next(n for n, other in self.namespaces.items() if other is ns)
+        ok, output = self.ping(name, address, count)
+        return (0, output, '') if ok else (1, output, '')
+
+    # iptables
+
+    def _iptables(self, ns, args, input):
+        table_name, rest = 'filter', []
+        i = 0
+        while i < len(args):
+            if args[i] == '-w':
+                pass
+            elif args[i] == '-t':
+                table_name = args[i + 1]
+                i += 1
+            else:
+                rest = args[i:]
+                break
+            i += 1
+        op, rest = rest[0], rest[1:]
+
+        if op in ('-L', '-S'):
+            chain = rest[0] if rest and not rest[0].startswith('-') else None
+            table = _table(ns, table_name)
+            if chain and chain not in table:
+                return 1, '', "iptables: No chain/target/match by that name.\n"
+            if op == '-S':
+                return 0, _save_lines(table, [chain] if chain else list(table), False, rules_only=True), ''
+            return 0, _list(table, [chain] if chain else list(table)), ''
+
+        table = _table(ns, table_name)
+        error = _apply(table, op, rest)
+        if error:
+            return 1, '', f"iptables: {error}\n"
+        return 0, '', ''
+
+    def _iptables_restore(self, ns, args, input):
+        noflush = '--noflush' in args or '-n' in args
+        staged = json.loads(json.dumps(ns['iptables']))
+        table = None
+        for number, line in enumerate((input or '').splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('*'):
+                table = staged.setdefault(line[1:], {})
+                if not noflush:
+                    table.clear()
+                _builtins(table, line[1:])
+                continue
+            if line == 'COMMIT':
+                table = None
+                continue
+            if table is None:
+                return 1, '', f"iptables-restore: line {number} failed\n"
+            if line.startswith(':'):
+                chain, policy = line[1:].split()[:2]
+                entry = table.setdefault(chain, {'policy': None, 'counters': [0, 0], 'rules': []})
+                if policy != '-':
+                    entry['policy'] = policy
+                continue
+            tokens = shlex.split(line)
+            if _apply(table, tokens[0], tokens[1:]):
+                return 1, '', f"iptables-restore: line {number} failed\n"
+        ns['iptables'] = staged
+        return 0, '', ''
+
+    def _iptables_save(self, ns, args, input):
+        counters = '-c' in args
+        tables = [args[args.index('-t') + 1]] if '-t' in args else sorted(ns['iptables'])
+        out = ["# Generated by iptables-save (vpcctl simulated kernel)"]
+        for name in tables:
+            table = _table(ns, name)
+            out.append(f"*{name}")
+            out.append(_save_lines(table, list(table), counters).rstrip('\n'))
+            out.append("COMMIT")
+        return 0, '\n'.join(out) + '\n', ''
+
+    # nftables
+
+    def _nft(self, ns, args, input):
+        if args[:2] == ['-f', '-']:
+            text = input or ''
+            ns['nft'] = text if '{' in text else None
+            return 0, '', ''
+        as_json = args[:1] == ['-j']
+        if as_json:
+            args = args[1:]
+        if args[:2] == ['list', 'table']:
+            if not ns['nft']:
+                return 1, '', "Error: No such file or directory\n"
+            if as_json:
+                return 0, json.dumps({'nftables': _nft_rules(ns['nft'])}), ''
+            body = ns['nft'][ns['nft'].index(f"table {args[2]} {args[3]} {{"):]
+            return 0, body, ''
+        return 1, '', f"nft {' '.join(args)}: not available in the simulated kernel\n"
+
+class SimNetlink:
+    """NetlinkSocket's link/address/route calls, against the simulated kernel"""
+
+    def __init__(self, kernel, namespace):
+        self.kernel = kernel
+        self.namespace = namespace
+
+    def link_index(self, name):
+        with self.kernel.lock:
+            link = self.kernel.namespace(self.namespace)['links'].get(name)
+            return link['index'] if link else None
+
+    def link_add(self, name, kind, peer=None, peer_netns=None, options=None):
+        with self.kernel.lock:
+            mtu = (options or {}).get('mtu')
+            if mtu is not None and not MTU_RANGE[0] <= mtu <= MTU_RANGE[1]:
+                raise OSError(errno.EINVAL, "Invalid argument")
+            if kind == 'veth':
+                peer_ns = peer_netns or self.namespace
+                self.kernel.namespace(peer_ns)
+                if peer in self.kernel.namespace(peer_ns)['links'] or len(peer) >= IFNAMSIZ:
+                    raise OSError(errno.EEXIST, "File exists")
+                self.kernel._add_link(self.namespace, name, 'veth', peer=[peer_ns, peer], options=options)
+                self.kernel._add_link(peer_ns, peer, 'veth', peer=[self.namespace, name], options=options)
+            else:
+                self.kernel._add_link(self.namespace, name, kind, options=options)
+
+    def link_set(self, name, up=None, master=None):
+        with self.kernel.lock:
+            link = self.kernel._link(self.namespace, name)
+            if master is not None:
+                bridge = self.kernel._link(self.namespace, master)
+                if bridge['kind'] != 'bridge':
+                    raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+                link['master'] = master
+            if up is not None:
+                link['up'] = up
+
+    def bridge_set(self, name, **options):
+        with self.kernel.lock:
+            link = self.kernel._link(self.namespace, name)
+            if link['kind'] != 'bridge':
+                raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+            link.setdefault('bridge', dict(BRIDGE_DEFAULTS)).update(options)
+
+    def link_delete(self, name):
+        with self.kernel.lock:
+            self.kernel._delete_link(self.namespace, name)
+
+    def addr_add(self, dev, address):
+        with self.kernel.lock:
+            link = self.kernel._link(self.namespace, dev)
+            iface = ipaddress.ip_interface(address)
+            if any(ipaddress.ip_interface(a).ip == iface.ip for a in link['addresses']):
+                raise OSError(errno.EEXIST, "File exists")
+            link['addresses'].append(str(iface))
+
+    def route_add(self, dst, via=None, dev=None, onlink=False):
+        with self.kernel.lock:
+            ns = self.kernel.namespace(self.namespace)
+            network = _network(dst)
+            if dev is not None:
+                self.kernel._link(self.namespace, dev)
+            if via and not onlink:
+                gateway = ipaddress.ip_address(via)
+                reachable = [d for net, d in self.kernel._connected(ns)
+                             if gateway in net and d == (dev or d)]
+                if not reachable:
+                    raise OSError(errno.ENETUNREACH, "Nexthop has invalid gateway")
+                dev = dev or reachable[0]
+            if dev is None:
+                raise OSError(errno.ENODEV, "No such device")
+            if any(_network(r['dst']) == network for r in ns['routes']):
+                raise OSError(errno.EEXIST, "File exists")
+            ns['routes'].append({'dst': str(network), 'via': via, 'dev': dev, 'onlink': onlink})
+
+    def route_delete(self, dst, via=None, dev=None):
+        with self.kernel.lock:
+            ns = self.kernel.namespace(self.namespace)
+            network = _network(dst)
+            for route in ns['routes']:
+                if _network(route['dst']) == network and (via is None or route['via'] == via) \
+                   and (dev is None or route['dev'] == dev):
+                    ns['routes'].remove(route)
+                    return
+            raise OSError(errno.ESRCH, "No such process")
+
+class SimBatch(NetlinkBatch):
+    """NetlinkBatch against the simulated kernel (namespaces included)"""
+    backend = 'sim'
+
+    def __init__(self, kernel, namespace=None):
+        super().__init__(kernel.netlink(namespace), namespace)
+        self.kernel = kernel
+
+    def add_netns(self, name, owner):
+        self._queue(f"netns add {name}", owner, True, self.kernel.add_namespace, name)
+
+    def delete_netns(self, name, owner, check=True):
+        self._queue(f"netns delete {name}", owner, check, self.kernel.delete_namespace, name)
+
+    def _add_veth(self, name, peer, peer_netns, options):
+        self.nl.link_add(name, 'veth', peer=peer, peer_netns=peer_netns, options=options)
+
+    def _run_ip(self, command):
+        raise OSError(errno.EOPNOTSUPP, f"untyped ip command not supported by the simulated kernel: {command}")
+
+class SimBackend:
+    """Everything happens in a SimKernel; no root, no processes"""
+    name = 'sim'
+
+    def __init__(self, state_dir=None):
+        self.kernel = SimKernel(os.path.join(state_dir or sim_state_dir(), KERNEL_FILE))
+
+    def save(self):
+        self.kernel.save()
+
+    def batch(self, namespace=None):
+        return SimBatch(self.kernel, namespace)
+
+    def link_exists(self, name):
+        return self.kernel.netlink().link_index(name) is not None
+
+    def namespace_exists(self, name):
+        return name in self.kernel.namespaces
+
+    def delete_namespace(self, name, check=True):
+        with command_span(f"ip netns delete {name}", backend=self.name) as span:
+            try:
+                self.kernel.delete_namespace(name)
+            except OSError as e:
+                span['exit_code'] = e.errno
+                if check:
+                    raise Exception(f"Failed to delete namespace {name}: {e.strerror}")
+
+    def sysctl(self, key, value, namespace=None):
+        self.run_in_namespace(namespace or HOST, f"sysctl -w {key}={value}")
+
+    def run(self, cmd, check=True, input=None):
+        return self.run_in_namespace(None, cmd, check=check, input=input)
+
+    def run_in_namespace(self, namespace, cmd, check=True, input=None):
+        with command_span(cmd, namespace, self.name) as span:
+            returncode, stdout, stderr = self.kernel.execute(namespace or HOST, cmd, input)
+            span['exit_code'] = returncode
+        if check and returncode != 0:
+            # Same message run_command gives for a failed process
+            raise Exception(f"Command failed: {cmd}\nError: {stderr}")
+        return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+    def ping(self, namespace, address, count=3, timeout=2):
+        with command_span(f"ping -c {count} {address}", namespace, self.name) as span:
+            ok, output = self.kernel.ping(namespace, address, count)
+            span['exit_code'] = 0 if ok else 1
+            return ok, output
+
+    def tcp_probe(self, namespace, address, port, timeout=2):
+        with command_span(f"tcp-connect {address}:{port}", namespace, self.name) as span:
+            started = time.perf_counter()
+            ok, detail = self.kernel.connect(namespace, address, port)
+            span['exit_code'] = 0 if ok else 1
+            return ok, (time.perf_counter() - started) * 1000 if ok else None, detail
+
+    def socket(self, namespace, family, kind, proto=0):
+        raise Exception("The simulated kernel carries no traffic; perf needs a real backend")
+
+    def spawn(self, namespace, cmd):
+        with command_span(cmd, namespace, self.name) as span:
+            span['exit_code'] = 0
+            return self.kernel.spawn(namespace, cmd)
+
+    def set_offloads(self, namespace, dev, offloads):
+        with command_span(f"ethtool -K {dev} {offload_flags(offloads)}", namespace, self.name) as span:
+            self.kernel.set_offloads(namespace or HOST, dev, offloads)
+            span['exit_code'] = 0
+
+    def namespace_pids(self, namespaces):
+        return self.kernel.namespace_pids(namespaces)
+
+    def running(self, pids):
+        # Simulated processes run until they're killed and have no start time
+        alive = {pid for ns_pids in self.kernel.namespace_pids(list(self.kernel.namespaces)).values()
+                 for pid in ns_pids}
+        return {pid: 0 for pid in pids if pid in alive}
+
+    def terminate(self, pids, grace=5):
+        self.kernel.kill(pids)
+        return []
+
+    def interface_stats(self):
+        return self.kernel.interface_stats()
+
+# iptables helpers
+
+def _builtins(table, name):
+    for chain in TABLE_CHAINS.get(name, ()):
+        table.setdefault(chain, {'policy': 'ACCEPT', 'counters': [0, 0], 'rules': []})
+    return table
+
+def _table(ns, name):
+    return _builtins(ns['iptables'].setdefault(name, {}), name)
+
+def _target(tokens):
+    return tokens[tokens.index('-j') + 1] if '-j' in tokens else None
+
+def _apply(table, op, args):
+    """One iptables operation on a table; returns an error message or None"""
+    chain = args[0] if args else None
+    rule = args[1:]
+    if op == '-N':
+        if chain in table:
+            return "Chain already exists."
+        table[chain] = {'policy': None, 'counters': [0, 0], 'rules': []}
+        return None
+    if op == '-F':
+        for name in [chain] if chain else list(table):
+            table[name]['rules'] = []
+        return None
+    if op == '-X':
+        for name in [chain] if chain else [n for n, c in table.items() if c['policy'] is None]:
+            del table[name]
+        return None
+    if chain not in table:
+        return "No chain/target/match by that name."
+    entry = table[chain]
+    if op == '-P':
+        entry['policy'] = args[1]
+        return None
+
+    target = _target(rule)
+    if target and target not in TARGETS and target not in table:
+        return "No chain/target/match by that name."
+    if op == '-A':
+        entry['rules'].append([rule, 0, 0])
+    elif op == '-I':
+        position = int(rule.pop(0)) - 1 if rule and rule[0].isdigit() else 0
+        entry['rules'].insert(position, [rule, 0, 0])
+    elif op in ('-D', '-C'):
+        for existing in entry['rules']:
+            if existing[0] == rule:
+                if op == '-D':
+                    entry['rules'].remove(existing)
+                return None
+        return "Bad rule (does a matching rule exist in that chain?)."
+    else:
+        return f"unknown option {op}"
+    return None
+
+def _in_list(value, spec):
+    if value is None:
+        return False
+    return any(ipaddress.ip_address(value) in ipaddress.ip_network(s, strict=False)
+               for s in spec.split(','))
+
+def _port_in(port, spec):
+    if port is None:
+        return False
+    for part in spec.split(','):
+        lo, _, hi = part.partition(':')
+        if int(lo) <= port <= int(hi or lo):
+            return True
+    return False
+
+def _matches(tokens, packet):
+    """Does a rule's match part match the packet?"""
+    i, negate = 0, False
+    while i < len(tokens):
+        option = tokens[i]
+        if option == '!':
+            negate = True
+            i += 1
+            continue
+        value = tokens[i + 1] if i + 1 < len(tokens) else None
+        if option == '-j':
+            break
+        if option in ('-m', '--comment'):
+            i += 2
+            continue
+        if option == '-p':
+            result = value == 'all' or value == packet['proto']
+        elif option == '-s':
+            result = _in_list(packet['src'], value)
+        elif option == '-d':
+            result = _in_list(packet['dst'], value)
+        elif option in ('-i', '-o'):
+            dev = packet.get('in' if option == '-i' else 'out')
+            result = dev is not None and (dev == value or
+                                          (value.endswith('+') and dev.startswith(value[:-1])))
+        elif option in ('--state', '--ctstate'):
+            result = packet['state'] in value.split(',')
+        elif option in ('--dport', '--dports', '--destination-port', '--destination-ports'):
+            result = _port_in(packet.get('dport'), value)
+        else:
+            # Anything we don't model can't be shown to match
+            return False
+        if result == negate:
+            return False
+        negate = False
+        i += 2
+    return True
+
+def _traverse(table, chain, packet, depth=0):
+    """Walk a chain: the verdict, or None to fall through"""
+    for entry in table[chain]['rules']:
+        tokens = entry[0]
+        if not _matches(tokens, packet):
+            continue
+        entry[1] += 1
+        entry[2] += PING_BYTES
+        target = _target(tokens)
+        if target in ('ACCEPT', 'DROP'):
+            return target
+        if target == 'REJECT':
+            return 'DROP'
+        if target == 'RETURN':
+            return None
+        if target in table and depth < 16:
+            verdict = _traverse(table, target, packet, depth + 1)
+            if verdict:
+                return verdict
+    if table[chain]['policy']:
+        table[chain]['counters'][0] += 1
+        table[chain]['counters'][1] += PING_BYTES
+    return None
+
+def _save_lines(table, chains, counters, rules_only=False):
+    out = []
+    if not rules_only:
+        for name in chains:
+            entry = table[name]
+            packets, octets = entry['counters']
+            out.append(f":{name} {entry['policy'] or '-'} [{packets}:{octets}]")
+    for name in chains:
+        for tokens, packets, octets in table[name]['rules']:
+            prefix = f"[{packets}:{octets}] " if counters else ''
+            out.append(f"{prefix}-A {name} {shlex.join(tokens)}")
+    return '\n'.join(out) + '\n'
+
+def _option(tokens, option, default):
+    return tokens[tokens.index(option) + 1] if option in tokens else default
+
+def _list(table, chains):
+    out = []
+    for name in chains:
+        entry = table[name]
+        if entry['policy']:
+            packets, octets = entry['counters']
+            out.append(f"Chain {name} (policy {entry['policy']} {packets} packets, {octets} bytes)")
+        else:
+            out.append(f"Chain {name} (user chain)")
+        out.append(f"{'pkts':>5} {'bytes':>5} {'target':<10} {'prot':<5} {'in':<6} {'out':<6} "
+                   f"{'source':<20} destination")
+        for tokens, packets, octets in entry['rules']:
+            extra = []
+            if '--dport' in tokens or '--dports' in tokens:
+                extra.append(f"dpt:{_option(tokens, '--dport', _option(tokens, '--dports', ''))}")
+            if '--comment' in tokens:
+                extra.append(f"/* {_option(tokens, '--comment', '')} */")
+            if '--state' in tokens:
+                extra.append(f"state {_option(tokens, '--state', '')}")
+            out.append(f"{packets:>5} {octets:>5} {_target(tokens) or '':<10} "
+                       f"{_option(tokens, '-p', 'all'):<5} {_option(tokens, '-i', '*'):<6} "
+                       f"{_option(tokens, '-o', '*'):<6} {_option(tokens, '-s', '0.0.0.0/0'):<20} "
+                       f"{_option(tokens, '-d', '0.0.0.0/0')} {' '.join(extra)}".rstrip())
+        out.append('')
+    return '\n'.join(out)
+
+def _nft_rules(text):
+    """Rules of a stored nft payload as `nft -j` would list them (counters stay 0)"""
+    rules = []
+    for line in text.splitlines():
+        if 'comment "' not in line:
+            continue
+        comment = line.split('comment "', 1)[1].split('"', 1)[0]
+        expr = [{'counter': {'packets': 0, 'bytes': 0}}]
+        words = line.split()
+        if 'accept' in words:
+            expr.append({'accept': None})
+        elif 'drop' in words:
+            expr.append({'drop': None})
+        rules.append({'rule': {'comment': comment, 'expr': expr}})
+    return rules
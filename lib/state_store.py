@@ -0,0 +1,517 @@
+"""
+State Store - Where vpcctl remembers VPCs, subnets, peerings and transit hubs
+
+Two implementations with the same interface:
+
+- SQLiteStateStore (default): /var/lib/vpcctl/state.db in WAL mode. Every
+  write is its own small transaction touching only the affected rows, and
+  lookups by VPC, subnet, namespace, bridge or veth hit an index. Safe for
+  concurrent vpcctl runs (SQLite does the locking).
+- JSONStateStore: the original /var/lib/vpcctl/state.json, rewritten as a
+  whole under a file lock. Kept as a fallback (VPCCTL_STATE_STORE=json).
+
+The first time the SQLite store opens it imports an existing state.json
+and renames it to state.json.migrated.
+
+Objects are plain dicts, same shape as they always were in state.json.
+
+VPCCTL_STATE_DIR moves the whole state somewhere else (the simulated
+kernel's runs default to their own directory, see sim_kernel.py).
+"""
+
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+STATE_DIR = '/var/lib/vpcctl'
+
+def state_dir():
+    """Where the state lives: VPCCTL_STATE_DIR, or /var/lib/vpcctl"""
+    return os.environ.get('VPCCTL_STATE_DIR', STATE_DIR)
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS vpcs (
+    name TEXT PRIMARY KEY,
+    cidr TEXT NOT NULL,
+    bridge TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS vpcs_bridge ON vpcs(bridge);
+CREATE TABLE IF NOT EXISTS subnets (
+    vpc TEXT NOT NULL REFERENCES vpcs(name) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    cidr TEXT NOT NULL,
+    namespace TEXT NOT NULL,
+    veth_host TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (vpc, name)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS subnets_namespace ON subnets(namespace);
+CREATE UNIQUE INDEX IF NOT EXISTS subnets_veth ON subnets(veth_host);
+CREATE TABLE IF NOT EXISTS peerings (
+    vpc1 TEXT NOT NULL REFERENCES vpcs(name) ON DELETE CASCADE,
+    vpc2 TEXT NOT NULL REFERENCES vpcs(name) ON DELETE CASCADE,
+    data TEXT NOT NULL,
+    PRIMARY KEY (vpc1, vpc2)
+);
+CREATE INDEX IF NOT EXISTS peerings_vpc2 ON peerings(vpc2);
+CREATE TABLE IF NOT EXISTS hubs (
+    name TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+class SQLiteStateStore:
+    """Row-level state in a WAL-mode SQLite database"""
+
+    def __init__(self, state_dir=STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.state_dir = state_dir
+        self.path = os.path.join(state_dir, 'state.db')
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        db.executescript(SCHEMA)
+        self._migrate_json()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA foreign_keys=ON')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def transaction(self):
+        """Run a group of writes atomically"""
+        db = self._db()
+        if db.in_transaction:
+            # Nested: the outer transaction commits
+            yield db
+            return
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def _migrate_json(self):
+        """One-time import of an existing state.json"""
+        json_file = os.path.join(self.state_dir, 'state.json')
+        if not os.path.exists(json_file):
+            return
+
+        with self.transaction() as db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'migrated_from'").fetchone():
+                return
+            with open(json_file, 'r') as f:
+                state = json.load(f)
+            self._insert_all(db, state)
+            db.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (json_file,))
+        os.replace(json_file, f"{json_file}.migrated")
+
+    def _insert_all(self, db, state):
+        for vpc_name, vpc in state.get('vpcs', {}).items():
+            self._insert_vpc(db, vpc_name, vpc)
+            for subnet_name, subnet in vpc.get('subnets', {}).items():
+                self._insert_subnet(db, vpc_name, subnet_name, subnet)
+        for peering in state.get('peerings', []):
+            self._insert_peering(db, peering)
+        for hub_name, hub in state.get('hubs', {}).items():
+            db.execute('INSERT INTO hubs (name, data) VALUES (?, ?)', (hub_name, json.dumps(hub)))
+
+    def _insert_vpc(self, db, name, vpc):
+        data = {k: v for k, v in vpc.items() if k != 'subnets'}
+        db.execute(
+            'INSERT INTO vpcs (name, cidr, bridge, data) VALUES (?, ?, ?, ?)',
+            (name, vpc['cidr'], vpc['bridge'], json.dumps(data))
+        )
+
+    def _insert_subnet(self, db, vpc_name, name, subnet):
+        db.execute(
+            'INSERT INTO subnets (vpc, name, cidr, namespace, veth_host, data) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (vpc_name, name, subnet['cidr'], subnet['namespace'],
+             subnet['veth_host'], json.dumps(subnet))
+        )
+
+    def _insert_peering(self, db, peering):
+        db.execute(
+            'INSERT INTO peerings (vpc1, vpc2, data) VALUES (?, ?, ?)',
+            (peering['vpc1'], peering['vpc2'], json.dumps(peering))
+        )
+
+    # VPCs
+
+    def get_vpc(self, name, subnets=False):
+        """Return a VPC dict (optionally with its subnets) or None"""
+        row = self._db().execute('SELECT data FROM vpcs WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        vpc = json.loads(row['data'])
+        vpc['subnets'] = self.get_subnets(name) if subnets else {}
+        return vpc
+
+    def find_vpc_by_bridge(self, bridge):
+        row = self._db().execute('SELECT name FROM vpcs WHERE bridge = ?', (bridge,)).fetchone()
+        return row['name'] if row else None
+
+    def list_vpcs(self):
+        return [r['name'] for r in self._db().execute('SELECT name FROM vpcs ORDER BY rowid')]
+
+    def add_vpc(self, name, vpc):
+        try:
+            with self.transaction() as db:
+                self._insert_vpc(db, name, vpc)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"VPC {name} already exists")
+
+    def update_vpc(self, name, **fields):
+        """Merge fields into a VPC row"""
+        with self.transaction() as db:
+            row = db.execute('SELECT data FROM vpcs WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                raise ValueError(f"VPC {name} does not exist")
+            data = json.loads(row['data'])
+            data.update(fields)
+            db.execute('UPDATE vpcs SET data = ? WHERE name = ?', (json.dumps(data), name))
+
+    def delete_vpc(self, name):
+        """Delete a VPC along with its subnets and peerings"""
+        with self.transaction() as db:
+            db.execute('DELETE FROM vpcs WHERE name = ?', (name,))
+
+    # Subnets
+
+    def get_subnets(self, vpc_name):
+        rows = self._db().execute(
+            'SELECT name, data FROM subnets WHERE vpc = ? ORDER BY rowid', (vpc_name,)
+        )
+        return {r['name']: json.loads(r['data']) for r in rows}
+
+    def get_subnet(self, vpc_name, name):
+        row = self._db().execute(
+            'SELECT data FROM subnets WHERE vpc = ? AND name = ?', (vpc_name, name)
+        ).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def find_subnet_by_namespace(self, namespace):
+        """Return (vpc_name, subnet_name) for a namespace, or None"""
+        row = self._db().execute(
+            'SELECT vpc, name FROM subnets WHERE namespace = ?', (namespace,)
+        ).fetchone()
+        return (row['vpc'], row['name']) if row else None
+
+    def find_subnet_by_veth(self, veth):
+        """Return (vpc_name, subnet_name) for a host-side veth, or None"""
+        row = self._db().execute(
+            'SELECT vpc, name FROM subnets WHERE veth_host = ?', (veth,)
+        ).fetchone()
+        return (row['vpc'], row['name']) if row else None
+
+    def add_subnet(self, vpc_name, name, subnet):
+        try:
+            with self.transaction() as db:
+                self._insert_subnet(db, vpc_name, name, subnet)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Subnet {name} already exists in VPC {vpc_name}")
+
+    def update_subnet(self, vpc_name, name, **fields):
+        """Merge fields into a subnet row (a None value removes the field)"""
+        with self.transaction() as db:
+            row = db.execute(
+                'SELECT data FROM subnets WHERE vpc = ? AND name = ?', (vpc_name, name)
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"Subnet {name} does not exist in VPC {vpc_name}")
+            data = json.loads(row['data'])
+            for key, value in fields.items():
+                if value is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = value
+            db.execute(
+                'UPDATE subnets SET data = ? WHERE vpc = ? AND name = ?',
+                (json.dumps(data), vpc_name, name)
+            )
+
+    def delete_subnet(self, vpc_name, name):
+        with self.transaction() as db:
+            db.execute('DELETE FROM subnets WHERE vpc = ? AND name = ?', (vpc_name, name))
+
+    # Peerings
+
+    def list_peerings(self, vpc_name=None):
+        if vpc_name is None:
+            rows = self._db().execute('SELECT data FROM peerings ORDER BY rowid')
+        else:
+            rows = self._db().execute(
+                'SELECT data FROM peerings WHERE vpc1 = ? OR vpc2 = ? ORDER BY rowid',
+                (vpc_name, vpc_name)
+            )
+        return [json.loads(r['data']) for r in rows]
+
+    def get_peering(self, vpc1_name, vpc2_name):
+        row = self._db().execute(
+            'SELECT data FROM peerings WHERE (vpc1 = ? AND vpc2 = ?) OR (vpc1 = ? AND vpc2 = ?)',
+            (vpc1_name, vpc2_name, vpc2_name, vpc1_name)
+        ).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def add_peering(self, peering):
+        try:
+            with self.transaction() as db:
+                self._insert_peering(db, peering)
+        except sqlite3.IntegrityError:
+            raise ValueError(
+                f"Peering already exists between {peering['vpc1']} and {peering['vpc2']}"
+            )
+
+    def delete_peering(self, vpc1_name, vpc2_name):
+        with self.transaction() as db:
+            db.execute(
+                'DELETE FROM peerings WHERE (vpc1 = ? AND vpc2 = ?) OR (vpc1 = ? AND vpc2 = ?)',
+                (vpc1_name, vpc2_name, vpc2_name, vpc1_name)
+            )
+
+    # Transit hubs
+
+    def list_hubs(self):
+        rows = self._db().execute('SELECT name, data FROM hubs ORDER BY rowid')
+        return {r['name']: json.loads(r['data']) for r in rows}
+
+    def get_hub(self, name):
+        row = self._db().execute('SELECT data FROM hubs WHERE name = ?', (name,)).fetchone()
+        return json.loads(row['data']) if row else None
+
+    def add_hub(self, name, hub):
+        try:
+            with self.transaction() as db:
+                db.execute('INSERT INTO hubs (name, data) VALUES (?, ?)', (name, json.dumps(hub)))
+        except sqlite3.IntegrityError:
+            raise ValueError(f"Transit hub {name} already exists")
+
+    def update_hub(self, name, hub):
+        with self.transaction() as db:
+            db.execute('UPDATE hubs SET data = ? WHERE name = ?', (json.dumps(hub), name))
+
+    def delete_hub(self, name):
+        with self.transaction() as db:
+            db.execute('DELETE FROM hubs WHERE name = ?', (name,))
+
+    # Whole state (listings, topology diffs)
+
+    def load(self):
+        """Return everything in the old state.json shape"""
+        vpcs = {}
+        for r in self._db().execute('SELECT name, data FROM vpcs ORDER BY rowid'):
+            vpcs[r['name']] = json.loads(r['data'])
+            vpcs[r['name']]['subnets'] = {}
+        for r in self._db().execute('SELECT vpc, name, data FROM subnets ORDER BY rowid'):
+            vpcs[r['vpc']]['subnets'][r['name']] = json.loads(r['data'])
+        return {'vpcs': vpcs, 'peerings': self.list_peerings(), 'hubs': self.list_hubs()}
+
+    def replace(self, state):
+        """Overwrite everything with a state dict"""
+        with self.transaction() as db:
+            db.execute('DELETE FROM vpcs')
+            db.execute('DELETE FROM hubs')
+            self._insert_all(db, state)
+
+class JSONStateStore:
+    """The original whole-file state.json, rewritten under an flock"""
+
+    def __init__(self, state_dir=STATE_DIR):
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, 'state.json')
+        self.lock_path = os.path.join(state_dir, 'state.lock')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        """Load, modify and save the whole file under a lock"""
+        state = getattr(self._local, 'state', None)
+        if state is not None:
+            # Nested: the outer transaction saves
+            yield state
+            return
+        with self._lock:
+            with open(self.lock_path, 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._local.state = state = self.load()
+                try:
+                    yield state
+                finally:
+                    self._local.state = None
+                self.replace(state)
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        return {'vpcs': {}, 'peerings': [], 'hubs': {}}
+
+    def replace(self, state):
+        # Write to a temp file and rename so readers never see a half-written file
+        tmp_file = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_file, self.path)
+
+    def get_vpc(self, name, subnets=False):
+        vpc = self.load()['vpcs'].get(name)
+        if vpc is not None and not subnets:
+            vpc['subnets'] = {}
+        return vpc
+
+    def find_vpc_by_bridge(self, bridge):
+        for name, vpc in self.load()['vpcs'].items():
+            if vpc['bridge'] == bridge:
+                return name
+        return None
+
+    def list_vpcs(self):
+        return list(self.load()['vpcs'])
+
+    def add_vpc(self, name, vpc):
+        with self.transaction() as state:
+            if name in state['vpcs']:
+                raise ValueError(f"VPC {name} already exists")
+            state['vpcs'][name] = dict(vpc, subnets={})
+
+    def update_vpc(self, name, **fields):
+        with self.transaction() as state:
+            if name not in state['vpcs']:
+                raise ValueError(f"VPC {name} does not exist")
+            state['vpcs'][name].update(fields)
+
+    def delete_vpc(self, name):
+        with self.transaction() as state:
+            state['vpcs'].pop(name, None)
+            state['peerings'] = [
+                p for p in state.get('peerings', []) if name not in [p['vpc1'], p['vpc2']]
+            ]
+
+    def get_subnets(self, vpc_name):
+        vpc = self.load()['vpcs'].get(vpc_name)
+        return vpc['subnets'] if vpc else {}
+
+    def get_subnet(self, vpc_name, name):
+        return self.get_subnets(vpc_name).get(name)
+
+    def _find_subnet(self, key, value):
+        for vpc_name, vpc in self.load()['vpcs'].items():
+            for subnet_name, subnet in vpc['subnets'].items():
+                if subnet[key] == value:
+                    return (vpc_name, subnet_name)
+        return None
+
+    def find_subnet_by_namespace(self, namespace):
+        return self._find_subnet('namespace', namespace)
+
+    def find_subnet_by_veth(self, veth):
+        return self._find_subnet('veth_host', veth)
+
+    def add_subnet(self, vpc_name, name, subnet):
+        with self.transaction() as state:
+            subnets = state['vpcs'][vpc_name]['subnets']
+            if name in subnets:
+                raise ValueError(f"Subnet {name} already exists in VPC {vpc_name}")
+            subnets[name] = subnet
+
+    def update_subnet(self, vpc_name, name, **fields):
+        with self.transaction() as state:
+            subnet = state['vpcs'].get(vpc_name, {}).get('subnets', {}).get(name)
+            if subnet is None:
+                raise ValueError(f"Subnet {name} does not exist in VPC {vpc_name}")
+            for key, value in fields.items():
+                if value is None:
+                    subnet.pop(key, None)
+                else:
+                    subnet[key] = value
+
+    def delete_subnet(self, vpc_name, name):
+        with self.transaction() as state:
+            if vpc_name in state['vpcs']:
+                state['vpcs'][vpc_name]['subnets'].pop(name, None)
+
+    def list_peerings(self, vpc_name=None):
+        peerings = self.load().get('peerings', [])
+        if vpc_name is None:
+            return peerings
+        return [p for p in peerings if vpc_name in [p['vpc1'], p['vpc2']]]
+
+    def get_peering(self, vpc1_name, vpc2_name):
+        for p in self.list_peerings(vpc1_name):
+            if vpc2_name in [p['vpc1'], p['vpc2']]:
+                return p
+        return None
+
+    def add_peering(self, peering):
+        with self.transaction() as state:
+            pair = {peering['vpc1'], peering['vpc2']}
+            if any({p['vpc1'], p['vpc2']} == pair for p in state.get('peerings', [])):
+                raise ValueError(
+                    f"Peering already exists between {peering['vpc1']} and {peering['vpc2']}"
+                )
+            state.setdefault('peerings', []).append(peering)
+
+    def delete_peering(self, vpc1_name, vpc2_name):
+        with self.transaction() as state:
+            pair = {vpc1_name, vpc2_name}
+            state['peerings'] = [
+                p for p in state.get('peerings', []) if {p['vpc1'], p['vpc2']} != pair
+            ]
+
+    def list_hubs(self):
+        return self.load().get('hubs', {})
+
+    def get_hub(self, name):
+        return self.list_hubs().get(name)
+
+    def add_hub(self, name, hub):
+        with self.transaction() as state:
+            hubs = state.setdefault('hubs', {})
+            if name in hubs:
+                raise ValueError(f"Transit hub {name} already exists")
+            hubs[name] = hub
+
+    def update_hub(self, name, hub):
+        with self.transaction() as state:
+            state.setdefault('hubs', {})[name] = hub
+
+    def delete_hub(self, name):
+        with self.transaction() as state:
+            state.get('hubs', {}).pop(name, None)
+
+def get_store(kind=None):
+    """Return the state store (sqlite unless VPCCTL_STATE_STORE=json)"""
+    kind = kind or os.environ.get('VPCCTL_STATE_STORE', 'sqlite')
+    directory = state_dir()
+    with _stores_lock:
+        if (kind, directory) not in _stores:
+            if kind == 'sqlite':
+                _stores[(kind, directory)] = SQLiteStateStore(directory)
+            elif kind == 'json':
+                _stores[(kind, directory)] = JSONStateStore(directory)
+            else:
+                raise ValueError(f"Unknown state store: {kind}")
+        return _stores[(kind, directory)]
@@ -6,50 +6,48 @@ The key was using the 'onlink' flag to allow gateways outside the subnet.
 """
 
 import os
-from utils import (
-    run_command, load_vpc_state, save_vpc_state,
-    validate_cidr, cidr_contains, get_namespace_ip,
-    namespace_exists
-)
+import shutil
+import time
+from utils import validate_cidr, cidr_contains, get_namespace_ip, get_bridge_ip
+from backends import get_backend
+from state_store import get_store
+from ipam import AddressPool, vpc_pool
+from peering_manager import peered_cidrs
+from transit_manager import hub_routes
+from profiles import load_profile, veth_options, bridge_options
+from tracing import traced
+
+def app_running(app, running):
+    """Is a recorded app still the process deploy-app started?
+
+    running is backend.running() for its pid: a pid that's been recycled
+    by some other process comes back with a different start time.
+    """
+    return running.get(app['pid']) == app['start_ticks']
 
 class SubnetManager:
-    def __init__(self, logger):
+    def __init__(self, logger, backend=None):
         self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
+
+    @traced
+    def create_subnet(self, vpc_name, subnet_name, cidr, subnet_type, prefix_len=None, profile=None):
+        """Create a subnet within a VPC (cidr=None allocates a free /prefix_len)
 
-    def create_subnet(self, vpc_name, subnet_name, cidr, subnet_type):
-        """Create a subnet within a VPC"""
+        profile names a built-in tuning profile or a JSON file (see profiles.py).
+        """
         self.logger.info(f"Creating subnet {subnet_name} in VPC {vpc_name}")
         
         # Validate CIDR
-        if not validate_cidr(cidr):
+        if cidr is not None and not validate_cidr(cidr):
             raise ValueError(f"Invalid CIDR: {cidr}")
         
-        # Load state
-        state = load_vpc_state()
-        
-        if vpc_name not in state['vpcs']:
-            raise ValueError(f"VPC {vpc_name} does not exist")
-        
-        vpc = state['vpcs'][vpc_name]
-        
-        # Check if subnet already exists
-        if subnet_name in vpc['subnets']:
-            raise ValueError(f"Subnet {subnet_name} already exists in VPC {vpc_name}")
-        
-        # Validate CIDR is within VPC CIDR
-        if not cidr_contains(vpc['cidr'], cidr):
-            raise ValueError(f"Subnet CIDR {cidr} is not within VPC CIDR {vpc['cidr']}")
+        profile = load_profile(profile) if profile else None
+        settings = profile['settings'] if profile else {}
         
-        # Create namespace
         ns_name = f"ns-{vpc_name}-{subnet_name}"
         
-        if namespace_exists(ns_name):
-            self.logger.warning(f"Namespace {ns_name} exists, removing it first")
-            run_command(f"ip netns delete {ns_name}", check=False)
-        
-        self.logger.info(f"Creating namespace: {ns_name}")
-        run_command(f"ip netns add {ns_name}")
-        
         # Create veth pair
         # IMPORTANT: Linux has a 15-char limit for interface names (IFNAMSIZ)
         # Learned this the hard way when long names like "veth-demo-vpc-public" failed
@@ -58,101 +56,211 @@ class SubnetManager:
         name_hash = hashlib.md5(f"{vpc_name}-{subnet_name}".encode()).hexdigest()[:6]
         
         veth_host = f"veth-{name_hash}"
-        veth_ns = f"vpeer-{name_hash}"
-        
-        self.logger.info(f"Creating veth pair: {veth_host} <-> {veth_ns}")
-        run_command(f"ip link add {veth_host} type veth peer name {veth_ns}")
-        
-        # Move one end to namespace
-        run_command(f"ip link set {veth_ns} netns {ns_name}")
-        
-        # Rename interface inside namespace to eth0 for simplicity
-        run_command(f"ip netns exec {ns_name} ip link set {veth_ns} name eth0")
         veth_ns_renamed = "eth0"
-        
-        # Attach host end to bridge
-        bridge_name = vpc['bridge']
-        self.logger.info(f"Attaching {veth_host} to bridge {bridge_name}")
-        run_command(f"ip link set {veth_host} master {bridge_name}")
-        run_command(f"ip link set {veth_host} up")
-        
-        # Configure namespace interface
-        ns_ip = get_namespace_ip(cidr)
-        # Get the correct prefix length from CIDR
-        prefix_len = cidr.split('/')[1]
-        self.logger.info(f"Configuring namespace interface with IP: {ns_ip}/{prefix_len}")
-        run_command(f"ip netns exec {ns_name} ip addr add {ns_ip}/{prefix_len} dev {veth_ns_renamed}")
-        run_command(f"ip netns exec {ns_name} ip link set {veth_ns_renamed} up")
-        run_command(f"ip netns exec {ns_name} ip link set lo up")
-        
-        # Add route to VPC network through the bridge
-        # The bridge has the first IP in the VPC CIDR range
-        import ipaddress
-        vpc_network = ipaddress.ip_network(vpc['cidr'], strict=False)
-        gateway_ip = str(list(vpc_network.hosts())[0])
-        
-        # Add route for the entire VPC CIDR through the bridge
-        # The 'onlink' flag here is crucial - it tells the kernel the gateway is reachable
-        # even though it's not in the same subnet. Without this, you get "Network unreachable"
-        self.logger.info(f"Adding route to VPC {vpc['cidr']} via {gateway_ip}")
-        run_command(f"ip netns exec {ns_name} ip route add {vpc['cidr']} via {gateway_ip} dev {veth_ns_renamed} onlink", check=False)
-        
-        # Add default route for everything else
-        self.logger.info(f"Setting default gateway: {gateway_ip}")
-        run_command(f"ip netns exec {ns_name} ip route add default via {gateway_ip} dev {veth_ns_renamed} onlink", check=False)
-        
-        # Enable forwarding in namespace
-        run_command(f"ip netns exec {ns_name} sysctl -w net.ipv4.ip_forward=1")
-        
-        # Configure NAT if public subnet
-        if subnet_type == 'public':
-            self._configure_nat(ns_name, cidr, vpc.get('interface', 'eth0'))
-        
-        # Store subnet info
-        vpc['subnets'][subnet_name] = {
-            'cidr': cidr,
-            'type': subnet_type,
-            'namespace': ns_name,
-            'veth_host': veth_host,
-            'veth_ns': veth_ns_renamed,
-            'ip': ns_ip
-        }
-        
-        save_vpc_state(state)
+        # Pick the CIDR and record the subnet in one store transaction, so a
+        # subnet created at the same time (apply creates them in parallel)
+        # can't be given an overlapping CIDR
+        with self.store.transaction():
+            vpc = self.store.get_vpc(vpc_name, subnets=True)
+            
+            if vpc is None:
+                raise ValueError(f"VPC {vpc_name} does not exist")
+            
+            # Check if subnet already exists
+            if subnet_name in vpc['subnets']:
+                raise ValueError(f"Subnet {subnet_name} already exists in VPC {vpc_name}")
+            
+            if cidr is None:
+                if prefix_len is None:
+                    raise ValueError("Either a CIDR or a prefix length is required")
+                cidr = str(vpc_pool(vpc).allocate(prefix_len))
+                self.logger.info(f"Allocated CIDR {cidr} from VPC {vpc['cidr']}")
+            
+            # Validate CIDR is within VPC CIDR
+            if not cidr_contains(vpc['cidr'], cidr):
+                raise ValueError(f"Subnet CIDR {cidr} is not within VPC CIDR {vpc['cidr']}")
+            
+            # ...and doesn't overlap another subnet
+            used = [subnet['cidr'] for subnet in vpc['subnets'].values()]
+            if not AddressPool(vpc['cidr'], used).is_free(cidr):
+                raise ValueError(f"Subnet CIDR {cidr} overlaps an existing subnet in VPC {vpc_name}")
+            
+            # The bridge is the VPC's, so its options are recorded there, and
+            # a profile can't quietly undo what another subnet's profile set
+            wanted = bridge_options(settings)
+            current = vpc.get('bridge_options', {})
+            conflicts = [f"{key} {current[key]} -> {value}" for key, value in wanted.items()
+                         if key in current and current[key] != value]
+            if conflicts:
+                raise ValueError(f"Profile {profile['name']} changes bridge options VPC {vpc_name} "
+                                 f"already has: {', '.join(conflicts)}")
+            if wanted.keys() - current.keys():
+                self.store.update_vpc(vpc_name, bridge_options={**current, **wanted})
+            
+            ns_ip = get_namespace_ip(cidr)
+            self.store.add_subnet(vpc_name, subnet_name, {
+                'cidr': cidr,
+                'type': subnet_type,
+                'namespace': ns_name,
+                'veth_host': veth_host,
+                'veth_ns': veth_ns_renamed,
+                'ip': ns_ip,
+                **({'profile': profile} if profile else {})
+            })
+        
+        # The subnet is already recorded, so give its CIDR back if it can't be built
+        try:
+            if self.backend.namespace_exists(ns_name):
+                self.logger.warning(f"Namespace {ns_name} exists, removing it first")
+                self.backend.delete_namespace(ns_name, check=False)
+            
+            bridge_name = vpc['bridge']
+            
+            # Host side: namespace, veth pair and bridge attachment in one batch.
+            # The peer end is created straight inside the namespace as eth0, which
+            # saves the separate "set netns" and rename steps.
+            self.logger.info(f"Creating namespace: {ns_name}")
+            self.logger.info(f"Creating veth pair: {veth_host} <-> {ns_name}:{veth_ns_renamed}")
+            self.logger.info(f"Attaching {veth_host} to bridge {bridge_name}")
+            host_batch = self.backend.batch()
+            host_batch.add_netns(ns_name, f"namespace {ns_name}")
+            host_batch.add_veth(veth_host, veth_ns_renamed, f"veth {veth_host}", peer_netns=ns_name,
+                                options=veth_options(settings))
+            host_batch.set_link(veth_host, f"veth {veth_host}", up=True, master=bridge_name)
+            if wanted:
+                # The bridge is the VPC's, so this applies to every subnet on it
+                self.logger.info(f"Setting bridge options on {bridge_name}")
+                host_batch.set_bridge(bridge_name, f"bridge {bridge_name}", **wanted)
+            host_batch.commit()
+            
+            if settings.get('offloads'):
+                # Both ends: GSO/TSO matter on the sending side, GRO on the receiving one
+                self.backend.set_offloads(None, veth_host, settings['offloads'])
+                self.backend.set_offloads(ns_name, veth_ns_renamed, settings['offloads'])
+            
+            # Traffic between subnets is routed through the bridge, which runs at
+            # the smallest MTU of its ports
+            mtu = settings.get('mtu', 1500)
+            others = {other.get('profile', {}).get('settings', {}).get('mtu', 1500)
+                      for other in vpc['subnets'].values()}
+            if others - {mtu}:
+                self.logger.warning(f"Other subnets in VPC {vpc_name} use MTU "
+                                    f"{', '.join(map(str, sorted(others)))}; traffic between "
+                                    f"subnets is routed at the smallest MTU")
+            
+            # Configure namespace interface
+            # Get the correct prefix length from CIDR
+            prefix_len = cidr.split('/')[1]
+            self.logger.info(f"Configuring namespace interface with IP: {ns_ip}/{prefix_len}")
+            
+            # Add route to VPC network through the bridge
+            # The bridge has the first IP in the VPC CIDR range
+            gateway_ip = get_bridge_ip(vpc['cidr'])
+            
+            # Namespace side: address, link state and routes in one batch
+            ns_batch = self.backend.batch(ns_name)
+            owner = f"subnet {subnet_name} ({ns_name})"
+            ns_batch.add_address(veth_ns_renamed, f"{ns_ip}/{prefix_len}", owner)
+            ns_batch.set_link(veth_ns_renamed, owner, up=True)
+            ns_batch.set_link("lo", owner, up=True)
+            
+            # Add route for the entire VPC CIDR through the bridge
+            # The 'onlink' flag here is crucial - it tells the kernel the gateway is reachable
+            # even though it's not in the same subnet. Without this, you get "Network unreachable"
+            self.logger.info(f"Adding route to VPC {vpc['cidr']} via {gateway_ip}")
+            ns_batch.add_route(
+                vpc['cidr'], f"route {vpc['cidr']} ({ns_name})",
+                via=gateway_ip, dev=veth_ns_renamed, onlink=True, check=False
+            )
+            
+            # Add default route for everything else
+            self.logger.info(f"Setting default gateway: {gateway_ip}")
+            ns_batch.add_route(
+                'default', f"default route ({ns_name})",
+                via=gateway_ip, dev=veth_ns_renamed, onlink=True, check=False
+            )
+            
+            # Routes to peered VPCs, so peerings made before this subnet cover it too
+            for remote_cidr in peered_cidrs(self.store, vpc_name):
+                self.logger.info(f"Adding route to peered VPC {remote_cidr} via {gateway_ip}")
+                ns_batch.add_route(
+                    remote_cidr, f"route {remote_cidr} ({ns_name})",
+                    via=gateway_ip, dev=veth_ns_renamed, onlink=True, check=False
+                )
+            
+            # ...and to VPCs reachable through a transit hub
+            for remote_cidr, hub_ip in hub_routes(self.store, vpc_name):
+                self.logger.info(f"Adding route to {remote_cidr} via transit hub {hub_ip}")
+                ns_batch.add_route(
+                    remote_cidr, f"route {remote_cidr} ({ns_name})",
+                    via=hub_ip, dev=veth_ns_renamed, onlink=True, check=False
+                )
+            
+            for failure in ns_batch.commit():
+                self.logger.warning(f"{failure['owner']}: {failure['error']}")
+            
+            # Enable forwarding in namespace
+            self.backend.sysctl('net.ipv4.ip_forward', 1, namespace=ns_name)
+            
+            # Configure NAT if public subnet
+            if subnet_type == 'public':
+                self._configure_nat(ns_name, cidr, vpc.get('interface', 'eth0'))
+        except BaseException:
+            # Take down whatever got built before the failure, then give
+            # the CIDR back
+            try:
+                self._undo_create(ns_name, veth_host, cidr, subnet_type, vpc.get('interface', 'eth0'))
+            except Exception as e:
+                self.logger.warning(f"Could not clean up after the failed create: {e}")
+            self.store.delete_subnet(vpc_name, subnet_name)
+            raise
         
         self.logger.info(f"✓ Subnet {subnet_name} created successfully")
         self.logger.info(f"  Type: {subnet_type}")
         self.logger.info(f"  CIDR: {cidr}")
         self.logger.info(f"  Namespace: {ns_name}")
         self.logger.info(f"  IP: {ns_ip}")
+        if profile:
+            self.logger.info(f"  Profile: {profile['name']}")
 
     def _configure_nat(self, ns_name, cidr, interface):
         """Configure NAT for public subnet"""
         self.logger.info(f"Configuring NAT for subnet {cidr}")
         
         # Enable IP forwarding on host
-        run_command("sysctl -w net.ipv4.ip_forward=1")
+        self.backend.sysctl('net.ipv4.ip_forward', 1)
         
         # Add MASQUERADE rule
-        run_command(
-            f"iptables -t nat -A POSTROUTING -s {cidr} -o {interface} -j MASQUERADE"
+        self.backend.run(
+            f"iptables -w -t nat -A POSTROUTING -s {cidr} -o {interface} -j MASQUERADE"
         )
         
         # Allow forwarding
-        run_command(f"iptables -A FORWARD -s {cidr} -j ACCEPT")
-        run_command(f"iptables -A FORWARD -d {cidr} -j ACCEPT")
+        self.backend.run(f"iptables -w -A FORWARD -s {cidr} -j ACCEPT")
+        self.backend.run(f"iptables -w -A FORWARD -d {cidr} -j ACCEPT")
+
+    def _undo_create(self, ns_name, veth_host, cidr, subnet_type, interface):
+        """Remove what a create_subnet that failed partway may have left behind"""
+        if subnet_type == 'public':
+            for rule in (f"-t nat -D POSTROUTING -s {cidr} -o {interface} -j MASQUERADE",
+                         f"-D FORWARD -s {cidr} -j ACCEPT", f"-D FORWARD -d {cidr} -j ACCEPT"):
+                self.backend.run(f"iptables -w {rule}", check=False)
+        
+        batch = self.backend.batch()
+        batch.delete_link(veth_host, f"veth {veth_host}", check=False)
+        batch.commit()
+        self.backend.delete_namespace(ns_name, check=False)
 
+    @traced
     def delete_subnet(self, vpc_name, subnet_name):
         """Delete a subnet"""
         self.logger.info(f"Deleting subnet {subnet_name} from VPC {vpc_name}")
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist in VPC {vpc_name}")
         
@@ -160,39 +268,39 @@ class SubnetManager:
         ns_name = subnet['namespace']
         veth_host = subnet['veth_host']
         
-        # Stop applications
-        self.stop_app(vpc_name, subnet_name)
+        # Stop everything in the namespace, apps started by hand included
+        self._stop_processes(ns_name)
         
         # Remove NAT rules if public
         if subnet['type'] == 'public':
             interface = vpc.get('interface', 'eth0')
-            run_command(
-                f"iptables -t nat -D POSTROUTING -s {subnet['cidr']} -o {interface} -j MASQUERADE",
+            self.backend.run(
+                f"iptables -w -t nat -D POSTROUTING -s {subnet['cidr']} -o {interface} -j MASQUERADE",
                 check=False
             )
         
         # Delete veth pair
-        run_command(f"ip link delete {veth_host}", check=False)
+        batch = self.backend.batch()
+        batch.delete_link(veth_host, f"veth {veth_host}", check=False)
+        batch.commit()
         
         # Delete namespace
-        if namespace_exists(ns_name):
-            run_command(f"ip netns delete {ns_name}")
+        if self.backend.namespace_exists(ns_name):
+            self.backend.delete_namespace(ns_name)
         
         # Remove from state
-        del vpc['subnets'][subnet_name]
-        save_vpc_state(state)
+        self.store.delete_subnet(vpc_name, subnet_name)
         
         self.logger.info(f"✓ Subnet {subnet_name} deleted successfully")
 
+    @traced
     def list_subnets(self, vpc_name):
         """List all subnets in a VPC"""
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if not vpc['subnets']:
             print(f"No subnets found in VPC {vpc_name}")
             return
@@ -207,17 +315,26 @@ class SubnetManager:
             print(f"  Namespace: {subnet_data['namespace']}")
             print(f"  IP: {subnet_data['ip']}")
             print(f"  Veth (host): {subnet_data['veth_host']}")
+            if subnet_data.get('profile'):
+                settings = subnet_data['profile']['settings']
+                details = ', '.join(f"{key} {settings[key]}" for key in ('mtu', 'queues', 'txqueuelen')
+                                    if key in settings)
+                print(f"  Profile: {subnet_data['profile']['name']}{f' ({details})' if details else ''}")
 
-    def deploy_app(self, vpc_name, subnet_name, port, app_type='python'):
+    @traced
+    def deploy_app(self, vpc_name, subnet_name, port, app_type='python', workers=1, mode='asyncio'):
         """Deploy a test application in a subnet"""
         self.logger.info(f"Deploying {app_type} app in {vpc_name}/{subnet_name} on port {port}")
         
-        state = load_vpc_state()
+        if workers < 1:
+            raise ValueError("--workers must be at least 1")
+        if app_type == 'nginx' and not shutil.which('nginx'):
+            raise ValueError("nginx is not installed (use --type python)")
         
-        if vpc_name not in state['vpcs']:
-            raise ValueError(f"VPC {vpc_name} does not exist")
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        vpc = state['vpcs'][vpc_name]
+        if vpc is None:
+            raise ValueError(f"VPC {vpc_name} does not exist")
         
         if subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
@@ -225,86 +342,174 @@ class SubnetManager:
         subnet = vpc['subnets'][subnet_name]
         ns_name = subnet['namespace']
         
-        if app_type == 'python':
-            # Create a simple HTTP server
-            app_script = f"""
-import http.server
-import socketserver
-
-PORT = {port}
-
-class MyHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html')
-        self.end_headers()
-        response = f'''
-        <html>
-        <head><title>VPC Test App</title></head>
-        <body>
-            <h1>Hello from {vpc_name}/{subnet_name}!</h1>
-            <p>Subnet IP: {subnet['ip']}</p>
-            <p>Subnet CIDR: {subnet['cidr']}</p>
-            <p>Subnet Type: {subnet['type']}</p>
-        </body>
-        </html>
-        '''
-        self.wfile.write(response.encode())
-
-with socketserver.TCPServer(("", PORT), MyHTTPRequestHandler) as httpd:
-    print(f"Server running on port {{PORT}}")
-    httpd.serve_forever()
+        # Forget apps that have exited since; a running one keeps its port
+        apps = subnet.get('apps', [])
+        running = self.backend.running([app['pid'] for app in apps])
+        apps = [app for app in apps if app_running(app, running)]
+        for app in apps:
+            if app['port'] == port:
+                raise ValueError(f"An app is already running on port {port} in "
+                                 f"{vpc_name}/{subnet_name} (pid {app['pid']}), stop it first")
+        
+        # Rendered once; both servers send it as is with every response
+        body = f"""<html>
+<head><title>VPC Test App</title></head>
+<body>
+    <h1>Hello from {vpc_name}/{subnet_name}!</h1>
+    <p>Subnet IP: {subnet['ip']}</p>
+    <p>Subnet CIDR: {subnet['cidr']}</p>
+    <p>Subnet Type: {subnet['type']}</p>
+</body>
+</html>
 """
-            
-            # Write script to namespace
-            script_path = f"/tmp/app-{vpc_name}-{subnet_name}.py"
-            with open(script_path, 'w') as f:
-                f.write(app_script)
-            
-            # Start server in background
-            self.logger.info(f"Starting Python HTTP server on port {port}")
-            run_command(
-                f"ip netns exec {ns_name} python3 {script_path} > /dev/null 2>&1 &",
-                check=False
+        body_path = f"/tmp/app-{vpc_name}-{subnet_name}.html"
+        with open(body_path, 'w') as f:
+            f.write(body)
+        
+        if app_type == 'python':
+            # Workers share the port through SO_REUSEPORT (see app_server.py)
+            server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_server.py')
+            self.logger.info(f"Starting {mode} HTTP server on port {port} ({workers} worker(s))")
+            pid = self.backend.spawn(
+                ns_name,
+                f"python3 {server} --port {port} --workers {workers} --mode {mode} --body {body_path}"
             )
         
-        self.logger.info(f"✓ Application deployed successfully")
+        elif app_type == 'nginx':
+            conf_path = f"/tmp/nginx-{vpc_name}-{subnet_name}.conf"
+            with open(conf_path, 'w') as f:
+                f.write(self._nginx_conf(vpc_name, subnet_name, port, workers, body_path))
+            self.logger.info(f"Starting nginx on port {port} ({workers} worker(s))")
+            pid = self.backend.spawn(ns_name, f"nginx -c {conf_path} -g 'daemon off;'")
+        
+        # Recorded by pid and start time, which is what stop-app signals
+        start_ticks = self.backend.running([pid]).get(pid)
+        if start_ticks is None:
+            raise Exception(f"The app exited as soon as it started (pid {pid})")
+        apps.append({
+            'port': port,
+            'type': app_type,
+            'workers': workers,
+            'mode': mode if app_type == 'python' else None,
+            'pid': pid,
+            'start_ticks': start_ticks,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        self.store.update_subnet(vpc_name, subnet_name, apps=apps)
+        
+        self.logger.info(f"✓ Application deployed successfully (pid {pid})")
         self.logger.info(f"  Access via: http://{subnet['ip']}:{port}")
 
-    def stop_app(self, vpc_name, subnet_name):
-        """Stop application in a subnet"""
-        self.logger.info(f"Stopping application in {vpc_name}/{subnet_name}")
-        
-        state = load_vpc_state()
+    def _nginx_conf(self, vpc_name, subnet_name, port, workers, body_path):
+        """Minimal nginx config serving the app body, with reuseport and keep-alive"""
+        return f"""worker_processes {workers};
+pid /tmp/nginx-{vpc_name}-{subnet_name}.pid;
+error_log stderr;
+events {{ worker_connections 4096; }}
+http {{
+    access_log off;
+    keepalive_requests 100000;
+    server {{
+        listen {port} reuseport backlog=4096;
+        root {os.path.dirname(body_path)};
+        location / {{
+            default_type text/html;
+            try_files /{os.path.basename(body_path)} =404;
+        }}
+    }}
+}}
+"""
+
+    @traced
+    def stop_app(self, vpc_name, subnet_name=None, port=None, grace=5):
+        """Stop the apps in a subnet (or every subnet of the VPC), optionally only one port
+
+        Everything gets SIGTERM at once and a grace period to finish what
+        it's serving; only what's still running after that gets SIGKILL.
+        """
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
-        if subnet_name not in vpc['subnets']:
+        if subnet_name is not None and subnet_name not in vpc['subnets']:
             raise ValueError(f"Subnet {subnet_name} does not exist")
         
-        subnet = vpc['subnets'][subnet_name]
-        ns_name = subnet['namespace']
-        
-        # Kill processes
-        run_command(f"ip netns exec {ns_name} pkill -9 python3", check=False)
-        run_command(f"ip netns exec {ns_name} pkill -9 nginx", check=False)
+        subnets = {subnet_name: vpc['subnets'][subnet_name]} if subnet_name else vpc['subnets']
+        where = f"{vpc_name}/{subnet_name}" if subnet_name else vpc_name
+        self.logger.info(f"Stopping application(s) in {where}"
+                         f"{f' on port {port}' if port is not None else ''}")
+        
+        apps = {name: subnet.get('apps', []) for name, subnet in subnets.items()}
+        # Only the recorded apps, and only while their pid is still the
+        # process deploy-app started; sweeping whole namespaces is left to
+        # delete-subnet and delete-vpc
+        matching = [app for name in apps for app in apps[name] if port is None or app['port'] == port]
+        if port is not None and not matching:
+            raise ValueError(f"No app deployed on port {port} in {where}")
+        running = self.backend.running([app['pid'] for app in matching])
+        pids = [app['pid'] for app in matching if app_running(app, running)]
+        
+        if pids:
+            self.logger.info(f"Sending SIGTERM to {len(pids)} process(es), {grace:g}s before SIGKILL")
+            survivors = self.backend.terminate(pids, grace=grace)
+            if survivors:
+                self.logger.warning(f"Processes still running after SIGKILL: {survivors}")
+        
+        for name, subnet_apps in apps.items():
+            kept = [app for app in subnet_apps if port is not None and app['port'] != port]
+            if kept != subnet_apps:
+                self.store.update_subnet(vpc_name, name, apps=kept or None)
         
         self.logger.info(f"✓ Application stopped")
 
+    def _stop_processes(self, ns_name, grace=5):
+        """SIGTERM every process in a subnet's namespace, SIGKILL what's left after grace"""
+        pids = self.backend.namespace_pids([ns_name]).get(ns_name, [])
+        if not pids:
+            return
+        
+        self.logger.info(f"Stopping {len(pids)} process(es) in {ns_name}")
+        survivors = self.backend.terminate(pids, grace=grace)
+        if survivors:
+            self.logger.warning(f"Processes still running after SIGKILL: {survivors}")
+
+    @traced
+    def list_apps(self, vpc_name=None):
+        """List deployed apps with their pid and whether they're still running"""
+        state = self.store.load()
+        if vpc_name is not None and vpc_name not in state['vpcs']:
+            raise ValueError(f"VPC {vpc_name} does not exist")
+        
+        vpcs = [vpc_name] if vpc_name else list(state['vpcs'])
+        rows = [
+            (v, s, app)
+            for v in vpcs for s, subnet in state['vpcs'][v]['subnets'].items()
+            for app in subnet.get('apps', [])
+        ]
+        if not rows:
+            print("No apps deployed")
+            return
+        
+        running = self.backend.running([app['pid'] for _, _, app in rows])
+        print(f"{'VPC':<16} {'SUBNET':<16} {'PORT':>6} {'TYPE':<16} {'WORKERS':>7} "
+              f"{'PID':>8} {'STARTED':<20} STATUS")
+        for v, s, app in rows:
+            kind = f"{app['type']}/{app['mode']}" if app.get('mode') else app['type']
+            status = 'running' if app_running(app, running) else 'exited'
+            print(f"{v:<16} {s:<16} {app['port']:>6} {kind:<16} {app['workers']:>7} "
+                  f"{app['pid']:>8} {app['started']:<20} {status}")
+
+    @traced
     def test_connectivity(self, vpc_name, from_subnet, to_subnet):
         """Test connectivity between subnets"""
         self.logger.info(f"Testing connectivity: {from_subnet} -> {to_subnet}")
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
         
-        if vpc_name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {vpc_name} does not exist")
         
-        vpc = state['vpcs'][vpc_name]
-        
         if from_subnet not in vpc['subnets']:
             raise ValueError(f"Subnet {from_subnet} does not exist")
         
@@ -316,15 +521,11 @@ with socketserver.TCPServer(("", PORT), MyHTTPRequestHandler) as httpd:
         
         self.logger.info(f"Pinging {to_ip} from {from_ns}")
         
-        result = run_command(
-            f"ip netns exec {from_ns} ping -c 3 -W 2 {to_ip}",
-            check=False
-        )
+        ok, output = self.backend.ping(from_ns, to_ip, count=3, timeout=2)
         
-        if result.returncode == 0:
+        if ok:
             self.logger.info("✓ Connectivity test PASSED")
-            print(result.stdout)
         else:
             self.logger.error("✗ Connectivity test FAILED")
-            print(result.stderr)
+        print(output)
 
@@ -0,0 +1,263 @@
+"""
+Topology Manager - Declarative `vpcctl apply -f topology.json`
+
+Takes the desired VPCs, subnets, peerings and policy attachments, diffs
+them against the current state and only runs the operations needed to
+get there. Operations that don't depend on each other run in parallel,
+one phase at a time:
+
+    delete peerings -> delete subnets -> delete VPCs ->
+    create VPCs -> create subnets -> create peerings -> apply policies
+
+Topology file format:
+
+    {
+      "vpcs": {
+        "prod": {
+          "cidr": "10.0.0.0/16",
+          "interface": "eth0",
+          "subnets": {
+            "web": {"cidr": "10.0.1.0/24", "type": "public",
+                    "policy": "policies/web-server.json"},
+            "db":  {"cidr": "10.0.2.0/24", "type": "private",
+                    "profile": "high-throughput"}
+          }
+        }
+      },
+      "peerings": [["prod", "dev"]]
+    }
+
+Policy paths are relative to the topology file, and so are profile files
+(a profile is a built-in name or a JSON file, see profiles.py). A subnet
+whose profile settings change is rebuilt.
+"""
+
+import ipaddress
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import load_vpc_state, validate_cidr, cidr_contains
+from vpc_manager import VPCManager
+from subnet_manager import SubnetManager
+from peering_manager import PeeringManager
+from firewall_manager import FirewallManager, load_policy, policy_digest
+from firewall_engine import get_engine
+from profiles import load_profile
+from tracing import traced
+
+def _profile_settings(subnet):
+    """What a subnet's profile sets, {} without one"""
+    return (subnet.get('profile') or {}).get('settings', {})
+
+class TopologyManager:
+    def __init__(self, logger, jobs=8, backend=None):
+        self.logger = logger
+        self.jobs = jobs
+        self.vpc_mgr = VPCManager(logger, backend)
+        self.subnet_mgr = SubnetManager(logger, backend)
+        self.peering_mgr = PeeringManager(logger, backend)
+        self.firewall_mgr = FirewallManager(logger, backend)
+
+    @traced
+    def apply(self, topology_file, dry_run=False):
+        """Reconcile the running VPCs with a topology file"""
+        start = time.monotonic()
+        desired = self._load_topology(topology_file)
+        state = load_vpc_state()
+
+        plan = self._plan(desired, state)
+        total = sum(len(ops) for ops in plan.values())
+
+        if total == 0:
+            self.logger.info("✓ Topology is up to date, nothing to do")
+            return
+
+        self._print_plan(plan)
+        if dry_run:
+            self.logger.info(f"Dry run: {total} change(s) not applied")
+            return
+
+        self._run_phase("Deleting peerings", plan['delete_peerings'],
+                        lambda p: self.peering_mgr.unpeer_vpcs(*p))
+        self._run_phase("Deleting subnets", plan['delete_subnets'],
+                        lambda s: self.subnet_mgr.delete_subnet(*s))
+        self._run_phase("Deleting VPCs", plan['delete_vpcs'],
+                        self.vpc_mgr.delete_vpc)
+        self._run_phase("Creating VPCs", plan['create_vpcs'],
+                        lambda v: self.vpc_mgr.create_vpc(v['name'], v['cidr'], v['interface']))
+        self._run_phase("Creating subnets", plan['create_subnets'],
+                        lambda s: self.subnet_mgr.create_subnet(s['vpc'], s['name'], s['cidr'], s['type'],
+                                                                profile=s['profile']))
+        self._run_phase("Creating peerings", plan['create_peerings'],
+                        lambda p: self.peering_mgr.peer_vpcs(*p))
+        self._run_phase("Clearing policies", plan['clear_policies'],
+                        lambda s: self.firewall_mgr.clear_policy(*s))
+        self._run_phase("Applying policies", plan['apply_policies'],
+                        lambda p: self.firewall_mgr.apply_policy(
+                            p['vpc'], p['subnet'], p['file'], show_rules=False))
+
+        elapsed = time.monotonic() - start
+        self.logger.info(f"✓ Topology applied: {total} change(s) in {elapsed:.2f}s")
+
+    def _load_topology(self, topology_file):
+        """Load and validate a topology file"""
+        try:
+            with open(topology_file, 'r') as f:
+                topology = json.load(f)
+        except Exception as e:
+            raise ValueError(f"Failed to load topology file: {e}")
+
+        base_dir = os.path.dirname(os.path.abspath(topology_file))
+        vpcs = topology.get('vpcs', {})
+
+        for vpc_name, vpc in vpcs.items():
+            if not validate_cidr(vpc.get('cidr', '')):
+                raise ValueError(f"Invalid CIDR for VPC {vpc_name}: {vpc.get('cidr')}")
+            vpc.setdefault('interface', 'eth0')
+            vpc.setdefault('subnets', {})
+
+            for subnet_name, subnet in vpc['subnets'].items():
+                if not validate_cidr(subnet.get('cidr', '')):
+                    raise ValueError(f"Invalid CIDR for subnet {vpc_name}/{subnet_name}")
+                if not cidr_contains(vpc['cidr'], subnet['cidr']):
+                    raise ValueError(
+                        f"Subnet CIDR {subnet['cidr']} is not within VPC CIDR {vpc['cidr']}"
+                    )
+                if subnet.get('type', 'private') not in ['public', 'private']:
+                    raise ValueError(f"Invalid type for subnet {vpc_name}/{subnet_name}")
+                subnet.setdefault('type', 'private')
+
+                if subnet.get('policy'):
+                    path = os.path.normpath(os.path.join(base_dir, subnet['policy']))
+                    subnet['policy'] = {'file': path, 'sha256': policy_digest(load_policy(path))}
+                if subnet.get('profile'):
+                    subnet['profile'] = load_profile(subnet['profile'], base_dir)
+
+            # Subnets are created in parallel, so create_subnet's own overlap
+            # check can't see a sibling that's being created at the same time
+            networks = sorted((ipaddress.ip_network(subnet['cidr'], strict=False), name)
+                              for name, subnet in vpc['subnets'].items())
+            for (first, first_name), (second, second_name) in zip(networks, networks[1:]):
+                if first.overlaps(second):
+                    raise ValueError(f"Subnets {vpc_name}/{first_name} ({first}) and "
+                                     f"{vpc_name}/{second_name} ({second}) overlap")
+
+        peerings = set()
+        for peering in topology.get('peerings', []):
+            if isinstance(peering, dict):
+                peering = [peering['vpc1'], peering['vpc2']]
+            for vpc_name in peering:
+                if vpc_name not in vpcs:
+                    raise ValueError(f"Peering references unknown VPC {vpc_name}")
+            peerings.add(tuple(sorted(peering)))
+
+        return {'vpcs': vpcs, 'peerings': peerings}
+
+    def _plan(self, desired, state):
+        """Diff desired topology against current state"""
+        plan = {
+            'delete_peerings': [], 'delete_subnets': [], 'delete_vpcs': [],
+            'create_vpcs': [], 'create_subnets': [], 'create_peerings': [],
+            'clear_policies': [], 'apply_policies': []
+        }
+        current_vpcs = state['vpcs']
+
+        # VPCs whose CIDR or interface changed have to be rebuilt
+        removed_vpcs = set()
+        for vpc_name, vpc in current_vpcs.items():
+            want = desired['vpcs'].get(vpc_name)
+            if want is None or want['cidr'] != vpc['cidr'] or \
+               want['interface'] != vpc.get('interface', 'eth0'):
+                plan['delete_vpcs'].append(vpc_name)
+                removed_vpcs.add(vpc_name)
+
+        for vpc_name, vpc in desired['vpcs'].items():
+            if vpc_name not in current_vpcs or vpc_name in removed_vpcs:
+                plan['create_vpcs'].append({
+                    'name': vpc_name, 'cidr': vpc['cidr'], 'interface': vpc['interface']
+                })
+                current_subnets = {}
+            else:
+                current_subnets = current_vpcs[vpc_name]['subnets']
+
+            # Subnets whose CIDR, type or profile changed are rebuilt too
+            for subnet_name, subnet in current_subnets.items():
+                want = vpc['subnets'].get(subnet_name)
+                if want is None or want['cidr'] != subnet['cidr'] or want['type'] != subnet['type'] \
+                   or _profile_settings(want) != _profile_settings(subnet):
+                    plan['delete_subnets'].append((vpc_name, subnet_name))
+
+            for subnet_name, subnet in vpc['subnets'].items():
+                have = current_subnets.get(subnet_name)
+                rebuilt = (vpc_name, subnet_name) in plan['delete_subnets']
+                if have is None or rebuilt:
+                    plan['create_subnets'].append({
+                        'vpc': vpc_name, 'name': subnet_name,
+                        'cidr': subnet['cidr'], 'type': subnet['type'],
+                        'profile': subnet['profile']['name'] if subnet.get('profile') else None
+                    })
+                    have = {}
+
+                want_policy = subnet.get('policy')
+                have_policy = have.get('policy')
+                if want_policy and (not have_policy or have_policy['sha256'] != want_policy['sha256']
+                                    or have_policy.get('engine', 'iptables') != get_engine()):
+                    plan['apply_policies'].append({
+                        'vpc': vpc_name, 'subnet': subnet_name, 'file': want_policy['file']
+                    })
+                elif not want_policy and have_policy:
+                    plan['clear_policies'].append((vpc_name, subnet_name))
+
+        # Peerings on rebuilt VPCs disappear with them and need re-creating
+        current_peerings = set()
+        for p in state.get('peerings', []):
+            pair = tuple(sorted([p['vpc1'], p['vpc2']]))
+            if removed_vpcs.intersection(pair):
+                continue
+            current_peerings.add(pair)
+            if pair not in desired['peerings']:
+                plan['delete_peerings'].append((p['vpc1'], p['vpc2']))
+
+        plan['create_peerings'] = sorted(desired['peerings'] - current_peerings)
+        return plan
+
+    def _print_plan(self, plan):
+        """Show what apply is about to do"""
+        print("\nPlan:")
+        for vpc1, vpc2 in plan['delete_peerings']:
+            print(f"  - peering {vpc1} <-> {vpc2}")
+        for vpc_name, subnet_name in plan['delete_subnets']:
+            print(f"  - subnet {vpc_name}/{subnet_name}")
+        for vpc_name in plan['delete_vpcs']:
+            print(f"  - vpc {vpc_name}")
+        for vpc in plan['create_vpcs']:
+            print(f"  + vpc {vpc['name']} ({vpc['cidr']})")
+        for subnet in plan['create_subnets']:
+            profile = f" profile {subnet['profile']}" if subnet['profile'] else ''
+            print(f"  + subnet {subnet['vpc']}/{subnet['name']} ({subnet['cidr']}) [{subnet['type']}]{profile}")
+        for vpc1, vpc2 in plan['create_peerings']:
+            print(f"  + peering {vpc1} <-> {vpc2}")
+        for vpc_name, subnet_name in plan['clear_policies']:
+            print(f"  ~ policy {vpc_name}/{subnet_name} cleared")
+        for p in plan['apply_policies']:
+            print(f"  ~ policy {p['vpc']}/{p['subnet']} <- {p['file']}")
+        print()
+
+    def _run_phase(self, title, items, func):
+        """Run one phase's operations on a bounded thread pool"""
+        if not items:
+            return
+
+        self.logger.info(f"{title} ({len(items)})")
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(func, item) for item in items]
+            errors = []
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(str(e))
+
+        if errors:
+            raise Exception(f"{title} failed:\n  " + "\n  ".join(errors))
@@ -0,0 +1,186 @@
+"""
+Tracing - Spans for manager operations and kernel commands
+
+With `vpcctl --trace out.json` or `--timings`, every manager operation
+(`@traced`) and every kernel command a backend runs - a process, a netlink
+request, a simulated one - becomes a span with its duration, exit code,
+namespace and command verb (`ip link`, `iptables -A`, `sysctl`, ...).
+
+- `--trace FILE` writes them in the Chrome trace event format, which
+  chrome://tracing and https://ui.perfetto.dev open directly; nested spans
+  (a manager operation and the commands it ran) stack up per thread
+- `--timings` prints a per-verb summary with a histogram of where the
+  command time went
+
+When tracing is off, span() hands back one shared do-nothing object and
+@traced costs a global lookup, so leaving the instrumentation in place is
+free for normal runs.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+# Options that take a value, so they're not mistaken for ip's object
+IP_OPTIONS_WITH_VALUE = ('-n', '-netns', '-batch', '-b', '-f', '-family')
+IPTABLES_COMMANDS = ('-A', '-C', '-D', '-I', '-R', '-L', '-S', '-F', '-Z', '-N', '-X', '-P', '-E')
+
+def command_verb(cmd):
+    """Short verb for a command line: 'iptables -w -t nat -A ...' -> 'iptables -A'"""
+    tokens = cmd.split()
+    if tokens[:3] == ['ip', 'netns', 'exec'] and len(tokens) > 4:
+        tokens = tokens[4:]
+    if not tokens:
+        return cmd
+    program = os.path.basename(tokens[0])
+
+    if program == 'ip':
+        if '-batch' in tokens or '-b' in tokens:
+            return 'ip -batch'
+        i = 1
+        while i < len(tokens) and tokens[i].startswith('-'):
+            i += 2 if tokens[i] in IP_OPTIONS_WITH_VALUE else 1
+        return f"ip {tokens[i]}" if i < len(tokens) else 'ip'
+    if program in ('iptables', 'ip6tables'):
+        command = next((t for t in tokens[1:] if t in IPTABLES_COMMANDS), None)
+        return f"{program} {command}" if command else program
+    if program == 'nft':
+        if '-f' in tokens:
+            return 'nft -f'
+        words = [t for t in tokens[1:] if not t.startswith('-')]
+        return f"nft {words[0]}" if words else 'nft'
+    return program
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self.args
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc is not None:
+            self.args.setdefault('error', str(exc).strip().splitlines()[0] if str(exc).strip() else exc_type.__name__)
+        self.tracer.add(self, end)
+        return False
+
+class _NoSpan:
+    """What span() returns when tracing is off"""
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_SPAN = _NoSpan()
+
+class Tracer:
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, span, end):
+        thread = threading.current_thread()
+        with self._lock:
+            tid = self.threads.setdefault(thread.ident, (len(self.threads) + 1, thread.name))[0]
+            self.events.append((span.name, span.cat, span.start - self.origin, end - span.start,
+                                tid, span.args))
+
+    def chrome_trace(self):
+        """The spans as a Chrome trace event document"""
+        pid = os.getpid()
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in self.threads.values()
+        ]
+        for name, cat, start, duration, tid, args in sorted(self.events, key=lambda e: e[2]):
+            events.append({
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': round(start * 1e6, 3), 'dur': round(duration * 1e6, 3),
+                'args': {k: v for k, v in args.items() if v is not None},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def timings(self):
+        """{verb: sorted durations} of every kernel command span"""
+        verbs = {}
+        for name, cat, start, duration, tid, args in self.events:
+            if cat == 'command':
+                verbs.setdefault(args.get('verb', name), []).append(duration)
+        return {verb: sorted(durations) for verb, durations in verbs.items()}
+
+    def format_timings(self, width=30):
+        """Per-verb table with a bar for each verb's share of the command time"""
+        verbs = self.timings()
+        if not verbs:
+            return "No kernel commands ran"
+        total = sum(sum(d) for d in verbs.values())
+        lines = [f"{'VERB':<20} {'COUNT':>6} {'TOTAL ms':>10} {'AVG ms':>9} {'P95 ms':>9} "
+                 f"{'MAX ms':>9}  SHARE"]
+        for verb, durations in sorted(verbs.items(), key=lambda item: -sum(item[1])):
+            spent = sum(durations)
+            p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+            share = spent / total if total else 0
+            bar = '#' * max(1, round(share * width)) if spent else ''
+            lines.append(f"{verb:<20} {len(durations):>6} {spent * 1000:>10.2f} "
+                         f"{spent / len(durations) * 1000:>9.3f} {p95 * 1000:>9.3f} "
+                         f"{durations[-1] * 1000:>9.3f}  {bar} {share:.0%}")
+        count = sum(len(d) for d in verbs.values())
+        lines.append(f"{'total':<20} {count:>6} {total * 1000:>10.2f}")
+        return '\n'.join(lines)
+
+def start():
+    """Start collecting spans (until stop())"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def stop():
+    """Stop collecting and return the tracer with what it collected"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+def span(name, cat='operation', **args):
+    """Context manager timing a block; yields a dict for more args (exit_code, ...)"""
+    if _tracer is None:
+        return _NO_SPAN
+    return _Span(_tracer, name, cat, args)
+
+def command_span(cmd, namespace=None, backend=None, **args):
+    """span() for a kernel command, named after its verb"""
+    if _tracer is None:
+        return _NO_SPAN
+    verb = command_verb(cmd)
+    return _Span(_tracer, verb, 'command',
+                 dict(args, verb=verb, cmd=cmd, namespace=namespace, backend=backend))
+
+def traced(method):
+    """Record every call of a manager method as a span ('VPCManager.create_vpc')"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _tracer is None:
+            return method(self, *args, **kwargs)
+        call = [repr(a) for a in args] + [f"{k}={v!r}" for k, v in kwargs.items()]
+        with _Span(_tracer, f"{type(self).__name__}.{method.__name__}", 'manager',
+                   {'call': ', '.join(call)}):
+            return method(self, *args, **kwargs)
+    return wrapper
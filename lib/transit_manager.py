@@ -0,0 +1,259 @@
+"""
+Transit Manager - Hub-and-spoke VPC connectivity
+
+Peering wires every pair of VPCs together with its own veth pair, so a full
+mesh of N VPCs needs N*(N-1)/2 links. A transit hub is a router namespace
+that each VPC attaches to with a single veth instead:
+
+    br-prod --- tgwh-xxx | tgwa-xxx ---+
+                                       | hub namespace (ns-tgw-<hub>)
+    br-dev  --- tgwh-yyy | tgwa-yyy ---+
+
+The hub end of each attachment gets the last usable address of the VPC's
+CIDR, and subnets route the other VPCs' CIDRs to it. Which attachments can
+reach each other is decided by route tables: every attachment belongs to
+one (default: "default"), and VPCs only get routes to, and are only
+forwarded to, VPCs in the same table. Link count grows with the number of
+VPCs, not with the number of pairs.
+"""
+
+import hashlib
+import ipaddress
+from backends import get_backend
+from state_store import get_store
+from ipam import transit_address
+from tracing import traced
+
+class TransitManager:
+    def __init__(self, logger, backend=None):
+        self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
+
+    @traced
+    def create_hub(self, name):
+        """Create a transit hub (a router namespace with nothing attached yet)"""
+        self.logger.info(f"Creating transit hub: {name}")
+
+        if self.store.get_hub(name) is not None:
+            raise ValueError(f"Transit hub {name} already exists")
+
+        ns_name = f"ns-tgw-{name}"
+        batch = self.backend.batch()
+        batch.add_netns(ns_name, f"transit hub {name}")
+        batch.commit()
+
+        batch = self.backend.batch(ns_name)
+        batch.set_link("lo", f"transit hub {name}", up=True)
+        batch.commit()
+        self.backend.sysctl('net.ipv4.ip_forward', 1, namespace=ns_name)
+
+        self.store.add_hub(name, {'namespace': ns_name, 'attachments': {}})
+        self._apply_forwarding(name)
+
+        self.logger.info(f"✓ Transit hub {name} created successfully")
+        self.logger.info(f"  Namespace: {ns_name}")
+
+    @traced
+    def delete_hub(self, name):
+        """Detach every VPC and delete the hub"""
+        self.logger.info(f"Deleting transit hub: {name}")
+
+        hub = self.store.get_hub(name)
+        if hub is None:
+            raise ValueError(f"Transit hub {name} does not exist")
+
+        for vpc_name in list(hub['attachments']):
+            self.detach_vpc(name, vpc_name)
+
+        self.backend.delete_namespace(hub['namespace'], check=False)
+        self.store.delete_hub(name)
+
+        self.logger.info(f"✓ Transit hub {name} deleted successfully")
+
+    @traced
+    def attach_vpc(self, hub_name, vpc_name, route_table='default'):
+        """Attach a VPC to a hub through a single veth pair"""
+        self.logger.info(f"Attaching VPC {vpc_name} to transit hub {hub_name} (route table: {route_table})")
+
+        hub = self.store.get_hub(hub_name)
+        if hub is None:
+            raise ValueError(f"Transit hub {hub_name} does not exist")
+
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
+        if vpc is None:
+            raise ValueError(f"VPC {vpc_name} does not exist")
+
+        if vpc_name in hub['attachments']:
+            raise ValueError(f"VPC {vpc_name} is already attached to transit hub {hub_name}")
+
+        # VPCs sharing a route table need distinct address space
+        cidr = ipaddress.ip_network(vpc['cidr'], strict=False)
+        for other_name, other in hub['attachments'].items():
+            if other['route_table'] == route_table and \
+               cidr.overlaps(ipaddress.ip_network(other['cidr'], strict=False)):
+                raise ValueError(f"VPC CIDRs overlap: {vpc['cidr']} and {other['cidr']} ({other_name})")
+
+        # Note: Linux interface names must be <= 15 characters
+        att_hash = hashlib.md5(f"{hub_name}-{vpc_name}".encode()).hexdigest()[:6]
+        veth_host = f"tgwh-{att_hash}"
+        veth_hub = f"tgwa-{att_hash}"
+        hub_ip = str(transit_address(vpc['cidr']))
+        ns_name = hub['namespace']
+        owner = f"attachment {hub_name}/{vpc_name}"
+
+        self.logger.info(f"Creating veth pair: {veth_host} <-> {ns_name}:{veth_hub}")
+        batch = self.backend.batch()
+        batch.add_veth(veth_host, veth_hub, owner, peer_netns=ns_name)
+        batch.set_link(veth_host, owner, up=True, master=vpc['bridge'])
+        batch.commit()
+
+        # The hub end lives inside the VPC's address space, so the VPC
+        # CIDR is directly connected from the hub's point of view
+        self.logger.info(f"Assigning {hub_ip} to {veth_hub}")
+        batch = self.backend.batch(ns_name)
+        batch.add_address(veth_hub, f"{hub_ip}/{cidr.prefixlen}", owner)
+        batch.set_link(veth_hub, owner, up=True)
+        batch.commit()
+
+        attachment = {
+            'cidr': vpc['cidr'],
+            'route_table': route_table,
+            'veth_host': veth_host,
+            'veth_hub': veth_hub,
+            'ip': hub_ip
+        }
+        peers = self._table_peers(hub, vpc_name, route_table)
+
+        # Routes in both directions: this VPC's subnets to every VPC in the
+        # table, and every VPC in the table back to this one
+        self._program_routes(vpc, [(p['cidr'], hub_ip) for p in peers.values()], add=True)
+        for peer_name, peer in peers.items():
+            self._program_routes(self.store.get_vpc(peer_name, subnets=True),
+                                 [(vpc['cidr'], peer['ip'])], add=True)
+
+        hub['attachments'][vpc_name] = attachment
+        self.store.update_hub(hub_name, hub)
+        self._apply_forwarding(hub_name)
+
+        self.logger.info(f"✓ VPC {vpc_name} attached to transit hub {hub_name}")
+        self.logger.info(f"  Hub address in {vpc_name}: {hub_ip}")
+        self.logger.info(f"  Reachable VPCs: {', '.join(peers) or 'none yet'}")
+
+    @traced
+    def detach_vpc(self, hub_name, vpc_name):
+        """Detach a VPC from a hub and withdraw the routes to and from it"""
+        self.logger.info(f"Detaching VPC {vpc_name} from transit hub {hub_name}")
+
+        hub = self.store.get_hub(hub_name)
+        if hub is None:
+            raise ValueError(f"Transit hub {hub_name} does not exist")
+
+        attachment = hub['attachments'].get(vpc_name)
+        if attachment is None:
+            raise ValueError(f"VPC {vpc_name} is not attached to transit hub {hub_name}")
+
+        peers = self._table_peers(hub, vpc_name, attachment['route_table'])
+        vpc = self.store.get_vpc(vpc_name, subnets=True)
+        if vpc is not None:
+            self._program_routes(vpc, [(p['cidr'], None) for p in peers.values()], add=False)
+        for peer_name in peers:
+            self._program_routes(self.store.get_vpc(peer_name, subnets=True),
+                                 [(attachment['cidr'], None)], add=False)
+
+        self.logger.info(f"Deleting veth pair: {attachment['veth_host']}")
+        batch = self.backend.batch()
+        batch.delete_link(attachment['veth_host'], f"attachment {hub_name}/{vpc_name}", check=False)
+        batch.commit()
+
+        del hub['attachments'][vpc_name]
+        self.store.update_hub(hub_name, hub)
+        self._apply_forwarding(hub_name)
+
+        self.logger.info(f"✓ VPC {vpc_name} detached from transit hub {hub_name}")
+
+    def _table_peers(self, hub, vpc_name, route_table):
+        """The other attachments sharing a route table"""
+        return {
+            name: att for name, att in hub['attachments'].items()
+            if name != vpc_name and att['route_table'] == route_table
+        }
+
+    def _program_routes(self, vpc, routes, add=True):
+        """Add or remove (cidr, via) routes in every subnet of a VPC, one batch per namespace"""
+        if not routes:
+            return
+
+        for subnet_name, subnet in vpc['subnets'].items():
+            ns_name = subnet['namespace']
+            batch = self.backend.batch(ns_name)
+            for cidr, via in routes:
+                owner = f"route {cidr} ({ns_name})"
+                if add:
+                    batch.add_route(cidr, owner, via=via, dev=subnet['veth_ns'],
+                                    onlink=True, check=False)
+                else:
+                    batch.delete_route(cidr, owner, check=False)
+            for failure in batch.commit():
+                self.logger.warning(f"{failure['owner']}: {failure['error']}")
+
+    def _apply_forwarding(self, hub_name):
+        """Only forward between attachments in the same route table
+
+        One chain per route table: traffic entering from an attachment jumps
+        to its table's chain, which accepts it only towards the table's
+        other attachments. That's two rules per attachment, however many
+        VPCs share a table.
+        """
+        hub = self.store.get_hub(hub_name)
+
+        tables = {}
+        for vpc_name, att in hub['attachments'].items():
+            tables.setdefault(att['route_table'], []).append(att['veth_hub'])
+
+        lines = ['*filter', ':INPUT ACCEPT [0:0]', ':FORWARD DROP [0:0]', ':OUTPUT ACCEPT [0:0]']
+        lines += [f":rt-{table} - [0:0]" for table in tables]
+        for table, ifaces in tables.items():
+            for iface in ifaces:
+                lines.append(f"-A FORWARD -i {iface} -j rt-{table}")
+                lines.append(f"-A rt-{table} -o {iface} -j ACCEPT")
+        lines.append('COMMIT')
+
+        self.backend.run_in_namespace(hub['namespace'], "iptables-restore -w",
+                                      input='\n'.join(lines) + '\n')
+
+    @traced
+    def list_hubs(self):
+        """Print every hub with its attachments grouped by route table"""
+        hubs = self.store.list_hubs()
+
+        if not hubs:
+            print("No transit hubs found")
+            return
+
+        for hub_name, hub in hubs.items():
+            print(f"\nTransit hub: {hub_name} ({hub['namespace']})")
+            if not hub['attachments']:
+                print("  No attachments")
+                continue
+
+            tables = {}
+            for vpc_name, att in hub['attachments'].items():
+                tables.setdefault(att['route_table'], []).append((vpc_name, att))
+
+            for table, members in tables.items():
+                print(f"  Route table: {table}")
+                for vpc_name, att in members:
+                    print(f"    {vpc_name} ({att['cidr']}) via {att['ip']} [{att['veth_host']}]")
+
+def hub_routes(store, vpc_name):
+    """(cidr, via) routes a VPC's subnets need for its transit hub attachments"""
+    routes = []
+    for hub_name, hub in store.list_hubs().items():
+        attachment = hub['attachments'].get(vpc_name)
+        if attachment is None:
+            continue
+        for other_name, other in hub['attachments'].items():
+            if other_name != vpc_name and other['route_table'] == attachment['route_table']:
+                routes.append((other['cidr'], attachment['ip']))
+    return routes
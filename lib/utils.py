@@ -3,41 +3,115 @@ Utility functions for VPC management
 """
 
 import subprocess
-import json
-import os
 import ipaddress
+import threading
+import time
+from contextlib import contextmanager
+from state_store import get_store
+from ipam import gateway_address, host_address
+from tracing import command_span
 
-def run_command(cmd, check=True, capture_output=True):
-    """Execute shell command and return result"""
-    try:
-        result = subprocess.run(
-            cmd,
+# Number of processes spawned by run_command during this run, and the
+# bytes piped into their stdin
+_subprocess_count = 0
+_input_bytes = 0
+_count_lock = threading.Lock()
+
+def _command_namespace(cmd):
+    """Namespace an `ip netns exec <ns> ...` or `ip -n <ns> ...` command runs in"""
+    tokens = cmd.split(None, 4)
+    if tokens[:3] == ['ip', 'netns', 'exec'] and len(tokens) > 3:
+        return tokens[3]
+    if tokens[:2] == ['ip', '-n'] and len(tokens) > 2:
+        return tokens[2]
+    return None
+
+def run_command(cmd, check=True, capture_output=True, input=None, namespace=None):
+    """Execute shell command and return result
+
+    namespace only labels the trace span, for commands already running
+    inside one (see tracing.py).
+    """
+    global _subprocess_count, _input_bytes
+    with _count_lock:
+        _subprocess_count += 1
+        _input_bytes += len(input.encode()) if input else 0
+    with command_span(cmd, namespace or _command_namespace(cmd)) as span:
+        try:
+            result = subprocess.run(
+                cmd,
+                shell=True,
+                check=check,
+                capture_output=capture_output,
+                text=True,
+                input=input
+            )
+            span['exit_code'] = result.returncode
+            return result
+        except subprocess.CalledProcessError as e:
+            span['exit_code'] = e.returncode
+            raise Exception(f"Command failed: {cmd}\nError: {e.stderr}")
+
+def spawn_command(cmd, namespace=None):
+    """Start a long-running command in the background and return its pid
+
+    The command is exec'd by the shell, so the pid is the command's own
+    and not a shell's. It gets a session of its own and no terminal, so it
+    outlives vpcctl and a Ctrl-C in the terminal doesn't reach it.
+    """
+    global _subprocess_count
+    with _count_lock:
+        _subprocess_count += 1
+    with command_span(cmd, namespace or _command_namespace(cmd)) as span:
+        process = subprocess.Popen(
+            f"exec {cmd}",
             shell=True,
-            check=check,
-            capture_output=capture_output,
-            text=True
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True
         )
-        return result
-    except subprocess.CalledProcessError as e:
-        raise Exception(f"Command failed: {cmd}\nError: {e.stderr}")
+        span['exit_code'] = 0
+        return process.pid
+
+def get_subprocess_count():
+    """Return how many commands run_command has executed so far"""
+    return _subprocess_count
+
+def get_input_bytes():
+    """Return how many bytes run_command has piped into commands so far"""
+    return _input_bytes
+
+class PhaseTimer:
+    """Add up wall time per named phase (safe to share between threads)"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + time.monotonic() - start
+
+    def summary(self):
+        """e.g. '1.23s (stop apps 0.01s, links 0.80s)'"""
+        elapsed = time.monotonic() - self.start
+        parts = ', '.join(f"{name} {secs:.2f}s" for name, secs in self.phases.items())
+        return f"{elapsed:.2f}s ({parts})" if parts else f"{elapsed:.2f}s"
 
 def load_vpc_state():
-    """Load VPC state from file"""
-    state_file = '/var/lib/vpcctl/state.json'
-    if os.path.exists(state_file):
-        with open(state_file, 'r') as f:
-            return json.load(f)
-    return {'vpcs': {}, 'peerings': []}
+    """Load the whole VPC state (see state_store.py)"""
+    return get_store().load()
 
 def save_vpc_state(state):
-    """Save VPC state to file"""
-    state_dir = '/var/lib/vpcctl'
-    if not os.path.exists(state_dir):
-        os.makedirs(state_dir)
-    
-    state_file = os.path.join(state_dir, 'state.json')
-    with open(state_file, 'w') as f:
-        json.dump(state, f, indent=2)
+    """Replace the whole VPC state in one transaction"""
+    get_store().replace(state)
 
 def validate_cidr(cidr):
     """Validate CIDR notation"""
@@ -53,31 +127,67 @@ def cidr_contains(parent_cidr, child_cidr):
     child = ipaddress.ip_network(child_cidr, strict=False)
     return child.subnet_of(parent)
 
+def parse_port(port):
+    """Parse a policy port: '*' -> None, 80 -> (80, 80), '8000-9000' -> (8000, 9000)"""
+    if port in ('*', None):
+        return None
+    try:
+        if isinstance(port, str) and '-' in port:
+            lo, hi = (int(p) for p in port.split('-', 1))
+        else:
+            lo = hi = int(port)
+    except ValueError:
+        raise ValueError(f"Invalid port: {port}")
+    if not 0 <= lo <= hi <= 65535:
+        raise ValueError(f"Invalid port: {port}")
+    return lo, hi
+
+def parse_ports(port):
+    """Like parse_port, but also takes a list (multiport): returns [(lo, hi), ...] or None"""
+    if isinstance(port, list):
+        ranges = [parse_port(p) for p in port]
+        if None in ranges:
+            return None
+        return ranges
+    ranges = parse_port(port)
+    return None if ranges is None else [ranges]
+
+def rule_comment(direction, origin):
+    """Comment tagging a compiled firewall rule with the policy rule(s) it came from"""
+    if isinstance(origin, (list, tuple)):
+        origin = ','.join(str(o) for o in origin)
+    return f"vpcctl:{direction}:{origin}"
+
+def parse_rule_comment(comment):
+    """'vpcctl:ingress:1,3' -> ('ingress', '1,3'), or None for anything else"""
+    parts = (comment or '').split(':')
+    if len(parts) != 3 or parts[0] != 'vpcctl':
+        return None
+    return parts[1], parts[2]
+
 def get_bridge_ip(cidr):
     """Get bridge IP from CIDR (first usable IP)"""
-    network = ipaddress.ip_network(cidr, strict=False)
-    return str(list(network.hosts())[0])
+    return str(gateway_address(cidr))
 
 def get_namespace_ip(cidr):
     """Get namespace IP from CIDR (second usable IP)"""
-    network = ipaddress.ip_network(cidr, strict=False)
-    hosts = list(network.hosts())
-    if len(hosts) > 1:
-        return str(hosts[1])
-    return str(hosts[0])
+    try:
+        return str(host_address(cidr, 1))
+    except ValueError:
+        # Single-host subnet
+        return str(host_address(cidr, 0))
 
 def namespace_exists(name):
     """Check if network namespace exists"""
-    result = run_command(f"ip netns list", check=False)
-    return name in result.stdout
+    from backends import get_backend
+    return get_backend().namespace_exists(name)
 
 def bridge_exists(name):
     """Check if bridge exists"""
-    result = run_command(f"ip link show {name}", check=False)
-    return result.returncode == 0
+    from backends import get_backend
+    return get_backend().link_exists(name)
 
 def interface_exists(name):
     """Check if interface exists"""
-    result = run_command(f"ip link show {name}", check=False)
-    return result.returncode == 0
-
+    from backends import get_backend
+    return get_backend().link_exists(name)
@@ -2,16 +2,19 @@
 VPC Manager - Handles VPC creation and management
 """
 
-import os
-from utils import (
-    run_command, load_vpc_state, save_vpc_state,
-    validate_cidr, bridge_exists, namespace_exists
-)
+from utils import validate_cidr, get_bridge_ip, PhaseTimer
+from backends import get_backend
+from state_store import get_store
+from transit_manager import TransitManager
+from tracing import traced
 
 class VPCManager:
-    def __init__(self, logger):
+    def __init__(self, logger, backend=None):
         self.logger = logger
+        self.backend = backend or get_backend()
+        self.store = get_store()
 
+    @traced
     def create_vpc(self, name, cidr, interface='eth0'):
         """Create a new VPC"""
         self.logger.info(f"Creating VPC: {name} with CIDR: {cidr}")
@@ -20,140 +23,147 @@ class VPCManager:
         if not validate_cidr(cidr):
             raise ValueError(f"Invalid CIDR: {cidr}")
         
-        # Load current state
-        state = load_vpc_state()
-        
         # Check if VPC already exists
-        if name in state['vpcs']:
+        if self.store.get_vpc(name) is not None:
             raise ValueError(f"VPC {name} already exists")
         
         # Create bridge for VPC
         bridge_name = f"br-{name}"
         
-        if bridge_exists(bridge_name):
-            self.logger.warning(f"Bridge {bridge_name} already exists, removing it first")
-            run_command(f"ip link delete {bridge_name}", check=False)
+        batch = self.backend.batch()
+        owner = f"bridge {bridge_name}"
         
-        self.logger.info(f"Creating bridge: {bridge_name}")
-        run_command(f"ip link add {bridge_name} type bridge")
+        if self.backend.link_exists(bridge_name):
+            self.logger.warning(f"Bridge {bridge_name} already exists, removing it first")
+            batch.delete_link(bridge_name, owner, check=False)
         
         # Assign IP to bridge (first IP in CIDR range) so it can route
-        import ipaddress
-        network = ipaddress.ip_network(cidr, strict=False)
-        bridge_ip = str(list(network.hosts())[0])
+        bridge_ip = get_bridge_ip(cidr)
+        prefix_len = cidr.split('/')[1]
         
+        # Bridge creation, address and link state are committed together
+        self.logger.info(f"Creating bridge: {bridge_name}")
         self.logger.info(f"Assigning IP {bridge_ip} to bridge")
-        run_command(f"ip addr add {bridge_ip}/16 dev {bridge_name}")
-        run_command(f"ip link set {bridge_name} up")
+        batch.add_bridge(bridge_name, owner)
+        batch.add_address(bridge_name, f"{bridge_ip}/{prefix_len}", owner)
+        batch.set_link(bridge_name, owner, up=True)
+        batch.commit()
         
         # Enable IP forwarding
-        run_command("sysctl -w net.ipv4.ip_forward=1")
+        self.backend.sysctl('net.ipv4.ip_forward', 1)
         
         # Allow forwarding on the bridge
-        run_command(f"iptables -A FORWARD -i {bridge_name} -o {bridge_name} -j ACCEPT", check=False)
-        run_command(f"iptables -A FORWARD -i {bridge_name} -j ACCEPT", check=False)
-        run_command(f"iptables -A FORWARD -o {bridge_name} -j ACCEPT", check=False)
+        self.backend.run(f"iptables -w -A FORWARD -i {bridge_name} -o {bridge_name} -j ACCEPT", check=False)
+        self.backend.run(f"iptables -w -A FORWARD -i {bridge_name} -j ACCEPT", check=False)
+        self.backend.run(f"iptables -w -A FORWARD -o {bridge_name} -j ACCEPT", check=False)
         
         # Store VPC info
-        state['vpcs'][name] = {
+        self.store.add_vpc(name, {
             'cidr': cidr,
             'bridge': bridge_name,
-            'interface': interface,
-            'subnets': {}
-        }
-        
-        save_vpc_state(state)
+            'interface': interface
+        })
         
         self.logger.info(f"✓ VPC {name} created successfully")
         self.logger.info(f"  Bridge: {bridge_name}")
         self.logger.info(f"  CIDR: {cidr}")
         self.logger.info(f"  Internet Interface: {interface}")
 
-    def delete_vpc(self, name):
+    @traced
+    def delete_vpc(self, name, timer=None):
         """Delete a VPC and all its resources"""
         self.logger.info(f"Deleting VPC: {name}")
+        own_timer = timer is None
+        timer = timer or PhaseTimer()
         
-        state = load_vpc_state()
+        vpc = self.store.get_vpc(name, subnets=True)
         
-        if name not in state['vpcs']:
+        if vpc is None:
             raise ValueError(f"VPC {name} does not exist")
         
-        vpc = state['vpcs'][name]
         bridge_name = vpc['bridge']
-        
-        # Delete all subnets first
-        subnets = list(vpc['subnets'].keys())
-        for subnet_name in subnets:
-            self._delete_subnet_resources(name, subnet_name, vpc)
-        
-        # Remove peerings
-        peerings_to_remove = []
-        for peering in state.get('peerings', []):
-            if name in [peering['vpc1'], peering['vpc2']]:
-                peerings_to_remove.append(peering)
-        
-        for peering in peerings_to_remove:
-            self.logger.info(f"Removing peering: {peering['vpc1']} <-> {peering['vpc2']}")
-            state['peerings'].remove(peering)
-            # Clean up peering interfaces
-            peer_if = f"peer-{peering['vpc1']}-{peering['vpc2']}"
-            run_command(f"ip link delete {peer_if}", check=False)
-        
-        # Delete bridge
-        if bridge_exists(bridge_name):
+        subnets = vpc['subnets']
+        
+        # Withdraw the VPC from any transit hubs first so the other VPCs lose their routes to it
+        with timer.phase('transit'):
+            for hub_name, hub in self.store.list_hubs().items():
+                if name in hub['attachments']:
+                    TransitManager(self.logger, self.backend).detach_vpc(hub_name, name)
+        
+        # Stop anything running in the subnets and wait for it to actually exit
+        with timer.phase('stop apps'):
+            self._stop_subnet_processes(subnets)
+        
+        with timer.phase('NAT rules'):
+            self._remove_nat_rules(vpc, subnets)
+        
+        # Veths, peering links, the bridge and the namespaces all go in one
+        # batch. Firewall rules inside a namespace disappear along with it.
+        with timer.phase('links & namespaces'):
+            batch = self.backend.batch()
+            for subnet_name, subnet in subnets.items():
+                self.logger.info(f"Deleting veth pair: {subnet['veth_host']}")
+                batch.delete_link(subnet['veth_host'], f"veth {subnet['veth_host']}", check=False)
+            
+            for peering in self.store.list_peerings(name):
+                self.logger.info(f"Removing peering: {peering['vpc1']} <-> {peering['vpc2']}")
+                peer_if = peering.get('veth1', f"peer-{peering['vpc1']}-{peering['vpc2']}")
+                batch.delete_link(peer_if, f"peering {peering['vpc1']}-{peering['vpc2']}", check=False)
+            
             self.logger.info(f"Deleting bridge: {bridge_name}")
-            run_command(f"ip link set {bridge_name} down", check=False)
-            run_command(f"ip link delete {bridge_name}", check=False)
+            batch.delete_link(bridge_name, f"bridge {bridge_name}", check=False)
+            
+            for subnet_name, subnet in subnets.items():
+                self.logger.info(f"Deleting namespace: {subnet['namespace']}")
+                batch.delete_netns(subnet['namespace'], f"subnet {subnet_name}", check=False)
+            batch.commit()
         
-        # Remove from state
-        del state['vpcs'][name]
-        save_vpc_state(state)
+        # Remove from state (subnets and peerings go with it)
+        with timer.phase('state'):
+            self.store.delete_vpc(name)
         
         self.logger.info(f"✓ VPC {name} deleted successfully")
+        if own_timer:
+            self.logger.info(f"  Took {timer.summary()}")
 
-    def _delete_subnet_resources(self, vpc_name, subnet_name, vpc):
-        """Delete subnet resources"""
-        subnet = vpc['subnets'][subnet_name]
-        ns_name = subnet['namespace']
-        veth_host = subnet['veth_host']
-        
-        # Stop any running apps - be more aggressive
-        # TODO: Maybe add a retry mechanism here? Sometimes processes don't die immediately
-        self.logger.info(f"Stopping applications in subnet {subnet_name}")
-        run_command(f"ip netns pids {ns_name} | xargs -r kill -9", check=False)
-        run_command(f"pkill -9 -f 'ip netns exec {ns_name}'", check=False)
-        
-        # Give processes a moment to die
-        # NOTE: 0.5s seems to work well, but might need tuning for slower systems
-        import time
-        time.sleep(0.5)
-        
-        # Remove NAT rules if public subnet
-        if subnet.get('type') == 'public':
-            self.logger.info(f"Removing NAT rules for {subnet_name}")
-            interface = vpc.get('interface', 'eth0')
-            run_command(
-                f"iptables -t nat -D POSTROUTING -s {subnet['cidr']} -o {interface} -j MASQUERADE",
-                check=False
-            )
-        
-        # Remove firewall rules
-        self.logger.info(f"Flushing firewall rules in {subnet_name}")
-        run_command(f"ip netns exec {ns_name} iptables -F", check=False)
-        run_command(f"ip netns exec {ns_name} iptables -X", check=False)
-        
-        # Delete veth pair
-        self.logger.info(f"Deleting veth pair: {veth_host}")
-        run_command(f"ip link delete {veth_host}", check=False)
-        
-        # Delete namespace
-        if namespace_exists(ns_name):
-            self.logger.info(f"Deleting namespace: {ns_name}")
-            run_command(f"ip netns delete {ns_name}", check=False)
+    def _stop_subnet_processes(self, subnets):
+        """Stop every process in the subnets' namespaces and wait for them to exit
 
+        All of them at once: SIGTERM, then SIGKILL for what's left after
+        the grace period (see procs.terminate).
+        """
+        namespaces = [subnet['namespace'] for subnet in subnets.values()]
+        pids = [pid for ns_pids in self.backend.namespace_pids(namespaces).values() for pid in ns_pids]
+        if not pids:
+            return
+        
+        self.logger.info(f"Stopping {len(pids)} process(es) in {len(namespaces)} subnet(s)")
+        survivors = self.backend.terminate(pids, grace=5)
+        if survivors:
+            self.logger.warning(f"Processes still running after SIGKILL: {survivors}")
+
+    def _remove_nat_rules(self, vpc, subnets):
+        """Remove the MASQUERADE rules of public subnets in one iptables-restore"""
+        interface = vpc.get('interface', 'eth0')
+        rules = [
+            f"-D POSTROUTING -s {subnet['cidr']} -o {interface} -j MASQUERADE"
+            for subnet in subnets.values() if subnet.get('type') == 'public'
+        ]
+        if not rules:
+            return
+        
+        self.logger.info(f"Removing NAT rules for {len(rules)} public subnet(s)")
+        payload = '\n'.join(['*nat'] + rules + ['COMMIT']) + '\n'
+        result = self.backend.run("iptables-restore -w --noflush", check=False, input=payload)
+        if result.returncode != 0:
+            # A single missing rule fails the whole restore, so delete them one by one
+            for rule in rules:
+                self.backend.run(f"iptables -w -t nat {rule}", check=False)
+
+    @traced
     def list_vpcs(self):
         """List all VPCs"""
-        state = load_vpc_state()
+        state = self.store.load()
         
         if not state['vpcs']:
             print("No VPCs found")
@@ -184,39 +194,55 @@ class VPCManager:
         
         print("\n" + "="*80)
 
-    def cleanup_all(self):
+    @traced
+    def cleanup_all(self, jobs=8):
         """Clean up all VPCs and resources"""
+        from concurrent.futures import ThreadPoolExecutor
         self.logger.info("Cleaning up all VPCs and resources")
-        
-        state = load_vpc_state()
-        
-        vpc_names = list(state['vpcs'].keys())
-        
-        for vpc_name in vpc_names:
-            try:
-                self.delete_vpc(vpc_name)
-            except Exception as e:
-                self.logger.error(f"Error deleting VPC {vpc_name}: {e}")
-        
-        # Clean orphaned namespaces
-        self.logger.info("Cleaning orphaned namespaces")
-        result = run_command("ip netns list", check=False)
-        for line in result.stdout.splitlines():
-            ns_name = line.split()[0]
-            if ns_name.startswith('ns-'):
-                self.logger.info(f"Removing orphaned namespace: {ns_name}")
-                run_command(f"ip netns delete {ns_name}", check=False)
-        
-        # Clean orphaned bridges
-        self.logger.info("Cleaning orphaned bridges")
-        result = run_command("ip link show type bridge", check=False)
-        for line in result.stdout.splitlines():
-            if 'br-' in line:
-                bridge_name = line.split(':')[1].strip().split('@')[0]
-                if bridge_name.startswith('br-'):
-                    self.logger.info(f"Removing orphaned bridge: {bridge_name}")
-                    run_command(f"ip link set {bridge_name} down", check=False)
-                    run_command(f"ip link delete {bridge_name}", check=False)
+        timer = PhaseTimer()
+        
+        vpc_names = self.store.list_vpcs()
+        
+        # VPCs don't share anything but peering links (deleted with check=False),
+        # so they can be torn down side by side
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(self.delete_vpc, vpc_name, timer): vpc_name for vpc_name in vpc_names}
+            for future, vpc_name in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Error deleting VPC {vpc_name}: {e}")
+        
+        with timer.phase('transit'):
+            for hub_name in self.store.list_hubs():
+                try:
+                    TransitManager(self.logger, self.backend).delete_hub(hub_name)
+                except Exception as e:
+                    self.logger.error(f"Error deleting transit hub {hub_name}: {e}")
+        
+        with timer.phase('orphans'):
+            batch = self.backend.batch()
+            
+            # Clean orphaned namespaces
+            self.logger.info("Cleaning orphaned namespaces")
+            result = self.backend.run("ip netns list", check=False)
+            for line in result.stdout.splitlines():
+                ns_name = line.split()[0]
+                if ns_name.startswith('ns-'):
+                    self.logger.info(f"Removing orphaned namespace: {ns_name}")
+                    batch.delete_netns(ns_name, f"namespace {ns_name}", check=False)
+            
+            # Clean orphaned bridges
+            self.logger.info("Cleaning orphaned bridges")
+            result = self.backend.run("ip link show type bridge", check=False)
+            for line in result.stdout.splitlines():
+                if 'br-' in line:
+                    bridge_name = line.split(':')[1].strip().split('@')[0]
+                    if bridge_name.startswith('br-'):
+                        self.logger.info(f"Removing orphaned bridge: {bridge_name}")
+                        batch.delete_link(bridge_name, f"bridge {bridge_name}", check=False)
+            batch.commit()
         
         self.logger.info("✓ Cleanup completed")
-
+        # Phase times are summed over VPCs, so they can add up to more than the total
+        self.logger.info(f"  {len(vpc_names)} VPC(s) in {timer.summary()}")
@@ -188,9 +188,9 @@ main() {
     log "Testing isolation: VPC1 should NOT reach VPC2"
     
     # Get namespace and IP for testing
-    VPC2_NS=$(cat /var/lib/vpcctl/state.json | grep -A 5 "\"$VPC2_PUBLIC_SUBNET\"" | grep namespace | cut -d'"' -f4 || echo "")
-    VPC2_IP=$(cat /var/lib/vpcctl/state.json | grep -A 6 "\"$VPC2_PUBLIC_SUBNET\"" | grep "\"ip\"" | cut -d'"' -f4 || echo "10.2.1.2")
-    VPC1_NS=$(cat /var/lib/vpcctl/state.json | grep -A 5 "\"$VPC1_PUBLIC_SUBNET\"" | grep namespace | cut -d'"' -f4 || echo "")
+    VPC2_NS=$(./vpcctl list-subnets --vpc "$VPC2_NAME" | grep -A 4 "Subnet: $VPC2_PUBLIC_SUBNET$" | grep "Namespace:" | awk '{print $2}' || echo "")
+    VPC2_IP=$(./vpcctl list-subnets --vpc "$VPC2_NAME" | grep -A 5 "Subnet: $VPC2_PUBLIC_SUBNET$" | grep " IP:" | awk '{print $2}' || echo "10.2.1.2")
+    VPC1_NS=$(./vpcctl list-subnets --vpc "$VPC1_NAME" | grep -A 4 "Subnet: $VPC1_PUBLIC_SUBNET$" | grep "Namespace:" | awk '{print $2}' || echo "")
     
     if [ -n "$VPC1_NS" ] && [ -n "$VPC2_IP" ]; then
         if ip netns exec "$VPC1_NS" ping -c 2 -W 2 "$VPC2_IP" >> "$LOG_FILE" 2>&1; then
@@ -0,0 +1,48 @@
+"""
+Unit tests for the vpcctld client (no root needed)
+
+    python3 -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from client import subcommand, run
+
+class SubcommandTest(unittest.TestCase):
+    def test_option_values_are_not_subcommands(self):
+        self.assertEqual(subcommand(['create-vpc', '--name', 'perf', '--cidr', '10.0.0.0/16']),
+                         'create-vpc')
+        self.assertEqual(subcommand(['--trace', 'perf', 'list-vpcs']), 'list-vpcs')
+        self.assertEqual(subcommand(['--back', 'sim', '-q', 'exporter']), 'exporter')
+        self.assertEqual(subcommand(['--backend=sim', 'perf']), 'perf')
+        self.assertIsNone(subcommand(['-q']))
+
+    def test_a_vpc_named_perf_still_goes_to_the_daemon(self):
+        sent = []
+        def request(method, params, socket_path):
+            sent.append(params['argv'])
+
+        with mock.patch('client.request', request), mock.patch.dict(os.environ):
+            os.environ.pop('VPCCTL_DAEMON', None)
+            run(['create-vpc', '--name', 'perf', '--cidr', '10.0.0.0/16'])
+            self.assertIsNone(run(['--backend', 'sim', 'perf', '--vpc', 'a']))
+        self.assertEqual(sent, [['create-vpc', '--name', 'perf', '--cidr', '10.0.0.0/16']])
+
+    def test_long_running_commands_stay_out_of_the_daemon(self):
+        sent = []
+        def request(method, params, socket_path):
+            sent.append(params['argv'])
+
+        with mock.patch('client.request', request), mock.patch.dict(os.environ):
+            os.environ.pop('VPCCTL_DAEMON', None)
+            self.assertIsNone(run(['tune-policy', '--vpc', 'a', '--subnet', 'web', '--window', '300']))
+            self.assertIsNone(run(['-q', 'reachability', '--vpc', 'a']))
+        self.assertEqual(sent, [])
+
+if __name__ == '__main__':
+    unittest.main()
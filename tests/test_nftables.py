@@ -0,0 +1,57 @@
+"""
+Unit tests for the nftables compiler (no root needed)
+
+    python3 -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from nftables import compile_policy
+
+def _target(action):
+    return {'ALLOW': 'ACCEPT', 'DENY': 'DROP'}[action]
+
+def _base_chain(ruleset, name):
+    body = ruleset[ruleset.index(f"    chain {name} {{"):]
+    return body[:body.index("\n    }")]
+
+class AllProtocolTest(unittest.TestCase):
+    def test_all_is_never_a_map_key(self):
+        ruleset = compile_policy({'ingress': [
+            {'protocol': 'all', 'action': 'deny', 'source': '10.1.0.0/16'},
+            {'protocol': 'tcp', 'port': 80, 'action': 'allow', 'source': '0.0.0.0/0'},
+        ]}, _target)
+        self.assertNotIn('all :', ruleset)
+        self.assertNotIn('all .', ruleset)
+        # tcp/80 checks the earlier deny first, anything else still gets it
+        self.assertIn('tcp . 80 : jump in_1', ruleset)
+        self.assertIn('ip saddr 10.1.0.0/16 counter drop comment "vpcctl:ingress:1"\n'
+                      '        counter accept comment "vpcctl:ingress:2"', ruleset)
+        self.assertIn('jump in_2', _base_chain(ruleset, 'input'))
+
+    def test_all_after_port_rules_is_in_their_chains(self):
+        ruleset = compile_policy({'ingress': [
+            {'protocol': 'tcp', 'port': 22, 'action': 'allow', 'source': '10.0.0.0/8'},
+            {'protocol': 'all', 'action': 'deny'},
+        ]}, _target)
+        self.assertIn('ip saddr 10.0.0.0/8 counter accept comment "vpcctl:ingress:1"\n'
+                      '        counter drop comment "vpcctl:ingress:2"', ruleset)
+        self.assertIn('counter drop comment "vpcctl:ingress:2"', _base_chain(ruleset, 'input'))
+
+class CatchAllTest(unittest.TestCase):
+    def test_lone_catch_all_is_still_counted(self):
+        ruleset = compile_policy({'ingress': [
+            {'protocol': 'tcp', 'port': 80, 'action': 'allow'},
+            {'protocol': 'icmp', 'action': 'deny'},
+        ]}, _target)
+        self.assertIn('tcp . 80 : jump in_1', ruleset)
+        self.assertIn('icmp : jump in_2', ruleset)
+        self.assertIn('chain in_1 {\n        counter accept comment "vpcctl:ingress:1"', ruleset)
+        self.assertIn('chain in_2 {\n        counter drop comment "vpcctl:ingress:2"', ruleset)
+
+if __name__ == '__main__':
+    unittest.main()
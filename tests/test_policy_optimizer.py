@@ -0,0 +1,96 @@
+"""
+Unit tests for the policy optimizer (no root needed)
+
+    python3 -m unittest discover -s tests
+"""
+
+import ipaddress
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from policy_optimizer import optimize_policy, reorder_policy
+
+# Probe packets: one address inside each test network, every kind of port
+PACKETS = [(protocol, port, ipaddress.ip_address(address))
+           for protocol in ('tcp', 'udp', 'icmp')
+           for port in ((22, 80, 443, 8050, 9000) if protocol != 'icmp' else (None,))
+           for address in ('10.1.2.3', '10.1.9.9', '10.9.9.9', '192.168.1.1', '172.16.0.1')]
+
+def _matches(rule, packet):
+    """First-match semantics of one rule, written out independently of the optimizer"""
+    protocol, port, address = packet
+    if rule.get('protocol', 'tcp') not in ('all', protocol):
+        return False
+    if address not in ipaddress.ip_network(rule.get('source', '0.0.0.0/0')):
+        return False
+    spec = str(rule.get('port', '*'))
+    if port is None or spec == '*':
+        return True
+    lo, _, hi = spec.partition('-')
+    return int(lo) <= port <= int(hi or lo)
+
+class AllProtocolTest(unittest.TestCase):
+    def test_all_deny_guarding_a_tcp_allow_is_kept(self):
+        policy = {'ingress': [
+            {'protocol': 'all', 'action': 'deny', 'source': '10.1.0.0/16'},
+            {'protocol': 'tcp', 'port': 80, 'action': 'allow', 'source': '0.0.0.0/0'},
+        ]}
+        optimized, _ = optimize_policy(policy)
+        rules = optimized['ingress']
+        self.assertEqual([(r['protocol'], r['action']) for r in rules],
+                         [('all', 'deny'), ('tcp', 'allow')])
+
+    def test_all_allow_shadows_a_later_tcp_rule(self):
+        policy = {'ingress': [
+            {'protocol': 'all', 'action': 'allow', 'source': '10.0.0.0/8'},
+            {'protocol': 'tcp', 'port': 22, 'action': 'deny', 'source': '10.1.0.0/16'},
+        ]}
+        optimized, _ = optimize_policy(policy)
+        self.assertEqual([r['protocol'] for r in optimized['ingress']], ['all'])
+
+    def test_tcp_rule_never_covers_all(self):
+        policy = {'ingress': [
+            {'protocol': 'tcp', 'port': '*', 'action': 'allow', 'source': '0.0.0.0/0'},
+            {'protocol': 'all', 'action': 'allow', 'source': '10.0.0.0/8'},
+        ]}
+        optimized, _ = optimize_policy(policy)
+        self.assertEqual(len(optimized['ingress']), 2)
+
+class ReorderTest(unittest.TestCase):
+    def test_hot_tcp_allow_stays_behind_all_deny(self):
+        policy = {'ingress': [
+            {'protocol': 'all', 'action': 'deny', 'source': '10.1.0.0/16', 'origin': [1]},
+            {'protocol': 'tcp', 'port': 80, 'action': 'allow', 'source': '0.0.0.0/0', 'origin': [2]},
+        ]}
+        reordered, _ = reorder_policy(policy, {'ingress': {'2': 1000, '1': 1}})
+        self.assertEqual([r['origin'] for r in reordered['ingress']], [[1], [2]])
+
+    def test_reorder_never_crosses_an_overlapping_rule_of_the_other_action(self):
+        rng = random.Random(7)
+        protocols = ['tcp', 'udp', 'icmp', 'all']
+        sources = ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '192.168.0.0/16']
+        for _ in range(200):
+            rules = []
+            for i in range(8):
+                rule = {'protocol': rng.choice(protocols), 'action': rng.choice(['allow', 'deny']),
+                        'source': rng.choice(sources), 'origin': [i + 1]}
+                if rule['protocol'] in ('tcp', 'udp'):
+                    rule['port'] = rng.choice([22, 80, 443, '8000-8100', '*'])
+                rules.append(rule)
+            hits = {'ingress': {str(i + 1): rng.randint(0, 1000) for i in range(8)}}
+            reordered, _ = reorder_policy({'ingress': rules}, hits)
+
+            position = {r['origin'][0]: n for n, r in enumerate(reordered['ingress'])}
+            for i, earlier in enumerate(rules):
+                for later in rules[i + 1:]:
+                    if earlier['action'] != later['action'] and \
+                       any(_matches(earlier, p) and _matches(later, p) for p in PACKETS):
+                        self.assertLess(position[earlier['origin'][0]], position[later['origin'][0]],
+                                        (rules, reordered['ingress']))
+
+if __name__ == '__main__':
+    unittest.main()
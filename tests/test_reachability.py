@@ -0,0 +1,84 @@
+"""
+Unit tests for reachability expectations (no root needed, runs on the sim backend)
+
+    python3 -m unittest discover -s tests
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from reachability import forward_verdict, parse_forward_chain
+
+SAVED = """*filter
+:INPUT ACCEPT [0:0]
+:FORWARD DROP [0:0]
+:OUTPUT ACCEPT [0:0]
+-A FORWARD -i br-a -o br-a -j ACCEPT
+-A FORWARD ! -s 10.9.0.0/16 -i br+ -m comment --comment "vpcs" -j ACCEPT
+COMMIT
+"""
+
+class ForwardVerdictTest(unittest.TestCase):
+    def setUp(self):
+        self.chain = parse_forward_chain(SAVED)
+
+    def test_rules_and_policy(self):
+        self.assertEqual(self.chain[0], 'DROP')
+        packet = {'in': 'br-a', 'out': 'br-b', 'src': '10.1.1.2', 'dst': '10.2.1.2'}
+        self.assertTrue(forward_verdict(self.chain, packet))
+        # Negated source, then the chain policy
+        self.assertFalse(forward_verdict(self.chain, dict(packet, src='10.9.1.2')))
+        self.assertFalse(forward_verdict(self.chain, dict(packet, **{'in': 'eth0'})))
+
+    def test_rules_it_cannot_evaluate_give_none(self):
+        policy, rules = self.chain
+        rules.insert(0, ['-p', 'tcp', '--dport', '22', '-j', 'DROP'])
+        packet = {'in': 'br-a', 'out': 'br-b', 'src': '10.1.1.2', 'dst': '10.2.1.2'}
+        self.assertIsNone(forward_verdict((policy, rules), packet))
+
+class UnpeeredVPCTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        os.environ['VPCCTL_STATE_DIR'] = self.scratch
+        self.addCleanup(shutil.rmtree, self.scratch)
+        self.addCleanup(os.environ.pop, 'VPCCTL_STATE_DIR')
+
+        from sim_kernel import SimBackend
+        from vpc_manager import VPCManager
+        from subnet_manager import SubnetManager
+        from reachability import ReachabilityChecker
+        self.backend = SimBackend(self.scratch)
+        logger = logging.getLogger('test')
+        for i, vpc in enumerate(('b', 'c'), 2):
+            VPCManager(logger, self.backend).create_vpc(vpc, f"10.{i}.0.0/16")
+            SubnetManager(logger, self.backend).create_subnet(vpc, 's1', f"10.{i}.1.0/24", 'private')
+        self.checker = ReachabilityChecker(logger, backend=self.backend)
+
+    def _check(self):
+        # The matrix goes to stdout
+        with open(os.devnull, 'w') as devnull:
+            saved, sys.stdout = sys.stdout, devnull
+            try:
+                return self.checker.check()
+            finally:
+                sys.stdout = saved
+
+    def test_host_forwarding_is_expected(self):
+        self.assertTrue(self._check())
+
+    def test_host_drop_is_expected(self):
+        self.backend.run("iptables -w -I FORWARD 1 -i br-b -o br-c -j DROP")
+        self.assertTrue(self._check())
+
+    def test_unknown_rules_are_not_predicted(self):
+        self.backend.run("iptables -w -I FORWARD 1 -p tcp --dport 22 -j DROP")
+        self.assertTrue(self._check())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Unit tests for VPC and subnet creation (no root needed, runs on the sim backend)
+
+    python3 -m unittest discover -s tests
+"""
+
+import ipaddress
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+class SubnetTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        os.environ['VPCCTL_STATE_DIR'] = self.scratch
+        self.addCleanup(shutil.rmtree, self.scratch)
+        self.addCleanup(os.environ.pop, 'VPCCTL_STATE_DIR')
+
+        from sim_kernel import SimBackend
+        from vpc_manager import VPCManager
+        from subnet_manager import SubnetManager
+        self.backend = SimBackend(self.scratch)
+        logger = logging.getLogger('test')
+        self.vpc_mgr = VPCManager(logger, self.backend)
+        self.subnet_mgr = SubnetManager(logger, self.backend)
+
+    def test_bridge_address_has_the_vpc_prefix(self):
+        from sim_kernel import HOST
+        self.vpc_mgr.create_vpc('prod', '10.20.0.0/24')
+        bridge = self.backend.kernel.namespaces[HOST]['links']['br-prod']
+        self.assertEqual(bridge['addresses'], ['10.20.0.1/24'])
+
+    def test_parallel_allocations_never_overlap(self):
+        self.vpc_mgr.create_vpc('prod', '10.0.0.0/16')
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(lambda i: self.subnet_mgr.create_subnet('prod', f"s{i}", None, 'private',
+                                                                   prefix_len=24), range(8)))
+
+        cidrs = sorted(ipaddress.ip_network(subnet['cidr'])
+                       for subnet in self.subnet_mgr.store.get_subnets('prod').values())
+        self.assertEqual(len(cidrs), 8)
+        for first, second in zip(cidrs, cidrs[1:]):
+            self.assertFalse(first.overlaps(second), cidrs)
+
+    def test_failed_create_gives_the_cidr_back(self):
+        self.vpc_mgr.create_vpc('prod', '10.0.0.0/16')
+        batch = self.backend.batch
+
+        def broken_batch(namespace=None):
+            raise OSError("no more namespaces")
+        self.backend.batch = broken_batch
+        with self.assertRaises(OSError):
+            self.subnet_mgr.create_subnet('prod', 'web', '10.0.1.0/24', 'private')
+        self.backend.batch = batch
+
+        self.assertEqual(self.subnet_mgr.store.get_subnets('prod'), {})
+        self.subnet_mgr.create_subnet('prod', 'web', '10.0.1.0/24', 'private')
+
+    def test_failed_create_takes_down_the_namespace_and_veth(self):
+        from sim_kernel import HOST
+        self.vpc_mgr.create_vpc('prod', '10.0.0.0/16')
+        namespaces = set(self.backend.kernel.namespaces)
+        links = set(self.backend.kernel.namespaces[HOST]['links'])
+
+        def broken_sysctl(key, value, namespace=None):
+            raise OSError("read-only /proc/sys")
+        self.backend.sysctl = broken_sysctl
+        with self.assertRaises(OSError):
+            self.subnet_mgr.create_subnet('prod', 'web', '10.0.1.0/24', 'private')
+        del self.backend.sysctl
+
+        self.assertEqual(set(self.backend.kernel.namespaces), namespaces)
+        self.assertEqual(set(self.backend.kernel.namespaces[HOST]['links']), links)
+        self.assertEqual(self.subnet_mgr.store.get_subnets('prod'), {})
+
+    def test_bridge_options_are_the_vpcs(self):
+        self.vpc_mgr.create_vpc('prod', '10.0.0.0/16')
+        self.subnet_mgr.create_subnet('prod', 'data', '10.0.1.0/24', 'private', profile='high-throughput')
+        self.assertEqual(self.subnet_mgr.store.get_vpc('prod')['bridge_options'],
+                         {'forward_delay': 0, 'mcast_snooping': 0})
+
+        path = os.path.join(self.scratch, 'snooping.json')
+        with open(path, 'w') as f:
+            f.write('{"bridge": {"multicast_snooping": true}}')
+        with self.assertRaisesRegex(ValueError, 'mcast_snooping 0 -> 1'):
+            self.subnet_mgr.create_subnet('prod', 'media', '10.0.2.0/24', 'private', profile=path)
+        self.assertNotIn('media', self.subnet_mgr.store.get_subnets('prod'))
+
+    def test_stop_app_leaves_processes_it_did_not_start(self):
+        self.vpc_mgr.create_vpc('prod', '10.0.0.0/16')
+        self.subnet_mgr.create_subnet('prod', 'web', '10.0.1.0/24', 'private')
+        self.subnet_mgr.deploy_app('prod', 'web', 8080)
+        namespace = self.subnet_mgr.store.get_subnets('prod')['web']['namespace']
+        by_hand = self.backend.spawn(namespace, 'sleep 1000')
+
+        self.subnet_mgr.stop_app('prod')
+        self.assertEqual(self.backend.namespace_pids([namespace]), {namespace: [by_hand]})
+        self.assertNotIn('apps', self.subnet_mgr.store.get_subnets('prod')['web'])
+
+        # delete-subnet still takes down everything in the namespace
+        self.subnet_mgr.delete_subnet('prod', 'web')
+        self.assertEqual(self.backend.running([by_hand]), {})
+
+if __name__ == '__main__':
+    unittest.main()
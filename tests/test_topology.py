@@ -0,0 +1,51 @@
+"""
+Unit tests for topology files (no root needed, runs on the sim backend)
+
+    python3 -m unittest discover -s tests
+"""
+
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+class LoadTopologyTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.mkdtemp()
+        os.environ['VPCCTL_STATE_DIR'] = self.scratch
+        self.addCleanup(shutil.rmtree, self.scratch)
+        self.addCleanup(os.environ.pop, 'VPCCTL_STATE_DIR')
+
+        from backends import get_backend
+        from topology_manager import TopologyManager
+        self.manager = TopologyManager(logging.getLogger('test'), backend=get_backend('sim'))
+
+    def _write(self, subnets):
+        path = os.path.join(self.scratch, 'topology.json')
+        with open(path, 'w') as f:
+            json.dump({'vpcs': {'prod': {'cidr': '10.0.0.0/16', 'subnets': subnets}}}, f)
+        return path
+
+    def test_overlapping_subnets_are_rejected(self):
+        path = self._write({'web': {'cidr': '10.0.1.0/24'},
+                            'db': {'cidr': '10.0.2.0/24'},
+                            'all': {'cidr': '10.0.0.0/22'}})
+        with self.assertRaisesRegex(ValueError, 'overlap'):
+            self.manager.apply(path)
+        from utils import load_vpc_state
+        self.assertEqual(load_vpc_state().get('vpcs', {}), {})
+
+    def test_adjacent_subnets_are_fine(self):
+        path = self._write({'web': {'cidr': '10.0.1.0/24'},
+                            'db': {'cidr': '10.0.2.0/24'},
+                            'low': {'cidr': '10.0.0.0/24'}})
+        desired = self.manager._load_topology(path)
+        self.assertEqual(set(desired['vpcs']['prod']['subnets']), {'web', 'db', 'low'})
+
+if __name__ == '__main__':
+    unittest.main()
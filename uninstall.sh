@@ -17,6 +17,7 @@ fi
 
 INSTALL_DIR="/opt/vpcctl"
 BIN_LINK="/usr/local/bin/vpcctl"
+DAEMON_LINK="/usr/local/bin/vpcctld"
 
 # Clean up VPC resources first
 if [ -x "$INSTALL_DIR/vpcctl" ]; then
@@ -24,11 +25,13 @@ if [ -x "$INSTALL_DIR/vpcctl" ]; then
     "$INSTALL_DIR/vpcctl" cleanup-all 2>/dev/null || true
 fi
 
-# Remove symlink
-if [ -L "$BIN_LINK" ]; then
-    echo "Removing symlink: $BIN_LINK"
-    rm -f "$BIN_LINK"
-fi
+# Remove symlinks
+for link in "$BIN_LINK" "$DAEMON_LINK"; do
+    if [ -L "$link" ]; then
+        echo "Removing symlink: $link"
+        rm -f "$link"
+    fi
+done
 
 # Remove installation directory
 if [ -d "$INSTALL_DIR" ]; then